@@ -0,0 +1,159 @@
+import asyncio
+import os
+import threading
+
+import metrics
+
+# The lanes queries are admitted through. Expensive queries (rankings over
+# every tune, unfiltered searches) get a lane of their own, so a burst of them
+# can't hold up the cheap lookups.
+CHEAP = 'cheap'
+EXPENSIVE = 'expensive'
+
+# Queries each worker process sends to the endpoint at the same time in each
+# lane. Together they should be no more than the SPARQL client's pool.
+CHEAP_CONCURRENCY = int(os.environ.get('ADMISSION_CHEAP_CONCURRENCY', 8))
+EXPENSIVE_CONCURRENCY = int(os.environ.get('ADMISSION_EXPENSIVE_CONCURRENCY', 2))
+# Queries that can wait for a slot in each lane. Beyond this, requests are
+# turned away with a 503 rather than left to time out.
+CHEAP_QUEUE_SIZE = int(os.environ.get('ADMISSION_CHEAP_QUEUE_SIZE', 32))
+EXPENSIVE_QUEUE_SIZE = int(os.environ.get('ADMISSION_EXPENSIVE_QUEUE_SIZE', 8))
+# Seconds a query waits for a slot before it is turned away.
+QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10))
+# Seconds a client that was turned away is asked to wait before retrying.
+RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))
+
+
+# Raised when a query can't be admitted because its lane is full.
+class OverloadedError(Exception):
+    def __init__(self, lane):
+        super().__init__(f"Too many {lane} queries waiting for the SPARQL endpoint")
+        self.lane = lane
+
+
+# A number of slots for sending queries, and a bounded queue of the queries
+# waiting for one, served in order.
+class Lane:
+    def __init__(self, name, concurrency, queue_size):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout):
+        with self._condition:
+            if self.in_flight >= self.concurrency or self.waiting:
+                if self.waiting >= self.queue_size:
+                    self.rejected += 1
+                    raise OverloadedError(self.name)
+                self.waiting += 1
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self.in_flight < self.concurrency, timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    self.rejected += 1
+                    raise OverloadedError(self.name)
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+        }
+
+
+# Bounds the queries a worker process sends to the endpoint at the same time,
+# with a lane for cheap queries and one for expensive ones. Use as
+#     with admission.admit(EXPENSIVE):
+#         response = sparql_client.query(sparql_query)
+class AdmissionControl:
+    lane_class = Lane
+
+    def __init__(self, cheap_concurrency=CHEAP_CONCURRENCY,
+                 expensive_concurrency=EXPENSIVE_CONCURRENCY,
+                 cheap_queue_size=CHEAP_QUEUE_SIZE,
+                 expensive_queue_size=EXPENSIVE_QUEUE_SIZE,
+                 timeout=QUEUE_TIMEOUT):
+        self.timeout = timeout
+        self.lanes = {
+            CHEAP: self.lane_class(CHEAP, cheap_concurrency, cheap_queue_size),
+            EXPENSIVE: self.lane_class(EXPENSIVE, expensive_concurrency, expensive_queue_size),
+        }
+
+    # A slot in a lane, held for the duration of a with block. Raises
+    # OverloadedError if the lane's queue is full or the wait times out.
+    def admit(self, lane):
+        return _Admission(self.lanes[lane], self.timeout)
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+class _Admission:
+    def __init__(self, lane, timeout):
+        self.lane = lane
+        self.timeout = timeout
+
+    def __enter__(self):
+        with metrics.stage('queue'):
+            self.lane.acquire(self.timeout)
+
+    def __exit__(self, *exc_info):
+        self.lane.release()
+
+    async def __aenter__(self):
+        with metrics.stage('queue'):
+            await self.lane.acquire(self.timeout)
+
+    async def __aexit__(self, *exc_info):
+        self.lane.release()
+
+
+# The Lane of the asynchronous server, whose queries wait on its event loop.
+class AsyncLane(Lane):
+    def __init__(self, name, concurrency, queue_size):
+        super().__init__(name, concurrency, queue_size)
+        self._released = asyncio.Condition()
+
+    async def acquire(self, timeout):
+        async with self._released:
+            if self.in_flight >= self.concurrency or self.waiting:
+                if self.waiting >= self.queue_size:
+                    self.rejected += 1
+                    raise OverloadedError(self.name)
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self._released.wait_for(
+                        lambda: self.in_flight < self.concurrency), timeout)
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    raise OverloadedError(self.name)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._released:
+            self._released.notify()
+
+
+# The AdmissionControl of the asynchronous server. Use as
+#     async with admission.admit(EXPENSIVE):
+#         response = await sparql_client.query(sparql_query)
+class AsyncAdmissionControl(AdmissionControl):
+    lane_class = AsyncLane
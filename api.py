@@ -0,0 +1,402 @@
+import threading
+
+from query_factory import (get_tune_given_name, get_pattern_search_query,
+                           advanced_search,
+                           get_most_common_patterns_for_a_tune,
+                           get_tune_data, get_tune_family_members,
+                           get_patterns_in_common_between_two_tunes,
+                           get_ranked_patterns_by_tune, get_ranked_tunes_by_pattern,
+                           get_ranked_tunes_by_common_patterns, get_page,
+                           get_kg_version, NUM_NODES)
+
+from admission import CHEAP, EXPENSIVE
+from facet_lists import FacetLists
+import metrics
+from fuzzy_search import MAX_TITLE_SUGGEST_LIMIT, TITLE_SUGGEST_LIMIT, FuzzySearch
+from kg_version import KGVersionMonitor
+from local_store import make_sparql_client
+from pattern_index import ENABLED as PATTERN_INDEX_ENABLED, PatternIndex
+from pattern_suggest import MAX_SUGGEST_LIMIT, PREFIX, SUBSTRING, SUGGEST_LIMIT
+from response_cache import (RANKED_LIST_MAX_AGE, RANKED_LIST_MAX_BYTES,
+                            ResponseCache)
+from sparql_client import BLAZEGRAPH_URL
+from tune_similarity import TuneSimilarity
+
+# The /api routes, shared by the Flask app (app.py) and the ASGI app
+# (asgi_app.py). Each route is a function of the query parameters returning a
+# plan of its response: a result that is already known, a query to run, or a
+# document to send as it is. The apps only differ in how they run the queries
+# and send the responses, so the handlers never do I/O themselves, apart from
+# the in-memory indexes and the drop-down lists, which may have to be loaded.
+
+# Value of the format query parameter selecting the compact column format
+# (see get_columns) instead of the SPARQL JSON results format.
+COLUMNS_FORMAT = 'columns'
+# Warning header of a response that includes a stale cached result.
+STALE_WARNING = '110 - "Response is Stale"'
+# Error of a response whose query failed.
+QUERY_FAILED = {'error': 'Failed to execute SPARQL query'}
+
+EMPTY_SEARCH_RESPONSE = {"head":{"vars":["tune_name", "tuneType", "key", "signature", "id"]},"results":{"bindings":[]}}
+response_cache = ResponseCache()
+ranked_list_cache = ResponseCache(max_bytes=RANKED_LIST_MAX_BYTES,
+                                  max_age=RANKED_LIST_MAX_AGE)
+# The SPARQL endpoint (or the embedded store if LOCAL_STORE_DIR is set), the
+# KG version monitor and the indexes, which are set up by start().
+sparql_client = None
+kg_version_monitor = None
+fuzzy_search = None
+facet_lists = None
+pattern_index = None
+tune_similarity = None
+_start_lock = threading.Lock()
+_started = False
+
+
+# Open the SPARQL client, read the KG version and start loading the indexes.
+# Each app calls this once before serving; calling it again does nothing.
+def start():
+    global sparql_client, kg_version_monitor, fuzzy_search, facet_lists, pattern_index, tune_similarity
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        sparql_client = make_sparql_client(BLAZEGRAPH_URL)
+        kg_version_monitor = KGVersionMonitor(sparql_client)
+        kg_version_monitor.add_listener(response_cache.set_version)
+        kg_version_monitor.add_listener(ranked_list_cache.set_version)
+        kg_version_monitor.start()
+        fuzzy_search = FuzzySearch(sparql_client, kg_version_monitor.version)
+        kg_version_monitor.add_listener(fuzzy_search.refresh)
+        facet_lists = FacetLists(sparql_client)
+        kg_version_monitor.add_listener(lambda version: facet_lists.load())
+        pattern_index = PatternIndex(sparql_client)
+        if PATTERN_INDEX_ENABLED:
+            pattern_index.start(kg_version_monitor.version)
+            kg_version_monitor.add_listener(pattern_index.set_version)
+        tune_similarity = TuneSimilarity(kg_version_monitor.version)
+        kg_version_monitor.add_listener(tune_similarity.set_version)
+        metrics.stats_collector.add('response_cache', response_cache.stats)
+        metrics.stats_collector.add('ranked_list_cache', ranked_list_cache.stats)
+        metrics.stats_collector.add('title_match_cache', fuzzy_search.match_cache_stats)
+        metrics.stats_collector.add('sparql_client', sparql_client.stats)
+        metrics.stats_collector.add('sparql_circuit_breaker', sparql_client.breaker.stats)
+        _started = True
+
+
+# A result that is already known, a decoded SPARQL JSON result.
+class Answer:
+    def __init__(self, result):
+        self.result = result
+
+
+# A SPARQL query whose JSON result is sent as it is. It is cached in the
+# response cache unless cached is false.
+class Query:
+    def __init__(self, sparql_query, lane=CHEAP, cached=True):
+        self.sparql_query = sparql_query
+        self.lane = lane
+        self.cached = cached
+
+
+# The page for click_num of the result of a ranked query (see run_paged_query).
+class PagedQuery:
+    def __init__(self, ranked_query, click_num):
+        self.ranked_query = ranked_query
+        self.click_num = click_num
+
+
+# A JSON object of the results of several plans, by name, run concurrently.
+class Bundle:
+    def __init__(self, parts):
+        self.parts = parts
+
+
+# A JSON document sent as it is, with its status.
+class Document:
+    def __init__(self, document, status=200):
+        self.document = document
+        self.status = status
+
+
+# The number of results asked for by a limit parameter, kept between 1 and
+# most, or None if it isn't a whole number.
+def read_limit(value, most):
+    try:
+        return max(1, min(int(value), most))
+    except (TypeError, ValueError):
+        return None
+
+
+# The pattern endpoints are answered from the pattern index once it has been
+# loaded, and by querying the SPARQL endpoint until then.
+def find_most_common_patterns(tune_id, exclude_trivial_patterns):
+    with metrics.stage('pattern_index'):
+        result = pattern_index.most_common_patterns(tune_id, exclude_trivial_patterns)
+    if result is None:
+        return Query(get_most_common_patterns_for_a_tune(tune_id, exclude_trivial_patterns))
+    return Answer(result)
+
+
+def find_common_patterns(tune_id, prev, exclude_trivial_patterns):
+    with metrics.stage('pattern_index'):
+        result = pattern_index.common_patterns(tune_id, prev, exclude_trivial_patterns)
+    if result is None:
+        return Query(get_patterns_in_common_between_two_tunes(tune_id, prev, exclude_trivial_patterns))
+    return Answer(result)
+
+
+def find_neighbour_patterns(tune_id, click_num, exclude_trivial_patterns):
+    with metrics.stage('pattern_index'):
+        result = pattern_index.ranked_patterns(tune_id, exclude_trivial_patterns)
+    if result is None:
+        return PagedQuery(get_ranked_patterns_by_tune(tune_id, exclude_trivial_patterns), click_num)
+    return Answer(get_page(result, NUM_NODES*int(click_num), NUM_NODES))
+
+
+# The advanced search is answered from the facet index of the pattern index
+# when it is built, and from the SPARQL endpoint otherwise.
+def find_advanced_search(query_params, matched_tuples):
+    with metrics.stage('facet_index'):
+        result = pattern_index.advanced_search(query_params, matched_tuples)
+    if result is None:
+        with metrics.stage('build_query'):
+            sparql_query = advanced_search(query_params, matched_tuples)
+        # Without a title the search runs over every tune.
+        return Query(sparql_query, lane=CHEAP if matched_tuples else EXPENSIVE)
+    return Answer(result)
+
+
+def find_tunes_by_pattern(pattern):
+    with metrics.stage('pattern_index'):
+        result = pattern_index.tunes_by_pattern(pattern)
+    if result is None:
+        return Query(get_pattern_search_query(pattern), lane=EXPENSIVE)
+    return Answer(result)
+
+
+# Pattern completions come from the pattern index. They are asked for at
+# every key pressed, too often to scan the patterns of the graph for each, so
+# until the index is loaded there are none.
+def find_pattern_suggestions(term, match, limit):
+    with metrics.stage('pattern_index'):
+        result = pattern_index.suggest_patterns(term, match, limit)
+    if result is None:
+        result = {'head': {'vars': ['pattern', 'patternFreq']},
+                  'results': {'bindings': []}}
+    return Answer(result)
+
+
+# Titles starting with the text typed so far, from the fuzzy search's title
+# table, as (title, id) rows.
+def find_title_suggestions(text, limit):
+    with metrics.stage('title_match'):
+        suggestions = fuzzy_search.suggest_titles(text, limit)
+    return {'head': {'vars': ['title', 'id']},
+            'results': {'bindings': [{'title': {'type': 'literal', 'value': title},
+                                      'id': {'type': 'literal', 'value': tune_id}}
+                                     for title, tune_id in suggestions]}}
+
+
+# The tune-tune network comes from the output of the tune similarity job when
+# it is up to date, and from the SPARQL endpoint otherwise.
+def find_neighbour_tunes(tune_id, click_num):
+    with metrics.stage('tune_similarity'):
+        result = tune_similarity.neighbour_tunes(tune_id, NUM_NODES*int(click_num), NUM_NODES)
+    if result is None:
+        return PagedQuery(get_ranked_tunes_by_common_patterns(tune_id), click_num)
+    return Answer(result)
+
+
+# A drop-down list of the search page. The lists are loaded at startup and
+# refreshed when the KG version changes.
+def find_list(name):
+    values = facet_lists.get(name)
+    if values is None:
+        return Document(QUERY_FAILED, 500)
+    # Return the JSON data
+    return Document(values)
+
+
+def search(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict(flat=False)
+    # Composition title based search
+    search_type = query_params['searchType'][0]
+    if search_type == "title":
+        search_term = query_params['searchTerm'][0]
+        with metrics.stage('title_match'):
+            fuzzy_title_matches = fuzzy_search.get_title_best_match(search_term)
+        if not fuzzy_title_matches:
+            # If there are no matched titles, return an empty response.
+            return Answer(EMPTY_SEARCH_RESPONSE)
+        # Generate the SPARQL query
+        with metrics.stage('build_query'):
+            return Query(get_tune_given_name(fuzzy_title_matches))
+    # Patters based search
+    elif search_type == "pattern":
+        return find_tunes_by_pattern(query_params['searchTerm'][0])
+    # Advanced search
+    elif search_type == "advanced":
+        matched_tuples = []
+        if query_params['title'][0]:
+            search_term = query_params['title'][0]
+            with metrics.stage('title_match'):
+                matched_tuples = fuzzy_search.get_title_best_match(search_term)
+        if query_params['title'][0] and not matched_tuples:
+            # If a title is searched for and there are no matched titles,
+            # return an empty response.
+            return Answer(EMPTY_SEARCH_RESPONSE)
+        return find_advanced_search(query_params, matched_tuples)
+    # Error message.
+    return Document({'error': 'Invalid search type.'}, 501)
+
+
+# Title suggestions for the search box, fetched as each key is typed: the
+# titles with a word starting with the search term. They come from memory,
+# without querying the endpoint.
+def getTitleSuggestions(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    limit = read_limit(query_params.get('limit', TITLE_SUGGEST_LIMIT), MAX_TITLE_SUGGEST_LIMIT)
+    if limit is None:
+        return Document({'error': 'Invalid limit.'}, 400)
+    return Answer(find_title_suggestions(query_params.get('searchTerm', ''), limit))
+
+
+def getCorpusList(args):
+    return find_list('corpus')
+
+
+def getKeysList(args):
+    return find_list('key')
+
+
+def getTimeSignatureList(args):
+    return find_list('signature')
+
+
+def getTuneTypeList(args):
+    return find_list('tuneType')
+
+
+def getPatterns(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    # Get the patterns from the pattern index or the SPARQL endpoint
+    return find_most_common_patterns(query_params['id'],
+                                     query_params['excludeTrivialPatterns'])
+
+
+def getCommonPatterns(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    # Get the patterns from the pattern index or the SPARQL endpoint
+    return find_common_patterns(query_params['id'],
+                                query_params['prev'],
+                                query_params['excludeTrivialPatterns'])
+
+
+def getNeighbourPatterns(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    # Get the patterns from the pattern index or the SPARQL endpoint
+    return find_neighbour_patterns(query_params['id'],
+                                   query_params['click_num'],
+                                   query_params['excludeTrivialPatterns'])
+
+
+def getNeighbourTunes(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    # Generate the SPARQL query
+    return PagedQuery(get_ranked_tunes_by_pattern(query_params['id']), query_params['click_num'])
+
+
+def getNeighbourTunesByCommonPatterns(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    # Get the tunes from the precomputed similarity or the SPARQL endpoint
+    return find_neighbour_tunes(query_params['id'], query_params['click_num'])
+
+
+def getTuneData(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    # Generate the SPARQL query
+    return Query(get_tune_data(query_params['id']))
+
+
+def getTuneFamilyMembers(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    # Generate the SPARQL query
+    return Query(get_tune_family_members(query_params['family']))
+
+
+def getTunesContainingPattern(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    # Get the tunes from the pattern index or the SPARQL endpoint
+    return find_tunes_by_pattern(query_params['pattern'])
+
+
+# Completions of a partly typed pattern for the pattern search, the most
+# frequent patterns in the corpus starting with the search term, or
+# containing it if match=substring.
+def getPatternSuggestions(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    match = query_params.get('match', PREFIX)
+    if match not in (PREFIX, SUBSTRING):
+        return Document({'error': 'Invalid match type.'}, 400)
+    limit = read_limit(query_params.get('limit', SUGGEST_LIMIT), MAX_SUGGEST_LIMIT)
+    if limit is None:
+        return Document({'error': 'Invalid limit.'}, 400)
+    # Get the patterns from the pattern index
+    return find_pattern_suggestions(query_params.get('searchTerm', ''), match, limit)
+
+
+# Everything the composition page needs in one response: the tune data, its
+# patterns and the first page of both networks. The apps run the queries
+# concurrently, so this takes about as long as the slowest of them.
+def getComposition(args):
+    # Get the query parameters from the GET request
+    query_params = args.to_dict()
+    tune_id = query_params['id']
+    click_num = query_params.get('click_num', '0')
+    exclude_trivial_patterns = query_params.get('excludeTrivialPatterns', 'true')
+    return Bundle({
+        'tune': Query(get_tune_data(tune_id)),
+        'patterns': find_most_common_patterns(tune_id, exclude_trivial_patterns),
+        'neighbour_patterns': find_neighbour_patterns(tune_id, click_num, exclude_trivial_patterns),
+        'neighbour_tunes': find_neighbour_tunes(tune_id, click_num),
+    })
+
+
+def getKGVersion(args):
+    # Generate the SPARQL query. This is what the cache is keyed on, so it is
+    # never served from the cache.
+    return Query(get_kg_version(), cached=False)
+
+
+# The rule of each route and its handler.
+ROUTES = [
+    ('/api/search', search),
+    ('/api/title_suggest', getTitleSuggestions),
+    ('/api/corpus_list', getCorpusList),
+    ('/api/keys_list', getKeysList),
+    ('/api/time_sig_list', getTimeSignatureList),
+    ('/api/tune_type_list', getTuneTypeList),
+    ('/api/patterns', getPatterns),
+    ('/api/common_patterns', getCommonPatterns),
+    ('/api/neighbour_patterns', getNeighbourPatterns),
+    ('/api/neighbour_tunes', getNeighbourTunes),
+    ('/api/neighbour_tunes_by_common_patterns', getNeighbourTunesByCommonPatterns),
+    ('/api/tune_by_id', getTuneData),
+    ('/api/tuneFamilyMembers', getTuneFamilyMembers),
+    ('/api/tunes_by_pattern', getTunesContainingPattern),
+    ('/api/pattern_suggest', getPatternSuggestions),
+    ('/api/composition', getComposition),
+    ('/api/kg_version', getKGVersion),
+]
@@ -1,396 +1,420 @@
-from flask import Flask, request, jsonify
+import contextvars
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, g, has_app_context, request, jsonify
 import requests
+from flask_compress import Compress
 from flask_cors import CORS
-from query_factory import (get_tune_given_name, get_pattern_search_query,
-                           advanced_search, get_most_common_patterns_for_a_tune,
-                           get_neighbour_patterns_by_tune, get_neighbour_tunes_by_pattern,
-                           get_tune_data, get_tune_family_members,
-                           get_patterns_in_common_between_two_tunes,
-                           get_neighbour_tunes_by_common_patterns,
-                           get_corpus_list, get_keys_list, get_time_sig_list,
-                           get_tune_type_list, get_kg_version)
-
-from fuzzy_search import FuzzySearch
-
+from query_factory import paginate, get_page, get_columns, NUM_NODES, RANKED_LIST_MAX_ROWS
+
+import api
+from api import (COLUMNS_FORMAT, QUERY_FAILED, STALE_WARNING, Answer, Bundle, Document,
+                 PagedQuery, ranked_list_cache, response_cache)
+from admission import CHEAP, EXPENSIVE, RETRY_AFTER, AdmissionControl, OverloadedError
+import metrics
+from refresher import Refresher
+from single_flight import SingleFlight
+from sparql_client import CHUNK_SIZE as STREAM_CHUNK_SIZE, POOL_SIZE
+
+# The /api routes of api.py served by Flask, with blocking calls to the SPARQL
+# endpoint.
 app = Flask(__name__)
-CORS(app)
-
-BLAZEGRAPH_URL = 'https://polifonia.disi.unibo.it/fonn/sparql'
-
-EMPTY_SEARCH_RESPONSE = {"head":{"vars":["tune_name", "tuneType", "key", "signature", "id"]},"results":{"bindings":[]}}
-fuzzy_search = FuzzySearch(BLAZEGRAPH_URL)
-
-
-@app.route('/api/search', methods=['GET'])
-def search():
-    #print(request)
-    # Get the query parameters from the GET request
-    query_params = request.args.to_dict(flat=False)
-    # Composition title based search
-    search_type = query_params['searchType'][0]
-    #print(query_params)
-    sparql_query = ""
-    if search_type == "title":
-        search_term = query_params['searchTerm'][0]
-        fuzzy_title_matches = fuzzy_search.get_title_best_match(search_term)
-        if not fuzzy_title_matches:
-            # If there are no matched titles, return an empty response.
-            return jsonify(EMPTY_SEARCH_RESPONSE), 200
-        else:
-            # Generate the SPARQL query
-            sparql_query = get_tune_given_name(fuzzy_title_matches)
-    # Patters based search
-    elif search_type == "pattern":
-        search_term = query_params['searchTerm'][0]
-        sparql_query = get_pattern_search_query(search_term)
-    # Advanced search
-    elif search_type == "advanced":
-        matched_tuples = []
-        if query_params['title'][0]:
-            search_term = query_params['title'][0]
-            matched_tuples = fuzzy_search.get_title_best_match(search_term)
-        if query_params['title'][0] and not matched_tuples:
-            # If a title is searched for and there are no matched titles,
-            # return an empty response.
-            return jsonify(EMPTY_SEARCH_RESPONSE), 200
-        else:
-            sparql_query = advanced_search(query_params, matched_tuples)
+CORS(app, expose_headers=['Warning'])
+# Responses are compressed with brotli or gzip, as the client accepts. The
+# streamed query results too: Flask-Compress leaves gzip out of the encodings
+# it streams by default, and some clients only accept gzip.
+app.config['COMPRESS_ALGORITHM_STREAMING'] = ['br', 'gzip', 'deflate']
+Compress(app)
+
+api.start()
+query_flights = SingleFlight()
+# Bounds the queries sent to the endpoint at the same time.
+admission = AdmissionControl()
+# Refreshes stale cached results in the background.
+refresher = Refresher()
+# Runs the queries of a composition page concurrently. It has as many threads
+# as the SPARQL client has connections.
+query_executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+metrics.stats_collector.add('admission', admission.stats, label='lane')
+metrics.stats_collector.add('stale_refresh', refresher.stats)
+metrics.stats_collector.add('single_flight', lambda: {'coalesced': query_flights.coalesced})
+
+
+# Execute a SPARQL query and return its JSON result as it was sent by the
+# endpoint, as an iterable of chunks of bytes, or None if the endpoint could
+# not be reached or returned an error. The routes pass it on unchanged rather
+# than decoding and re-encoding it, and large results are streamed through.
+# Results are cached until the knowledge graph version changes; pass
+# cache=None to always query the endpoint. Unless stale is false, a stale
+# cached result is returned while it is refreshed in the background, and the
+# last known good result however old while the endpoint is unavailable.
+def run_raw_query(sparql_query, cache=response_cache, stale=True, lane=CHEAP):
+    if cache is None:
+        return fetch_raw_query(sparql_query, None, None, None, lane)
+    cache_version = cache.version
+    body = cache.get(sparql_query)
+    if body is None and stale:
+        body = cache.get_stale(sparql_query, any_age=not api.sparql_client.breaker.closed)
+        if body is not None:
+            mark_stale()
+            refresher.submit(sparql_query, refresh_raw_query, cache, lane)
+    if body is not None:
+        return [body]
+    # Identical queries running at the same time share one call to the
+    # endpoint: the first caller makes it and the others wait for its result.
+    flight, leader = query_flights.join(sparql_query, cache_version)
+    if not leader:
+        with metrics.stage('coalesced_wait'):
+            body = flight.wait()
+        if body is not None:
+            cache.put(sparql_query, body, len(body), cache_version)
+            return [body]
+        # The call failed or its result was too large to pass on.
+        flight = None
+    return fetch_raw_query(sparql_query, cache, cache_version, flight, lane)
+
+
+# Replace the stale cached result of a query with a fresh one.
+def refresh_raw_query(sparql_query, cache, lane):
+    result = run_raw_query(sparql_query, cache, stale=False, lane=lane)
+    if result is not None:
+        read_body(result)
+
+
+# Send a query admitted through its lane. The lane's slot is held until the
+# endpoint starts responding, which for the ranking queries is when it has
+# evaluated them.
+#
+# A result small enough to be cached is read whole before it is passed on,
+# and the callers waiting on flight get it then, so neither they nor the
+# connection to the endpoint depend on how fast, or whether, the client of
+# this request reads it. A larger result finishes the flight with None and is
+# streamed through.
+def fetch_raw_query(sparql_query, cache, cache_version, flight, lane):
+    try:
+        with admission.admit(lane):
+            response = api.sparql_client.query(sparql_query, stream=True)
+    except requests.RequestException as e:
+        print(f"Error executing Sparql Query = {sparql_query}")
+        print(e)
+        response = None
+    except OverloadedError:
+        if flight is not None:
+            query_flights.finish(flight, None)
+        raise
     else:
-        # Error message.
-        return jsonify({'error': 'Invalid search type.'}), 501
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
+        if response.status_code != 200:
+            print(f"Error executing Sparql Query = {sparql_query}")
+            print(response.text)
+            response.close()
+            response = None
+    if response is None:
+        if flight is not None:
+            query_flights.finish(flight, None)
+        return None
+    chunks = response.iter_content(STREAM_CHUNK_SIZE)
+    if cache is None:
+        return StreamedBody(response, [], chunks)
+    head = []
+    size = 0
+    try:
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size > cache.max_entry_bytes:
+                break
+    except requests.RequestException as e:
+        print(f"Error reading the result of Sparql Query = {sparql_query}")
+        print(e)
+        response.close()
+        if flight is not None:
+            query_flights.finish(flight, None)
+        return None
+    if size > cache.max_entry_bytes:
+        if flight is not None:
+            query_flights.finish(flight, None)
+        return StreamedBody(response, head, chunks)
+    response.close()
+    body = b''.join(head)
+    cache.put(sparql_query, body, size, cache_version)
+    if flight is not None:
+        query_flights.finish(flight, body)
+    return [body]
+
+
+# The body of a streamed response, as an iterable of chunks: those already
+# read, then the rest of the response. Closing it closes the response; the
+# routes close it with their response, whether or not it was read, as for a
+# HEAD request or a client that goes away.
+class StreamedBody:
+    def __init__(self, response, head, chunks):
+        self.response = response
+        self.head = head
+        self.chunks = chunks
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.head
+            yield from self.chunks
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.response.close()
+
+
+# Execute a SPARQL query and return the decoded JSON result, or None if the
+# endpoint could not be reached or returned an error. Used where the result is
+# transformed rather than passed on; cache holds decoded results, and stale
+# results and identical queries are handled as in run_raw_query.
+def run_query(sparql_query, cache=None, stale=True, lane=CHEAP):
+    flight = None
+    if cache is not None:
+        cache_version = cache.version
+        result = cache.get(sparql_query)
+        if result is None and stale:
+            result = cache.get_stale(sparql_query, any_age=not api.sparql_client.breaker.closed)
+            if result is not None:
+                mark_stale()
+                refresher.submit(sparql_query, refresh_query, cache, lane)
+        if result is not None:
+            return result
+        flight, leader = query_flights.join(sparql_query, cache_version)
+        if not leader:
+            with metrics.stage('coalesced_wait'):
+                body = flight.wait()
+            if body is not None:
+                with metrics.stage('decode'):
+                    result = json.loads(body)
+                cache.put(sparql_query, result, len(body), cache_version)
+                return result
+            flight = None
+    body = None
+    try:
+        with admission.admit(lane):
+            response = api.sparql_client.query(sparql_query)
+    except requests.RequestException as e:
         print(f"Error executing Sparql Query = {sparql_query}")
-        print(response.text)
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
-
-
-@app.route('/api/corpus_list', methods=['GET'])
-def getCorpusList():
-    # Generate the SPARQL query
-    sparql_query = get_corpus_list()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    corpusJSON = response.json()
-    corpus_list = [item['corpus']['value'] for item in
-                 corpusJSON['results']['bindings']]
-    #print(corpus_list)
-    # Return the JSON data
-    return jsonify(corpus_list), 200
-
-
-@app.route('/api/keys_list', methods=['GET'])
-def getKeysList():
-    # Generate the SPARQL query
-    sparql_query = get_keys_list()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    keysJSON = response.json()
-    keys_list = [item['key']['value'] for item in
-                 keysJSON['results']['bindings']]
-    #print(keys_list)
-    # Return the JSON data
-    return jsonify(keys_list), 200
-
-
-@app.route('/api/time_sig_list', methods=['GET'])
-def getTimeSignatureList():
-    # Generate the SPARQL query
-    sparql_query = get_time_sig_list()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    timeSigJSON = response.json()
-    time_sig_list = [item['signature']['value'] for item in
-                 timeSigJSON['results']['bindings']]
-    #print(time_sig_list)
-    # Return the JSON data
-    return jsonify(time_sig_list), 200
-
-
-@app.route('/api/tune_type_list', methods=['GET'])
-def getTuneTypeList():
-    # Generate the SPARQL query
-    sparql_query = get_tune_type_list()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    tuneTypeJSON = response.json()
-    tune_type_list = [item['tuneType']['value'] for item in
-                 tuneTypeJSON['results']['bindings']]
-    #print(tune_type_list)
-    # Return the JSON data
-    return jsonify(tune_type_list), 200
-
-
-@app.route('/api/patterns', methods=['GET'])
-def getPatterns():
-    # Get the query parameters from the GET request
-    query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    sparql_query = get_most_common_patterns_for_a_tune(query_params['id'],
-                                                       query_params['excludeTrivialPatterns'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
-
-
-@app.route('/api/common_patterns', methods=['GET'])
-def getCommonPatterns():
-    # Get the query parameters from the GET request
-    query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    sparql_query = get_patterns_in_common_between_two_tunes(query_params['id'],
-                                                            query_params['prev'],
-                                                            query_params['excludeTrivialPatterns'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
-
-
-@app.route('/api/neighbour_patterns', methods=['GET'])
-def getNeighbourPatterns():
-    # Get the query parameters from the GET request
-    query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    #print(query_params)
-    sparql_query = get_neighbour_patterns_by_tune(query_params['id'],
-                                                  query_params['click_num'],
-                                                  query_params['excludeTrivialPatterns'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
-
-
-@app.route('/api/neighbour_tunes', methods=['GET'])
-def getNeighbourTunes():
-    # Get the query parameters from the GET request
-    query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    #print(query_params)
-    sparql_query = get_neighbour_tunes_by_pattern(query_params['id'],
-                                                  query_params['click_num'],)
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
-
-
-@app.route('/api/neighbour_tunes_by_common_patterns', methods=['GET'])
-def getNeighbourTunesByCommonPatterns():
-    # Get the query parameters from the GET request
-    query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    #print(query_params)
-    sparql_query = get_neighbour_tunes_by_common_patterns(query_params['id'],
-                                                  query_params['click_num'],)
+        print(e)
+        return None
+    else:
+        if response.status_code != 200:
+            print(f"Error executing Sparql Query = {sparql_query}")
+            print(response.text)
+            return None
+        with metrics.stage('decode'):
+            result = response.json()
+        body = response.content
+    finally:
+        if flight is not None:
+            query_flights.finish(flight, body)
+    if cache is not None:
+        cache.put(sparql_query, result, len(body), cache_version)
+    return result
+
+
+def refresh_query(sparql_query, cache, lane):
+    run_query(sparql_query, cache, stale=False, lane=lane)
+
+
+# Note that the response to the current request includes a stale result.
+def mark_stale():
+    if has_app_context():
+        g.stale = True
+
+
+# When too many queries are waiting for the endpoint, turn the request away
+# rather than let it time out.
+@app.errorhandler(OverloadedError)
+def overloaded(e):
+    print(e)
+    return jsonify({'error': 'Too many requests, please try again later'}), 503, {'Retry-After': str(RETRY_AFTER)}
+
+
+# Time each request, from when it is received until its response has been
+# sent, and record the status and size of the response.
+@app.before_request
+def start_request_metrics():
+    metrics.set_route(request.url_rule.rule if request.url_rule else 'unmatched')
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    start_time = g.start_time
+    metrics.RESPONSES.labels(route, str(response.status_code)).inc()
+    if response.is_streamed:
+        # The size of a streamed body is only known once it has been sent.
+        response.response = CountedBody(response.response, route)
+    else:
+        metrics.RESPONSE_BYTES.labels(route).observe(response.calculate_content_length() or 0)
+    response.call_on_close(lambda: metrics.REQUEST_SECONDS.labels(route).observe(
+        time.perf_counter() - start_time))
+    return response
+
+
+# A streamed body that records its size once it has been sent. It is closed
+# whether or not it was read, and closes the body it wraps.
+class CountedBody:
+    def __init__(self, chunks, route):
+        self.chunks = chunks
+        self.route = route
+        self.size = 0
+        self._closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        metrics.RESPONSE_BYTES.labels(self.route).observe(self.size)
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+@app.after_request
+def add_stale_warning(response):
+    if g.get('stale'):
+        response.headers['Warning'] = STALE_WARNING
+    return response
+
+
+# A response holding a query result, which is either a decoded result or the
+# raw body from run_raw_query. If the client asked for the compact format the
+# result is converted to it.
+def json_response(result):
+    if wants_columns():
+        columns = get_columns(decode_result(result))
+        with metrics.stage('serialize'):
+            return jsonify(columns)
+    if isinstance(result, dict):
+        with metrics.stage('serialize'):
+            return jsonify(result)
+    response = Response(result, mimetype='application/json')
+    # Flask-Compress replaces the body with its own, which isn't read for a
+    # HEAD request and isn't closed if the client goes away.
+    if isinstance(result, StreamedBody):
+        response.call_on_close(result.close)
+    return response
+
+
+# Whether the request asked for the compact column format.
+def wants_columns():
+    return request.args.get('format') == COLUMNS_FORMAT
+
+
+# The decoded form of a query result.
+def decode_result(result):
+    if isinstance(result, dict):
+        return result
+    body = b''.join(result)
+    with metrics.stage('decode'):
+        return json.loads(body)
+
+
+# The JSON document of a query result, as bytes, in the compact column format
+# if columns is true.
+def read_body(result, columns=False):
+    if columns:
+        result = get_columns(decode_result(result))
+    if isinstance(result, dict):
+        with metrics.stage('serialize'):
+            return json.dumps(result, separators=(',', ':')).encode('utf-8')
+    return b''.join(result)
+
+
+# Run a plan and return the JSON document of its result as bytes, or None if
+# it failed. Reading the whole body here lets the composition queries run in
+# parallel.
+def fetch_body(plan, columns):
+    result = run_plan(plan)
+    if result is None:
+        return None
+    return read_body(result, columns)
+
+
+# Execute a ranked query and return the page of NUM_NODES rows for click_num.
+# The first RANKED_LIST_MAX_ROWS rows are fetched in one go and the pages are
+# sliced from them, so paging through a network doesn't re-run the ranking.
+def run_paged_query(ranked_query, click_num):
+    offset = NUM_NODES*int(click_num)
+    if offset + NUM_NODES > RANKED_LIST_MAX_ROWS:
+        return run_raw_query(paginate(ranked_query, offset, NUM_NODES), lane=EXPENSIVE)
+    result = run_query(paginate(ranked_query, 0, RANKED_LIST_MAX_ROWS),
+                       cache=ranked_list_cache, lane=EXPENSIVE)
+    if result is None:
+        return None
+    return get_page(result, offset, NUM_NODES)
+
+
+# The result of an Answer, Query or PagedQuery plan, or None if its query
+# failed.
+def run_plan(plan):
+    if isinstance(plan, Answer):
+        return plan.result
+    if isinstance(plan, PagedQuery):
+        return run_paged_query(plan.ranked_query, plan.click_num)
+    return run_raw_query(plan.sparql_query, cache=response_cache if plan.cached else None, lane=plan.lane)
+
+
+# The response to the plan returned by a route handler.
+def respond(plan):
+    if isinstance(plan, Document):
+        return jsonify(plan.document), plan.status
+    if isinstance(plan, Bundle):
+        return respond_bundle(plan)
     # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
+    result = run_plan(plan)
+    # Check the query succeeded
+    if result is None:
+        return jsonify(QUERY_FAILED), 500
     # Return the JSON data
-    return jsonify(response.json()), 200
+    return json_response(result), 200
 
 
-@app.route('/api/tune_by_id', methods=['GET'])
-def getTuneData():
-    # Get the query parameters from the GET request
-    query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    #print(query_params)
-    sparql_query = get_tune_data(query_params['id'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+# The queries of a bundle are run in parallel, in the context of this
+# request, so that they can mark the response as stale.
+def respond_bundle(bundle):
+    columns = wants_columns()
+    futures = {name: query_executor.submit(contextvars.copy_context().run, fetch_body, part, columns)
+               for name, part in bundle.parts.items()}
+    bodies = {name: future.result() for name, future in futures.items()}
+    # Check the queries succeeded
+    if any(body is None for body in bodies.values()):
+        return jsonify(QUERY_FAILED), 500
+    # Return the JSON data, built from the parts as they are
+    return Response(b'{' + b','.join(json.dumps(name).encode('utf-8') + b':' + body
+                                     for name, body in bodies.items()) + b'}',
+                    mimetype='application/json'), 200
 
 
-@app.route('/api/tuneFamilyMembers', methods=['GET'])
-def getTuneFamilyMembers():
-    # Get the query parameters from the GET request
-    query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    #print(query_params)
-    sparql_query = get_tune_family_members(query_params['family'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+# The view of a route, answering with the plan of its handler.
+def view(handler):
+    def handle():
+        return respond(handler(request.args))
+    handle.__name__ = handler.__name__
+    return handle
 
 
-@app.route('/api/tunes_by_pattern', methods=['GET'])
-def getTunesContainingPattern():
-    # Get the query parameters from the GET request
-    query_params = request.args.to_dict()
-    # Generate the SPARQL query
-    #print(query_params)
-    sparql_query = get_pattern_search_query(query_params['pattern'])
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+for rule, handler in api.ROUTES:
+    app.add_url_rule(rule, view_func=view(handler), methods=['GET'])
 
 
-@app.route('/api/kg_version', methods=['GET'])
-def getKGVersion():
-    # Generate the SPARQL query
-    sparql_query = get_kg_version()
-    # Execute the SPARQL query
-    response = requests.post(
-        BLAZEGRAPH_URL,
-        data={
-            'query': sparql_query,
-            'format': 'json'
-        }
-    )
-    #print(sparql_query)
-    #print(response.text)
-    # Check the response status
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to execute SPARQL query'}), 500
-    # Return the JSON data
-    return jsonify(response.json()), 200
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    # Return the metrics in the Prometheus text format
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE), 200
 
 
 if __name__ == "__main__":
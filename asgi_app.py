@@ -0,0 +1,338 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+
+from quart import Quart, Response, g, request, jsonify
+from quart.utils import run_sync
+from quart_cors import cors
+import brotli
+import httpx
+from query_factory import paginate, get_page, get_columns, NUM_NODES, RANKED_LIST_MAX_ROWS
+
+import api
+from api import (COLUMNS_FORMAT, QUERY_FAILED, STALE_WARNING, Answer, Bundle, Document,
+                 PagedQuery, ranked_list_cache, response_cache)
+import metrics
+from admission import CHEAP, EXPENSIVE, RETRY_AFTER, AsyncAdmissionControl, OverloadedError
+from async_sparql_client import POOL_SIZE as ASYNC_POOL_SIZE, AsyncSparqlClient
+from local_store import STORE_DIR as LOCAL_STORE_DIR, AsyncLocalSparqlClient
+from refresher import AsyncRefresher
+from sparql_client import BLAZEGRAPH_URL
+
+# The /api routes of api.py served by an asyncio event loop. A request
+# waiting on the SPARQL endpoint doesn't hold a thread, so a single process
+# can keep hundreds of slow queries in flight. Run it with an ASGI server:
+#     hypercorn asgi_app:app
+app = cors(Quart(__name__), expose_headers=['Warning'])
+
+# The Flask-Compress defaults used by the Flask app: responses smaller than
+# COMPRESS_MIN_SIZE bytes are sent uncompressed.
+COMPRESS_MIN_SIZE = 500
+COMPRESS_LEVEL = 6
+COMPRESS_BR_LEVEL = 4
+
+# Queries sent to the endpoint at the same time in each lane, and queries that
+# can wait for a slot. A process here keeps many more queries in flight than a
+# Flask worker, so the lanes are sized from its client's pool, split between
+# them and queued as the Flask app's lanes are by default.
+ASYNC_CHEAP_CONCURRENCY = int(os.environ.get('ASYNC_ADMISSION_CHEAP_CONCURRENCY',
+                                             max(1, ASYNC_POOL_SIZE*4//5)))
+ASYNC_EXPENSIVE_CONCURRENCY = int(os.environ.get('ASYNC_ADMISSION_EXPENSIVE_CONCURRENCY',
+                                                 max(1, ASYNC_POOL_SIZE - ASYNC_CHEAP_CONCURRENCY)))
+ASYNC_CHEAP_QUEUE_SIZE = int(os.environ.get('ASYNC_ADMISSION_CHEAP_QUEUE_SIZE', 4*ASYNC_CHEAP_CONCURRENCY))
+ASYNC_EXPENSIVE_QUEUE_SIZE = int(os.environ.get('ASYNC_ADMISSION_EXPENSIVE_QUEUE_SIZE', 4*ASYNC_EXPENSIVE_CONCURRENCY))
+
+sparql_client = None
+# The calls to the endpoint in progress, by KG version and query, so that a
+# query sent after the version has changed isn't answered by a call made
+# before. Queries are only coalesced within a process here; SINGLE_FLIGHT_DIR
+# applies to the Flask app.
+queries_in_flight = {}
+# Refreshes stale cached results in the background.
+refresher = AsyncRefresher()
+# Bounds the queries sent to the endpoint at the same time.
+admission = AsyncAdmissionControl(ASYNC_CHEAP_CONCURRENCY, ASYNC_EXPENSIVE_CONCURRENCY,
+                                  ASYNC_CHEAP_QUEUE_SIZE, ASYNC_EXPENSIVE_QUEUE_SIZE)
+metrics.stats_collector.add('async_admission', admission.stats, label='lane')
+metrics.stats_collector.add('async_stale_refresh', refresher.stats)
+
+
+# The response cache, title search, pattern index, drop-down lists and KG
+# version monitor are shared with the Flask app. Starting them reads the KG
+# version, so it runs in a worker thread rather than on the event loop.
+@app.before_serving
+async def open_sparql_client():
+    global sparql_client
+    await run_sync(api.start)()
+    # The embedded store is shared with the blocking client of api.py.
+    if LOCAL_STORE_DIR:
+        sparql_client = AsyncLocalSparqlClient(api.sparql_client)
+    else:
+        sparql_client = AsyncSparqlClient(BLAZEGRAPH_URL)
+    metrics.stats_collector.add('async_sparql_client', sparql_client.stats)
+    metrics.stats_collector.add('async_sparql_circuit_breaker', sparql_client.breaker.stats)
+
+
+@app.after_serving
+async def close_sparql_client():
+    await sparql_client.aclose()
+
+
+# When too many queries are waiting for the endpoint, turn the request away
+# rather than let it time out.
+@app.errorhandler(OverloadedError)
+async def overloaded(e):
+    print(e)
+    return jsonify({'error': 'Too many requests, please try again later'}), 503, {'Retry-After': str(RETRY_AFTER)}
+
+
+@app.after_request
+async def add_stale_warning(response):
+    if g.get('stale'):
+        response.headers['Warning'] = STALE_WARNING
+    return response
+
+
+# Compress the JSON responses with brotli or gzip, as the client accepts.
+@app.after_request
+async def compress_response(response):
+    response.vary.add('Accept-Encoding')
+    if response.mimetype != 'application/json' or 'Content-Encoding' in response.headers:
+        return response
+    encoding = request.accept_encodings.best_match(['br', 'gzip'])
+    if encoding is None:
+        return response
+    body = await response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    if encoding == 'br':
+        body = brotli.compress(body, quality=COMPRESS_BR_LEVEL)
+    else:
+        body = gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# Time each request until its response is ready, and record the status and
+# size of the response. This runs before the response is compressed.
+@app.before_request
+async def start_request_metrics():
+    metrics.set_route(request.url_rule.rule if request.url_rule else 'unmatched')
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+async def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.RESPONSES.labels(route, str(response.status_code)).inc()
+    metrics.RESPONSE_BYTES.labels(route).observe(response.content_length or 0)
+    metrics.REQUEST_SECONDS.labels(route).observe(time.perf_counter() - g.start_time)
+    return response
+
+
+# Execute a SPARQL query and return its JSON result as it was sent by the
+# endpoint, as bytes, or None if the endpoint could not be reached or returned
+# an error. The routes pass it on unchanged rather than decoding and
+# re-encoding it. Results are cached until the knowledge graph version changes;
+# pass cache=None to always query the endpoint. Unless stale is false, a stale
+# cached result is returned while it is refreshed in the background, and the
+# last known good result however old while the endpoint is unavailable.
+async def run_raw_query(sparql_query, cache=response_cache, stale=True, lane=CHEAP):
+    if cache is not None:
+        cache_version = cache.version
+        body = cache.get(sparql_query)
+        if body is None and stale:
+            body = cache.get_stale(sparql_query, any_age=not sparql_client.breaker.closed)
+            if body is not None:
+                g.stale = True
+                refresher.submit(sparql_query, refresh_raw_query, cache, lane)
+        if body is not None:
+            return body
+    response = await execute(sparql_query, lane)
+    if response is None:
+        return None
+    if cache is not None:
+        cache.put(sparql_query, response.content, len(response.content), cache_version)
+    return response.content
+
+
+# Execute a SPARQL query and return the decoded JSON result, or None if the
+# endpoint could not be reached or returned an error. Used where the result is
+# transformed rather than passed on; cache holds decoded results, and stale
+# results are handled as in run_raw_query.
+async def run_query(sparql_query, cache=None, stale=True, lane=CHEAP):
+    if cache is not None:
+        cache_version = cache.version
+        result = cache.get(sparql_query)
+        if result is None and stale:
+            result = cache.get_stale(sparql_query, any_age=not sparql_client.breaker.closed)
+            if result is not None:
+                g.stale = True
+                refresher.submit(sparql_query, refresh_query, cache, lane)
+        if result is not None:
+            return result
+    response = await execute(sparql_query, lane)
+    if response is None:
+        return None
+    with metrics.stage('decode'):
+        result = response.json()
+    if cache is not None:
+        cache.put(sparql_query, result, len(response.content), cache_version)
+    return result
+
+
+# Replace the stale cached result of a query with a fresh one.
+async def refresh_raw_query(sparql_query, cache, lane):
+    await run_raw_query(sparql_query, cache, stale=False, lane=lane)
+
+
+async def refresh_query(sparql_query, cache, lane):
+    await run_query(sparql_query, cache, stale=False, lane=lane)
+
+
+# Send a SPARQL query to the endpoint and return the response, or None if it
+# could not be reached or returned an error. Identical queries running at the
+# same time, for the same KG version, share one call to the endpoint, which is
+# admitted through lane.
+async def execute(sparql_query, lane):
+    key = (response_cache.version, sparql_query)
+    call = queries_in_flight.get(key)
+    if call is None:
+        call = queries_in_flight[key] = asyncio.ensure_future(send_query(sparql_query, lane))
+        call.add_done_callback(lambda call: queries_in_flight.pop(key, None))
+    # A request that is cancelled mustn't cancel the call for the others.
+    return await asyncio.shield(call)
+
+
+async def send_query(sparql_query, lane):
+    try:
+        async with admission.admit(lane):
+            response = await sparql_client.query(sparql_query)
+    except httpx.HTTPError as e:
+        print(f"Error executing Sparql Query = {sparql_query}")
+        print(e)
+        return None
+    if response.status_code != 200:
+        print(f"Error executing Sparql Query = {sparql_query}")
+        print(response.text)
+        return None
+    return response
+
+
+# A response holding a query result, which is either a decoded result or the
+# raw body from run_raw_query. If the client asked for the compact format the
+# result is converted to it.
+def json_response(result):
+    if wants_columns():
+        columns = get_columns(decode_result(result))
+        with metrics.stage('serialize'):
+            return jsonify(columns)
+    if isinstance(result, dict):
+        with metrics.stage('serialize'):
+            return jsonify(result)
+    return Response(result, mimetype='application/json')
+
+
+# Whether the request asked for the compact column format.
+def wants_columns():
+    return request.args.get('format') == COLUMNS_FORMAT
+
+
+# The decoded form of a query result.
+def decode_result(result):
+    if isinstance(result, dict):
+        return result
+    with metrics.stage('decode'):
+        return json.loads(result)
+
+
+# The JSON document of a query result, as bytes, in the compact column format
+# if columns is true.
+def read_body(result, columns=False):
+    if columns:
+        result = get_columns(decode_result(result))
+    if isinstance(result, dict):
+        with metrics.stage('serialize'):
+            return json.dumps(result, separators=(',', ':')).encode('utf-8')
+    return result
+
+
+# Execute a ranked query and return the page of NUM_NODES rows for click_num.
+# The first RANKED_LIST_MAX_ROWS rows are fetched in one go and the pages are
+# sliced from them, so paging through a network doesn't re-run the ranking.
+async def run_paged_query(ranked_query, click_num):
+    offset = NUM_NODES*int(click_num)
+    if offset + NUM_NODES > RANKED_LIST_MAX_ROWS:
+        return await run_raw_query(paginate(ranked_query, offset, NUM_NODES), lane=EXPENSIVE)
+    result = await run_query(paginate(ranked_query, 0, RANKED_LIST_MAX_ROWS),
+                             cache=ranked_list_cache, lane=EXPENSIVE)
+    if result is None:
+        return None
+    return get_page(result, offset, NUM_NODES)
+
+
+# The result of an Answer, Query or PagedQuery plan, or None if its query
+# failed.
+async def run_plan(plan):
+    if isinstance(plan, Answer):
+        return plan.result
+    if isinstance(plan, PagedQuery):
+        return await run_paged_query(plan.ranked_query, plan.click_num)
+    return await run_raw_query(plan.sparql_query, cache=response_cache if plan.cached else None,
+                               lane=plan.lane)
+
+
+# The response to the plan returned by a route handler.
+async def respond(plan):
+    if isinstance(plan, Document):
+        return jsonify(plan.document), plan.status
+    if isinstance(plan, Bundle):
+        return await respond_bundle(plan)
+    # Execute the SPARQL query
+    result = await run_plan(plan)
+    # Check the query succeeded
+    if result is None:
+        return jsonify(QUERY_FAILED), 500
+    # Return the JSON data
+    return json_response(result), 200
+
+
+# The queries of a bundle are run concurrently.
+async def respond_bundle(bundle):
+    results = await asyncio.gather(*(run_plan(part) for part in bundle.parts.values()))
+    # Check the queries succeeded
+    if any(part is None for part in results):
+        return jsonify(QUERY_FAILED), 500
+    # Return the JSON data, built from the bodies of the parts
+    columns = wants_columns()
+    body = b'{' + b','.join(json.dumps(name).encode('utf-8') + b':' + read_body(part, columns)
+                            for name, part in zip(bundle.parts, results)) + b'}'
+    return Response(body, mimetype='application/json'), 200
+
+
+# The view of a route, answering with the plan of its handler. The handlers
+# match titles, look up the indexes and may load a drop-down list, which
+# would block the event loop, so they run in a worker thread.
+def view(handler):
+    async def handle():
+        plan = await run_sync(handler)(request.args)
+        return await respond(plan)
+    handle.__name__ = handler.__name__
+    return handle
+
+
+for rule, handler in api.ROUTES:
+    app.add_url_rule(rule, view_func=view(handler), methods=['GET'])
+
+
+@app.route('/metrics', methods=['GET'])
+async def getMetrics():
+    # Return the metrics in the Prometheus text format
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE), 200
+
+
+if __name__ == "__main__":
+    app.run()
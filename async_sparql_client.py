@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+
+import httpx
+
+import metrics
+from circuit_breaker import CircuitBreaker
+from sparql_client import (CONNECT_TIMEOUT, MAX_RETRIES, READ_TIMEOUT,
+                           RETRY_BACKOFF, RETRY_STATUS_CODES, CallStats)
+
+# Connections kept open to the endpoint by the asynchronous server. All the
+# in-flight requests of a process share them, so the pool is much larger than
+# the threaded client's.
+POOL_SIZE = int(os.environ.get('ASYNC_SPARQL_POOL_SIZE', 100))
+
+
+# Raised instead of calling the endpoint while the circuit breaker is open.
+class CircuitOpenError(httpx.TransportError):
+    pass
+
+
+# The non-blocking counterpart of SparqlClient, used by the ASGI server. It
+# keeps the same timeouts, retry policy, circuit breaker and call statistics,
+# and returns an httpx.Response, which has the same
+# status_code/text/content/json() as a requests.Response.
+class AsyncSparqlClient:
+    def __init__(self, endpoint_url, pool_size=POOL_SIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_factor=RETRY_BACKOFF,
+                 breaker=None):
+        self.endpoint_url = endpoint_url
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size,
+                                max_keepalive_connections=pool_size))
+        self._stats = CallStats()
+
+    # Execute a SPARQL query, returning the httpx.Response. Connection errors
+    # that persist after retrying, and read timeouts, are raised as
+    # httpx.HTTPError, and CircuitOpenError (a subclass of it) is raised
+    # without calling the endpoint while the breaker is open.
+    async def query(self, sparql_query):
+        if not self.breaker.allow():
+            metrics.SPARQL_ERRORS.labels('CircuitOpenError').inc()
+            raise CircuitOpenError(f"Not querying the failing SPARQL endpoint: {self.endpoint_url}")
+        start = time.perf_counter()
+        status_code = None
+        try:
+            response = await self._post(sparql_query)
+            status_code = response.status_code
+            return response
+        except httpx.HTTPError as e:
+            metrics.SPARQL_ERRORS.labels(type(e).__name__).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stats.record(elapsed, status_code != 200)
+            metrics.observe_stage('sparql', elapsed)
+            if status_code is not None:
+                metrics.SPARQL_RESPONSES.labels(str(status_code)).inc()
+            if status_code is None or status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+    # The queries are read-only SELECTs, so like SparqlClient we retry
+    # connection errors and gateway errors, backing off exponentially, but
+    # not errors reading the response.
+    async def _post(self, sparql_query):
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.post(
+                    self.endpoint_url,
+                    data={
+                        'query': sparql_query,
+                        'format': 'json'
+                    }
+                )
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if attempt >= self.max_retries:
+                    raise
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self):
+        return self._stats.stats()
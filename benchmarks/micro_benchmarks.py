@@ -0,0 +1,324 @@
+import gc
+import gzip
+import json
+import os
+import random
+import resource
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from fuzzy_search import FuzzySearch, TitleIndex
+from query_factory import advanced_search, get_tune_given_name
+
+# Micro-benchmarks of the hot paths of a search: fuzzy matching of titles
+# against synthetic corpora, suggesting titles as they are typed, and building
+# the SPARQL queries from the matches.
+# Run from the repository root:
+#     python -m benchmarks.micro_benchmarks
+# The results are compared with the stored baselines, and the exit status is 1
+# if any of them regressed. Baselines are only comparable on the machine they
+# were recorded on; record them again there with
+#     python -m benchmarks.micro_benchmarks --save-baseline
+
+# Number of titles in each synthetic corpus, separated by commas.
+CORPUS_SIZES = [int(size) for size in os.environ.get('BENCH_CORPUS_SIZES', '10000,100000,500000').split(',')]
+# Queries timed of each kind, for each corpus.
+QUERIES = int(os.environ.get('BENCH_QUERIES', 30))
+# Times each call is repeated. The fastest is kept, as the slower ones were
+# held up by something else running on the machine.
+REPEATS = int(os.environ.get('BENCH_REPEATS', 3))
+# Times each query builder is timed.
+BUILDER_CALLS = int(os.environ.get('BENCH_BUILDER_CALLS', 2000))
+# Queries of each kind run while tracing the memory they allocate.
+TRACED_QUERIES = 5
+# Seed of the corpora and the queries, so that runs are repeatable.
+SEED = int(os.environ.get('BENCH_SEED', 0))
+# A benchmark has regressed when its median or 95th percentile latency, or
+# the memory it uses, is more than this many times its baseline.
+TOLERANCE = float(os.environ.get('BENCH_TOLERANCE', 1.5))
+# Differences smaller than these are within the noise of a run, and are not
+# counted as regressions.
+NOISE = {'ms': 0.05, 'seconds': 0.05, 'bytes': 64 * 1024}
+BASELINES_PATH = os.environ.get('BENCH_BASELINES',
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json'))
+
+# Words tune titles are made of, most common first, and a few hundred
+# made-up ones so that the corpora have as many distinct titles as the real
+# one.
+WORDS = ["the", "of", "reel", "jig", "polka", "hornpipe", "lady", "mary", "kerry", "maggie", "johnny",
+         "morning", "star", "sally", "gardens", "mountain", "road", "castle", "boys", "girl", "hill", "house",
+         "first", "may", "college", "groves", "gilderoy", "foxhunters", "banshee", "silver", "spear", "humours",
+         "bantry", "drowsy", "tarbolton", "rolling", "wave", "blue", "green", "kelly", "o'neill's", "cooley's",
+         "mcdermott's", "fiddler", "piper", "wedding", "fair", "harvest", "home", "bridge", "river", "glen",
+         "lough", "ballinasloe", "connemara", "donegal", "sligo", "clare", "galway", "limerick", "lass", "lad",
+         "old", "new", "little", "big", "merry", "wild", "rover", "sailor", "ship", "sea", "shore", "moon",
+         "dance", "waltz", "set", "slide", "march", "air", "lament", "pinksterlied", "lied", "het", "de",
+         "ruiter", "van", "meisje", "boer", "molen", "ó", "dónal", "bhríde", "sí", "cailín", "rua", "ann",
+         "cúil", "éire"]
+SYLLABLES = ["ba", "bal", "ca", "car", "da", "dun", "gal", "kil", "ly", "ma", "mo", "na", "nan", "ra",
+             "ross", "shan", "ti", "tra", "va", "wick", "ford", "more", "beg", "lin", "mac"]
+
+# The kinds of title searches: titles as they are, titles with typos, a
+# couple of words of a title, a single common word, queries matching nothing
+# at the first cutoff, which retry with a halved cutoff, and popular titles
+# searched for again, which are answered from the match cache.
+QUERY_KINDS = ['exact', 'typo', 'partial', 'common_word', 'retry', 'cached']
+
+
+def synthetic_words(rng):
+    made_up = {''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))) for _ in range(600)}
+    return WORDS + sorted(made_up)
+
+
+# A dict from tune ids to titles, shaped like those of the knowledge graph:
+# mostly two to four words, with the common words far more frequent, some
+# upper-case collections, numbered variants and repeated titles.
+def synthetic_corpus(size, rng):
+    words = synthetic_words(rng)
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    names = {}
+    titles = []
+    for i in range(size):
+        if titles and rng.random() < 0.03:
+            title = rng.choice(titles)
+        else:
+            title = ' '.join(rng.choices(words, weights, k=rng.randint(1, 5)))
+            if rng.random() < 0.1:
+                title += f" No. {rng.randint(1, 12)}"
+            title = title.upper() if rng.random() < 0.2 else title.title()
+            titles.append(title)
+        names[str(i)] = title
+    return names
+
+
+def add_typos(title, rng):
+    chars = list(title)
+    for _ in range(rng.randint(1, 2)):
+        position = rng.randrange(len(chars))
+        edit = rng.choice(['delete', 'replace', 'insert'])
+        if edit == 'delete' and len(chars) > 1:
+            del chars[position]
+        elif edit == 'replace':
+            chars[position] = rng.choice(string.ascii_lowercase)
+        else:
+            chars.insert(position, rng.choice(string.ascii_lowercase))
+    return ''.join(chars)
+
+
+# QUERIES queries of each kind for a corpus. The retry queries are checked to
+# match nothing at the default cutoff, among a limited number of attempts.
+def synthetic_queries(fuzzy_search, names, rng):
+    titles = list(names.values())
+    queries = {kind: [] for kind in QUERY_KINDS}
+    for _ in range(QUERIES):
+        title = rng.choice(titles)
+        queries['exact'].append(title.lower() if rng.random() < 0.5 else title)
+        queries['typo'].append(add_typos(title, rng))
+        words = title.split()
+        start = rng.randrange(len(words))
+        queries['partial'].append(' '.join(words[start:start + rng.randint(1, 2)]))
+        queries['common_word'].append(rng.choice(WORDS[:20]))
+    popular = [rng.choice(titles) for _ in range(10)]
+    queries['cached'] = [rng.choice(popular) for _ in range(QUERIES)]
+    queries['suggest'] = [rng.choice(titles) for _ in range(QUERIES)]
+    for _ in range(100 * QUERIES):
+        if len(queries['retry']) == QUERIES:
+            break
+        query = ''.join(rng.choice('qxzjvkw') for _ in range(rng.randint(5, 9)))
+        if not fuzzy_search.get_title_best_match(query, retry_till_match=False):
+            queries['retry'].append(query)
+    return queries
+
+
+def percentiles(times):
+    times = np.array(times) * 1000
+    return {
+        'calls': len(times),
+        'mean_ms': float(times.mean()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'p99_ms': float(np.percentile(times, 99)),
+    }
+
+
+def time_calls(function, calls):
+    times = []
+    for args in calls:
+        fastest = None
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            function(*args)
+            elapsed = time.perf_counter() - start
+            fastest = elapsed if fastest is None else min(fastest, elapsed)
+        times.append(fastest)
+    return times
+
+
+# The most memory allocated at once while calling function on each of calls.
+def peak_memory(function, calls):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for args in calls:
+            function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def fuzzy_search_benchmarks(fuzzy_search, size, rng):
+    results = {}
+    names = synthetic_corpus(size, rng)
+    # The memory the index keeps, and the most it allocates while it is built
+    gc.collect()
+    tracemalloc.start()
+    index = TitleIndex(names)
+    index_bytes, build_peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    distinct_titles = len(index._processed)
+    del index
+    # Building the index, as when the titles are refreshed
+    start = time.perf_counter()
+    fuzzy_search._set_names(names, None)
+    results[f'fuzzy_search/{size}/build'] = {
+        'seconds': time.perf_counter() - start,
+        'distinct_titles': distinct_titles,
+        'index_bytes': index_bytes,
+        'peak_bytes': build_peak_bytes,
+    }
+
+    queries = synthetic_queries(fuzzy_search, names, rng)
+    for kind in QUERY_KINDS:
+        calls = [(query,) for query in queries[kind]]
+        if kind == 'cached':
+            for query in queries[kind]:
+                fuzzy_search.get_title_best_match(query)
+            function = fuzzy_search.get_title_best_match
+        else:
+            # Every search is a new one, as the match cache is cleared.
+            def function(query):
+                fuzzy_search._match_cache.clear()
+                return fuzzy_search.get_title_best_match(query)
+        result = percentiles(time_calls(function, calls))
+        result['peak_bytes'] = peak_memory(function, calls[:TRACED_QUERIES])
+        results[f'fuzzy_search/{size}/{kind}'] = result
+
+    # A title suggestion for each key pressed while typing titles. Every one
+    # is worked out afresh, as the remembered suggestions are cleared.
+    calls = [(title[:length],) for title in queries['suggest'] for length in range(1, len(title) + 1)]
+    def function(text):
+        fuzzy_search._suggestions._remembered.clear()
+        return fuzzy_search.suggest_titles(text)
+    result = percentiles(time_calls(function, calls))
+    result['peak_bytes'] = peak_memory(function, calls[:TRACED_QUERIES])
+    results[f'title_suggest/{size}/keystrokes'] = result
+    return results
+
+
+# The query builders, with up to 50 matched titles, as a title search returns.
+def query_builder_benchmarks(rng):
+    results = {}
+    names = synthetic_corpus(1000, rng)
+    matches = [(title, rng.randint(60, 100), tune_id) for tune_id, title in names.items()]
+    cases = {
+        'get_tune_given_name/1': (get_tune_given_name, (matches[:1],)),
+        'get_tune_given_name/10': (get_tune_given_name, (matches[:10],)),
+        'get_tune_given_name/50': (get_tune_given_name, (matches[:50],)),
+        'advanced_search/facets': (advanced_search, ({'title': [''], 'pattern': [''], 'corpus': ['Session'],
+                                                      'key': ['Gmajor', 'Dmajor'], 'timeSignature': ['4/4'],
+                                                      'tuneType': ['reel', 'jig']}, [])),
+        'advanced_search/title_50': (advanced_search, ({'title': ['maggie'], 'pattern': [''],
+                                                        'key': ['Gmajor']}, matches[:50])),
+        'advanced_search/title_pattern_facets_50': (advanced_search, ({'title': ['maggie'], 'pattern': ['1 2 3 4 5'],
+                                                                       'corpus': ['Session', 'Meertens'],
+                                                                       'key': ['Gmajor'], 'timeSignature': ['6/8'],
+                                                                       'tuneType': ['jig']}, matches[:50])),
+    }
+    for name, (function, args) in cases.items():
+        calls = [args] * BUILDER_CALLS
+        result = percentiles(time_calls(function, calls))
+        result['peak_bytes'] = peak_memory(function, calls[:TRACED_QUERIES])
+        results[f'query_factory/{name}'] = result
+    return results
+
+
+def run():
+    rng = random.Random(SEED)
+    # FuzzySearch is a singleton, so one instance is given each corpus in
+    # turn. It is started from an empty snapshot, without a SPARQL endpoint.
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_path = os.path.join(directory, 'names.json.gz')
+        with gzip.open(snapshot_path, 'wt', encoding='utf-8') as snapshot_file:
+            json.dump({'version': None, 'names': []}, snapshot_file)
+        fuzzy_search = FuzzySearch(None, snapshot_path=snapshot_path)
+    results = {}
+    for size in CORPUS_SIZES:
+        print(f"Benchmarking fuzzy search over {size} titles")
+        results.update(fuzzy_search_benchmarks(fuzzy_search, size, rng))
+    print("Benchmarking the query builders")
+    results.update(query_builder_benchmarks(rng))
+    results['process'] = {'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    return results
+
+
+# The names of the measurements of a result that are compared with its
+# baseline.
+def compared_measurements(result):
+    return [name for name in ('p50_ms', 'p95_ms', 'seconds', 'index_bytes', 'peak_bytes') if name in result]
+
+
+def regressed(measurement, value, baseline):
+    noise = NOISE[measurement.rsplit('_', 1)[-1]]
+    return value > TOLERANCE * baseline and value - baseline > noise
+
+
+def report(results, baselines):
+    regressions = []
+    print(f"{'benchmark':<52}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KiB':>12}  baseline")
+    for name, result in results.items():
+        if 'p50_ms' in result:
+            row = f"{name:<52}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+        elif 'seconds' in result:
+            row = f"{name:<52}{result['seconds'] * 1000:>10.0f}{'':>20}"
+        else:
+            row = f"{name:<52}{'':>30}"
+        row += f"{result.get('peak_bytes', result.get('max_rss_bytes', 0)) / 1024:>12.0f}"
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(row + "  none")
+            continue
+        slower = [f"{measurement} {result[measurement] / baseline[measurement]:.2f}x"
+                  for measurement in compared_measurements(result)
+                  if baseline.get(measurement) and regressed(measurement, result[measurement], baseline[measurement])]
+        print(row + ("  REGRESSED " + ', '.join(slower) if slower else "  ok"))
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    results = run()
+    if '--save-baseline' in sys.argv:
+        with open(BASELINES_PATH, 'w') as baselines_file:
+            json.dump(results, baselines_file, indent=2, sort_keys=True)
+        report(results, {})
+        print(f"Saved the baselines to {BASELINES_PATH}")
+        return
+    try:
+        with open(BASELINES_PATH) as baselines_file:
+            baselines = json.load(baselines_file)
+    except FileNotFoundError:
+        baselines = {}
+    regressions = report(results, baselines)
+    if regressions:
+        print(f"{len(regressions)} benchmarks regressed by more than {TOLERANCE}x their baselines")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+
+# Consecutive failed calls to the SPARQL endpoint after which the breaker
+# opens and further calls fail immediately.
+FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_FAILURES', 5))
+# Seconds the breaker stays open before a call is let through to find out
+# whether the endpoint has recovered.
+RESET_TIMEOUT = float(os.environ.get('CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+# Stops calling the SPARQL endpoint when it keeps failing, so that requests
+# fail fast instead of each waiting out the timeouts and retries, and the
+# worker threads aren't all tied up waiting on a struggling endpoint.
+#
+# The breaker opens after failure_threshold consecutive failures. Once it has
+# been open for reset_timeout seconds it is half-open: one call is let through
+# as a probe, and the breaker closes if it succeeds and opens again if not.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    # Whether a call can be made now. A caller that is allowed must report
+    # the outcome with record_success() or record_failure().
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                print("SPARQL endpoint has recovered, closing the circuit breaker")
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and
+                                           self.failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    print(f"SPARQL endpoint failed {self.failures} times, opening the circuit breaker")
+                self.state = OPEN
+                self._opened = time.monotonic()
+
+    # Whether calls are currently being made normally.
+    @property
+    def closed(self):
+        return self.state == CLOSED
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'open': int(self.state != CLOSED),
+                'failures': self.failures,
+                'rejected': self.rejected,
+            }
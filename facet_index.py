@@ -0,0 +1,103 @@
+import numpy as np
+
+# The advanced search filters, and the variable of the search results holding
+# the value filtered on. The corpus isn't returned, only filtered on.
+FACET_VARS = {
+    'corpus': None,
+    'tuneType': 'tuneType',
+    'key': 'key',
+    'timeSignature': 'signature',
+}
+
+
+# One bitset per value of each advanced search filter, over the tunes that
+# can be found by the advanced search: those with an annotation. A bitset
+# is a packed array of one bit per tune, so a combination of filters is
+# resolved with a few vectorized ORs (of the values chosen for a filter) and
+# ANDs (across filters) over arrays of a few kilobytes.
+class FacetIndex:
+    # tune_rows maps the id of every tune to its rows of the tune metadata
+    # export, and corpus_rows are the (tune id, corpus) pairs of the tunes
+    # with an annotation, with a corpus of None for those in no corpus.
+    def __init__(self, tune_rows, corpus_rows):
+        self.tune_ids = list(tune_rows)
+        self.positions = {tune_id: position for position, tune_id in enumerate(self.tune_ids)}
+        size = len(self.tune_ids)
+        annotated = np.zeros(size, dtype=bool)
+        masks = {facet: {} for facet in FACET_VARS}
+        for tune_id, corpus in corpus_rows:
+            position = self.positions.get(tune_id)
+            if position is None:
+                continue
+            annotated[position] = True
+            if corpus is not None:
+                masks['corpus'].setdefault(corpus, np.zeros(size, dtype=bool))[position] = True
+        for tune_id, rows in tune_rows.items():
+            position = self.positions[tune_id]
+            for facet, variable in FACET_VARS.items():
+                if variable is None:
+                    continue
+                for row in rows:
+                    if variable in row:
+                        masks[facet].setdefault(row[variable]['value'], np.zeros(size, dtype=bool))[position] = True
+        self.size = size
+        self.annotated = np.packbits(annotated)
+        self.bitsets = {facet: {value: np.packbits(mask) for value, mask in values.items()}
+                        for facet, values in masks.items()}
+        self._empty = np.zeros_like(self.annotated)
+
+    def __len__(self):
+        return self.size
+
+    # The index as arrays, for saving with np.savez: the bitsets as the rows
+    # of a matrix, with the filter and value of each row.
+    def to_arrays(self):
+        keys = [(facet, value) for facet, values in self.bitsets.items() for value in values]
+        bitsets = np.array([self.bitsets[facet][value] for facet, value in keys], dtype=np.uint8)
+        return {'facets': np.array([facet for facet, _ in keys], dtype=str),
+                'values': np.array([value for _, value in keys], dtype=str),
+                'annotated': self.annotated,
+                'bitsets': bitsets.reshape(len(keys), len(self.annotated))}
+
+    # The index saved by to_arrays, over the same tune ids, without going
+    # through the tune rows again.
+    @classmethod
+    def from_arrays(cls, tune_ids, arrays):
+        index = cls.__new__(cls)
+        index.tune_ids = tune_ids
+        index.positions = {tune_id: position for position, tune_id in enumerate(tune_ids)}
+        index.size = len(tune_ids)
+        index.annotated = arrays['annotated']
+        index.bitsets = {facet: {} for facet in FACET_VARS}
+        for facet, value, bitset in zip(arrays['facets'].tolist(), arrays['values'].tolist(), arrays['bitsets']):
+            index.bitsets[facet][value] = bitset
+        index._empty = np.zeros_like(index.annotated)
+        return index
+
+    # The bitset of the tunes with an annotation that match every filter in
+    # query_params, which maps a filter to the values chosen for it.
+    def candidates(self, query_params):
+        bits = self.annotated.copy()
+        for facet in FACET_VARS:
+            values = query_params.get(facet)
+            if not values:
+                continue
+            chosen = self._empty.copy()
+            for value in values:
+                bitset = self.bitsets[facet].get(value)
+                if bitset is not None:
+                    np.bitwise_or(chosen, bitset, out=chosen)
+            np.bitwise_and(bits, chosen, out=bits)
+        return bits
+
+    # The bitset of the given tunes.
+    def bitset(self, tune_ids):
+        mask = np.zeros(self.size, dtype=bool)
+        positions = [self.positions[tune_id] for tune_id in tune_ids if tune_id in self.positions]
+        mask[positions] = True
+        return np.packbits(mask)
+
+    # The ids of the tunes in a bitset.
+    def tunes(self, bits):
+        return [self.tune_ids[position]
+                for position in np.flatnonzero(np.unpackbits(bits, count=self.size))]
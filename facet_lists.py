@@ -0,0 +1,46 @@
+import requests
+
+from query_factory import (get_corpus_list, get_keys_list, get_time_sig_list,
+                           get_tune_type_list)
+
+# The advanced search drop-down lists: the query generating each list and the
+# variable holding its values.
+FACET_QUERIES = {
+    'corpus': (get_corpus_list, 'corpus'),
+    'key': (get_keys_list, 'key'),
+    'signature': (get_time_sig_list, 'signature'),
+    'tuneType': (get_tune_type_list, 'tuneType'),
+}
+
+
+# The values of the advanced search drop-downs. They are small and only change
+# with the knowledge graph, so they are loaded once and kept in memory.
+class FacetLists:
+    def __init__(self, sparql_client):
+        self.sparql_client = sparql_client
+        self._lists = {}
+        self.load()
+
+    # (Re)load every list. A list that fails to load keeps its previous values.
+    def load(self):
+        for name in FACET_QUERIES:
+            self._load_list(name)
+
+    def _load_list(self, name):
+        query_builder, variable = FACET_QUERIES[name]
+        try:
+            values = [item[variable]['value'] for item in
+                      self.sparql_client.iter_bindings(query_builder())]
+        except (ConnectionError, requests.RequestException) as e:
+            print(f"Unable to load the {name} list: {e}")
+            return
+        self._lists[name] = values
+
+    # Return the values of a list, or None if it has never been loaded and
+    # still can't be.
+    def get(self, name):
+        values = self._lists.get(name)
+        if values is None:
+            self._load_list(name)
+            values = self._lists.get(name)
+        return values
@@ -1,41 +1,442 @@
+import gzip
+import heapq
+import json
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, defaultdict
+
+import numpy as np
+import requests
 from singleton_decorator import singleton
 from query_factory import get_all_tune_names
-import requests
-from fuzzywuzzy import process as fuzzy_process
+from fuzzywuzzy import fuzz, utils as fuzzy_utils
+from rapidfuzz import fuzz as rapidfuzz_fuzz, process as rapidfuzz_process
+
+# Characters left in a title by fuzzywuzzy's full_process(force_ascii=True),
+# apart from spaces and the few letters above U+00FF it doesn't strip, which
+# are counted together in one extra column.
+INDEX_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+CHAR_COLUMNS = {char: column for column, char in enumerate(INDEX_CHARS)}
+OTHER_COLUMN = len(INDEX_CHARS)
+# Longest string rapidfuzz's partial_ratio searches exhaustively.
+RAPIDFUZZ_EXHAUSTIVE_LENGTH = 64
+# Number of titles first given a rapidfuzz bound at a time. The batch size
+# doubles with each batch, up to the maximum.
+RAPIDFUZZ_BATCH_SIZE = 64
+RAPIDFUZZ_MAX_BATCH_SIZE = 4096
+# Local snapshot of the tune titles, used at startup instead of querying the
+# SPARQL endpoint.
+SNAPSHOT_PATH = os.environ.get('TUNE_NAMES_SNAPSHOT', 'tune_names_snapshot.json.gz')
+# Number of recent get_title_best_match results remembered.
+MATCH_CACHE_SIZE = int(os.environ.get('FUZZY_MATCH_CACHE_SIZE', 2048))
+# Number of title suggestions returned by default, and the most that can be
+# asked for.
+TITLE_SUGGEST_LIMIT = int(os.environ.get('TITLE_SUGGEST_LIMIT', 10))
+MAX_TITLE_SUGGEST_LIMIT = 50
+# Suggestions for terms matching more words than this (the first letters
+# typed) are worked out once and remembered.
+REMEMBER_RANGE = 4096
+
+
+# A fuzzy search index over a table of tune titles.
+class TitleIndex:
+    # Build the candidate-pruning index over names, a dict from tune ids to
+    # titles. Titles are normalized once with fuzzywuzzy's full_process, and
+    # titles normalizing to the same string are scored once and fanned out to
+    # all their ids. Every fuzzywuzzy WRatio component compares strings made
+    # of the characters of the query and the title, so the characters they
+    # have in common bound the score. Per distinct title we store its
+    # character counts, its space count, its length and its shortest
+    # token-joined length, plus postings from each token to the titles
+    # containing it.
+    def __init__(self, names):
+        self._ids = list(names.keys())
+        self._titles = list(names.values())
+        # Distinct normalized titles, in order of first appearance, and the
+        # positions in names of the titles normalizing to each.
+        self._processed = []
+        self._members = []
+        distinct = {}
+        for position, title in enumerate(self._titles):
+            processed = fuzzy_utils.full_process(title, force_ascii=True)
+            i = distinct.get(processed)
+            if i is None:
+                i = distinct[processed] = len(self._processed)
+                self._processed.append(processed)
+                self._members.append([])
+            self._members[i].append(position)
+        self._char_counts = np.zeros((len(self._processed), len(INDEX_CHARS) + 1), dtype=np.uint16)
+        self._space_counts = np.zeros(len(self._processed), dtype=np.uint16)
+        self._lengths = np.array([len(processed) for processed in self._processed], dtype=np.float64)
+        self._min_lengths = np.zeros(len(self._processed), dtype=np.float64)
+        token_postings = defaultdict(list)
+        for i, processed in enumerate(self._processed):
+            for char, count in Counter(processed).items():
+                if char == ' ':
+                    self._space_counts[i] = count
+                else:
+                    self._char_counts[i, CHAR_COLUMNS.get(char, OTHER_COLUMN)] += count
+            tokens = set(processed.split())
+            self._min_lengths[i] = len(' '.join(tokens))
+            for token in tokens:
+                token_postings[token].append(i)
+        self._token_postings = {token: np.array(postings) for token, postings in token_postings.items()}
+
+    def __len__(self):
+        return len(self._ids)
+
+    # An upper bound on the WRatio score of the processed query against every
+    # title, following WRatio's own cases. With common the number of
+    # characters (spaces included) the query and title have in common, and
+    # shortest the length of the shortest string either could be reduced to:
+    #  - a ratio of two strings is at most 2*common/(sum of their lengths),
+    #  - a partial ratio is at most 2*common/(shortest + common),
+    #  - a token set ratio is the best ratio of the shared tokens to the
+    #    tokens of either string, at most 2*shared/(shared + the shorter
+    #    length) with shared the length of the shared tokens joined, or of
+    #    the tokens of both, which the ratio bound covers,
+    #  - a partial token set ratio is 100 when a whole token is shared.
+    # Partial ratios only count when the lengths differ by a factor of 1.5,
+    # and are scaled like WRatio scales them. Each component is rounded before
+    # scaling, which adds at most 0.5, so the score is at most the largest
+    # bound plus one, rounded down.
+    def score_bounds(self, query):
+        query_counts = np.zeros(len(INDEX_CHARS) + 1, dtype=np.uint16)
+        query_spaces = 0
+        for char, count in Counter(query).items():
+            if char == ' ':
+                query_spaces = count
+            else:
+                query_counts[CHAR_COLUMNS.get(char, OTHER_COLUMN)] += count
+        columns = np.flatnonzero(query_counts)
+        common = np.minimum(self._char_counts[:, columns], query_counts[columns]).sum(axis=1, dtype=np.float64)
+        common += np.minimum(self._space_counts, query_spaces)
+        tokens = set(query.split())
+        # The number and total length of the tokens shared with each title
+        shared_tokens = np.zeros(len(self._processed), dtype=np.float64)
+        shared_length = np.zeros(len(self._processed), dtype=np.float64)
+        for token in tokens:
+            postings = self._token_postings.get(token)
+            if postings is not None:
+                shared_tokens[postings] += 1
+                shared_length[postings] += len(token)
+        shared_token = shared_tokens > 0
+        shared_length += np.maximum(shared_tokens - 1, 0)
+        query_min_length = len(' '.join(tokens))
+        shortest = np.minimum(self._min_lengths, query_min_length)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(common > 0, 200 * common / (self._min_lengths + query_min_length), 0)
+            partial_ratio = np.where(common > 0, 200 * common / (shortest + common), 0)
+            length_ratio = np.maximum(self._lengths, len(query)) / np.minimum(self._lengths, len(query))
+            token_set_ratio = np.where(shared_token, 200 * shared_length / (shared_length + shortest), 0)
+        partial_token_set_ratio = np.where(shared_token, 100, 0)
+        partial_scale = np.where(length_ratio > 8, .6, .9)
+        bounds = np.where(length_ratio < 1.5,
+                          np.maximum(ratio, .95 * token_set_ratio),
+                          np.maximum(ratio, partial_scale * np.maximum(partial_ratio, .95 * partial_token_set_ratio)))
+        bounds = np.minimum(np.floor(bounds + 1 + 1e-6), 100)
+        bounds[(self._lengths == 0) | (len(query) == 0)] = 0
+        return bounds
+
+    # Tighter bounds for a batch of titles from rapidfuzz's WRatio. It has the
+    # same structure as fuzzywuzzy's, but its partial ratios search every
+    # alignment instead of only those next to matching blocks, and it doesn't
+    # round its components. fuzzywuzzy rounds each component and reports
+    # partial ratios above 99.5 as 100, adding at most 0.5 to a component, so
+    # its score is at most rapidfuzz's plus one, rounded down. Past
+    # RAPIDFUZZ_EXHAUSTIVE_LENGTH characters rapidfuzz stops searching every
+    # alignment, so the character bound is kept.
+    def rapidfuzz_bounds(self, query, batch, character_bounds):
+        choices = [self._processed[i] for i in batch]
+        scores = rapidfuzz_process.cdist([query], choices, scorer=rapidfuzz_fuzz.WRatio, dtype=np.float64)[0]
+        bounds = np.minimum(np.floor(scores + 1 + 1e-6), character_bounds)
+        if len(query) > RAPIDFUZZ_EXHAUSTIVE_LENGTH:
+            long_choices = self._lengths[batch] > RAPIDFUZZ_EXHAUSTIVE_LENGTH
+            bounds[long_choices] = character_bounds[long_choices]
+        return bounds.tolist()
+
+    # The positions of the matches with a score of at least score_cutoff, in
+    # the same order as fuzzywuzzy's extractBests, with their scores. Distinct
+    # titles are taken in batches in decreasing order of their character bound
+    # and given a rapidfuzz bound, and are scored in decreasing order of that
+    # bound once no title still to come can have a higher one. A scored title
+    # is expanded to each of its positions in names, which extractBests
+    # would have scored separately. Scoring stops when no remaining title
+    # could enter the top limit. Bounds and scores are memoized in cache so
+    # retries with a lower cutoff don't recompute them.
+    def best_matches(self, query, bounds, score_cutoff, limit, cache):
+        candidates = np.flatnonzero(bounds >= score_cutoff)
+        candidates = candidates[np.lexsort((candidates, -bounds[candidates]))]
+        next_candidate = 0
+        batch_size = RAPIDFUZZ_BATCH_SIZE
+        # Max-heap of (-bound, index) of titles with a rapidfuzz bound.
+        bounded = []
+        # Min-heap of (score, -position), so the worst of the best is at the top.
+        best = []
+        while True:
+            if next_candidate < len(candidates):
+                i = int(candidates[next_candidate])
+                frontier = (int(bounds[i]), -i)
+            else:
+                frontier = None
+            if bounded and (frontier is None or (-bounded[0][0], -bounded[0][1]) >= frontier):
+                neg_bound, i = heapq.heappop(bounded)
+                if -neg_bound < score_cutoff:
+                    break
+                members = self._members[i]
+                if limit is not None and len(best) == limit and (-neg_bound, -members[0]) < best[0]:
+                    break
+                score = cache['scores'].get(i)
+                if score is None:
+                    score = fuzz.WRatio(query, self._processed[i], full_process=False)
+                    cache['scores'][i] = score
+                if score < score_cutoff:
+                    continue
+                for position in members:
+                    if limit is None or len(best) < limit:
+                        heapq.heappush(best, (score, -position))
+                    elif (score, -position) > best[0]:
+                        heapq.heapreplace(best, (score, -position))
+                    else:
+                        break
+            elif frontier is not None:
+                batch = candidates[next_candidate:next_candidate + batch_size]
+                next_candidate += len(batch)
+                batch_size = min(2 * batch_size, RAPIDFUZZ_MAX_BATCH_SIZE)
+                unbounded = [i for i in batch.tolist() if i not in cache['bounds']]
+                if unbounded:
+                    new_bounds = self.rapidfuzz_bounds(query, unbounded, bounds[unbounded])
+                    cache['bounds'].update(zip(unbounded, new_bounds))
+                for i in batch.tolist():
+                    heapq.heappush(bounded, (-int(cache['bounds'][i]), i))
+            else:
+                break
+        return sorted((-score, -neg_position) for score, neg_position in best)
+
+    # The (title, score, id) tuples extractBests would return, retrying with a
+    # halved cutoff until there is a match.
+    def find_best_matches(self, query, score_cutoff, limit, retry_till_match, max_retries):
+        bounds = self.score_bounds(query)
+        cache = {'bounds': {}, 'scores': {}}
+        best_matches = self.best_matches(query, bounds, score_cutoff, limit, cache)
+        if not best_matches and retry_till_match:
+            retry_count = 0
+            while not best_matches and retry_count < max_retries:
+                retry_count += 1
+                score_cutoff /= 2
+                best_matches = self.best_matches(query, bounds, score_cutoff, limit, cache)
+        return [(self._titles[position], -neg_score, self._ids[position])
+                for neg_score, position in best_matches]
+
+
+# As-you-type title suggestions: the titles with a word starting with the
+# typed text, normalized like the fuzzy search normalizes titles. The start of
+# every word of the distinct normalized titles of a TitleIndex is kept in the
+# order of the text from there on, so the words starting with a term are a
+# range of them found by binary search. The titles starting with the term
+# come first, then shorter titles before longer ones, then in string order.
+class TitleSuggestIndex:
+    def __init__(self, title_index):
+        self._title_index = title_index
+        processed = title_index._processed
+        # The normalized titles, each ended by a space and a separator, so
+        # that a term ending with a space matches a whole last word
+        self._text = ''.join(title + ' \0' for title in processed)
+        # The start of every word in the text, the title it is in, its offset
+        # in the title and the text from there to the end of the title
+        word_starts, word_titles, word_offsets, words = [], [], [], []
+        start = 0
+        for i, title in enumerate(processed):
+            offset = 0
+            for word in title.split(' '):
+                if word:
+                    word_starts.append(start + offset)
+                    word_titles.append(i)
+                    word_offsets.append(offset)
+                    words.append(title[offset:] + ' ')
+                offset += len(word) + 1
+            start += len(title) + 2
+        order = sorted(range(len(words)), key=words.__getitem__)
+        del words
+        self._word_starts = np.array(word_starts, dtype=np.int64)[order]
+        self._word_titles = np.array(word_titles, dtype=np.int32)[order]
+        # The rank of each word's title in the order suggestions are given
+        title_order = sorted(range(len(processed)), key=lambda i: (len(processed[i]), processed[i]))
+        title_rank = np.empty(len(processed), dtype=np.int64)
+        title_rank[title_order] = np.arange(len(processed))
+        self._word_ranks = (title_rank[self._word_titles]
+                            + len(processed) * (np.array(word_offsets, dtype=np.int64)[order] > 0))
+        self._remembered = {}
+
+    # The (title, id) pairs of the first limit titles with a word starting
+    # with query, a normalized search term.
+    def suggest(self, query, limit):
+        if not query.strip():
+            return []
+        remembered = self._remembered.get(query)
+        if remembered is not None:
+            return remembered[:limit]
+        length = len(query)
+        key = lambda start: self._text[start:start + length]
+        start = bisect_left(self._word_starts, query, key=key)
+        end = bisect_right(self._word_starts, query, lo=start, key=key)
+        if end - start > REMEMBER_RANGE:
+            self._remembered[query] = self._suggestions(start, end, MAX_TITLE_SUGGEST_LIMIT)
+            return self._remembered[query][:limit]
+        return self._suggestions(start, end, limit)
+
+    # The suggestions from the words between start and end, best first.
+    def _suggestions(self, start, end, limit):
+        ranks = self._word_ranks[start:end]
+        if len(ranks) > limit:
+            # Each title gives at least one suggestion, so the limit best words
+            # are enough unless some of them are in the same title.
+            best = np.argpartition(ranks, limit)[:limit]
+            suggestions = self._titles_of(start, best[np.argsort(ranks[best], kind='stable')], limit)
+            if len(suggestions) == limit:
+                return suggestions
+        return self._titles_of(start, np.argsort(ranks, kind='stable'), limit)
+
+    # The (title, id) pairs of the titles of the given words, in order.
+    def _titles_of(self, start, words, limit):
+        suggestions = []
+        seen = set()
+        for k in words.tolist():
+            i = int(self._word_titles[start + k])
+            if i in seen:
+                continue
+            seen.add(i)
+            for position in self._title_index._members[i]:
+                suggestions.append((self._title_index._titles[position], self._title_index._ids[position]))
+                if len(suggestions) == limit:
+                    return suggestions
+        return suggestions
 
 
 @singleton
 class FuzzySearch:
-    def __init__(self, blazegraph_url):
+    def __init__(self, sparql_client, version=None, snapshot_path=SNAPSHOT_PATH):
+        self.sparql_client = sparql_client
+        self.snapshot_path = snapshot_path
+        self._match_cache = OrderedDict()
+        self._match_cache_lock = threading.Lock()
+        self.match_cache_hits = 0
+        self.match_cache_misses = 0
+        # Start from the local snapshot when there is one, so that startup
+        # doesn't wait on (or fail with) the SPARQL endpoint. If it is from an
+        # older release it is refreshed in the background.
+        snapshot = self._read_snapshot()
+        if snapshot is not None:
+            self._set_names(*snapshot)
+            if version is not None and version != self.version:
+                threading.Thread(target=self.refresh, args=(version,), daemon=True).start()
+        else:
+            self._set_names(self._fetch_names(), version)
+            self._write_snapshot()
+
+    # Get all the tune titles from the SPARQL endpoint. The result is parsed
+    # as it is read rather than loaded as a whole.
+    def _fetch_names(self):
         # Generate the SPARQL query
         sparql_query = get_all_tune_names()
         # Execute the SPARQL query
-        response = requests.post(
-            blazegraph_url,
-            data={
-                'query': sparql_query,
-                'format': 'json'
-            }
-        )
-        # Check the response status
-        if response.status_code != 200:
-            raise ConnectionError(f"Unable to get all composition names from SPARQL endpoint: {blazegraph_url}.\n"
-                                  f"Server response code: {response.status_code}\n"
-                                  f"Server response: {response.text}")
+        return {item['id']['value']: item['title']['value']
+                for item in self.sparql_client.iter_bindings(sparql_query)}
+
+    def _set_names(self, names, version):
+        index = TitleIndex(names)
+        suggestions = TitleSuggestIndex(index)
+        with self._match_cache_lock:
+            self.names = names
+            self.version = version
+            self._index = index
+            self._suggestions = suggestions
+            # Matches found against the previous names are no longer valid.
+            self._match_cache.clear()
+
+    # Reload the titles from the endpoint for a new knowledge graph version.
+    # If the endpoint can't be reached the current titles are kept.
+    def refresh(self, version):
+        if version == self.version:
+            return
+        try:
+            names = self._fetch_names()
+        except (ConnectionError, requests.RequestException) as e:
+            print(f"Unable to refresh the composition names, keeping version {self.version}: {e}")
+            return
+        self._set_names(names, version)
+        self._write_snapshot()
+
+    # The snapshot is a gzipped JSON document holding the knowledge graph
+    # version and the (id, title) pairs, or None if there isn't a readable one.
+    # A snapshot that is missing either, or holds anything but strings, is
+    # treated as if there were none.
+    def _read_snapshot(self):
+        try:
+            with gzip.open(self.snapshot_path, 'rt', encoding='utf-8') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            names = dict(snapshot['names'])
+            version = snapshot['version']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not all(isinstance(tune_id, str) and isinstance(title, str) for tune_id, title in names.items()):
+            return None
+        return names, version
 
-        namesJSON = response.json()
-        self.names = {item['id']['value']: item['title']['value'] for item in namesJSON['results']['bindings']}
+    def _write_snapshot(self):
+        # Write to a temporary file and rename it, so that other workers never
+        # read a partly written snapshot.
+        temp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        try:
+            with gzip.open(temp_path, 'wt', encoding='utf-8') as snapshot_file:
+                json.dump({'version': self.version, 'names': list(self.names.items())},
+                          snapshot_file, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temp_path, self.snapshot_path)
+        except OSError as e:
+            print(f"Unable to write the composition names snapshot {self.snapshot_path}: {e}")
 
+    # Returns the same (title, score, id) tuples as fuzzywuzzy's extractBests
+    # over self.names, retrying with a halved cutoff until there is a match.
+    # Popular titles are searched for over and over, so recent results are
+    # remembered, keyed on the normalized title and the search parameters.
     def get_title_best_match(self, title, score_cutoff=60, limit=50, retry_till_match=True, max_retries=3):
-        best_matches = fuzzy_process.extractBests(title, self.names,
-                                                  score_cutoff=score_cutoff,
-                                                  limit=limit)
-        if not best_matches and retry_till_match:
-            retry_count = 0
-            while not best_matches and retry_count < max_retries:
-                retry_count += 1
-                score_cutoff /= 2
-                best_matches = fuzzy_process.extractBests(title, self.names,
-                                                          score_cutoff=score_cutoff,
-                                                          limit=limit)
-        return best_matches
+        index = self._index
+        if not index:
+            return []
+        # extractBests processes the query twice, the second time forcing it
+        # to ASCII.
+        query = fuzzy_utils.full_process(fuzzy_utils.full_process(title), force_ascii=True)
+        key = (query, score_cutoff, limit, retry_till_match, max_retries)
+        with self._match_cache_lock:
+            best_matches = self._match_cache.get(key)
+            if best_matches is not None:
+                self._match_cache.move_to_end(key)
+                self.match_cache_hits += 1
+                return list(best_matches)
+            self.match_cache_misses += 1
+        best_matches = index.find_best_matches(query, score_cutoff, limit, retry_till_match, max_retries)
+        with self._match_cache_lock:
+            # Don't remember matches against names replaced in the meantime.
+            if self._index is index:
+                self._match_cache[key] = best_matches
+                if len(self._match_cache) > MATCH_CACHE_SIZE:
+                    self._match_cache.popitem(last=False)
+        return list(best_matches)
+
+    def match_cache_stats(self):
+        with self._match_cache_lock:
+            return {
+                'entries': len(self._match_cache),
+                'hits': self.match_cache_hits,
+                'misses': self.match_cache_misses,
+            }
+
+    # The (title, id) pairs of up to limit titles with a word starting with
+    # the text typed so far, for suggesting titles as it is typed.
+    def suggest_titles(self, text, limit=TITLE_SUGGEST_LIMIT):
+        query = fuzzy_utils.full_process(fuzzy_utils.full_process(text), force_ascii=True)
+        # Processing strips a trailing space, which ends the last word typed.
+        if query and text[-1:].isspace():
+            query += ' '
+        return self._suggestions.suggest(query, limit)
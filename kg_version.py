@@ -0,0 +1,66 @@
+import os
+import threading
+
+import requests
+
+from query_factory import get_kg_version
+
+# Seconds between checks of the knowledge graph release version.
+CHECK_INTERVAL = float(os.environ.get('KG_VERSION_CHECK_INTERVAL', 300))
+
+
+# Watches the release version of the knowledge graph from a background thread
+# and notifies listeners when it changes, so that anything derived from the
+# previous release can be dropped or rebuilt.
+class KGVersionMonitor:
+    def __init__(self, sparql_client, interval=CHECK_INTERVAL):
+        self.sparql_client = sparql_client
+        self.interval = interval
+        self.version = None
+        self._listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Register a callback(version) run whenever a new version is seen,
+    # including the first one.
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    # Fetch the current version, returning None if the endpoint can't be
+    # reached. There may be several release values, so they are combined.
+    def fetch(self):
+        try:
+            response = self.sparql_client.query(get_kg_version())
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        versions = sorted(item['version']['value'] for item in
+                          response.json()['results']['bindings'])
+        return '|'.join(versions)
+
+    def check(self):
+        version = self.fetch()
+        if version is None or version == self.version:
+            return
+        previous = self.version
+        self.version = version
+        print(f"Knowledge graph version changed from {previous} to {version}")
+        for callback in self._listeners:
+            try:
+                callback(version)
+            except Exception as e:
+                print(f"Error handling knowledge graph version change: {e}")
+
+    # Check the version once now, then keep checking in the background.
+    def start(self):
+        self.check()
+        self._thread = threading.Thread(target=self._run, name='kg-version-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
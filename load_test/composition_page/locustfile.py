@@ -1,33 +1,97 @@
 # Composition page load test
-# For each user make 4-5 queries about pairwise similarity between tunes + get all patterns from tunes
+# Each user opens the page of a tune, expands its networks of patterns and
+# tunes, and follows the patterns and tunes in them to other pages. Run it
+# against a server querying load_test/mock_sparql_server.py:
+#     locust -f load_test/composition_page/locustfile.py --host http://localhost:5000
+
+import os
+import random
 
 from locust import HttpUser, task, between
 
+# Titles searched for to find the tunes whose pages are opened, separated by
+# commas.
+TITLES = os.environ.get('LOAD_TEST_TITLES', "Maggie,Johnny,DE RUITER,Foxhunters,First Of May,"
+                                            "College Groves,Gilderoy,PINKSTERLIED I").split(',')
+# Set to 1 to load each page with /api/composition instead of one request per
+# part of the page.
+COMPOSITION_ROUTE = os.environ.get('LOAD_TEST_COMPOSITION_ROUTE', '0') == '1'
+# Times each network is expanded on a page.
+MAX_CLICKS = 2
+# Seed of the users' choices, so that runs are repeatable.
+SEED = int(os.environ.get('LOAD_TEST_SEED', 0))
+
+seeds = random.Random(SEED)
 
 
-def get_most_common_patterns_for_a_tune(tune):
-    sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
-                        PREFIX mm: <http://w3id.org/polifonia/ontology/music-meta/>
-                        SELECT ?tune_name ?pattern (count(?pattern) as ?patternFreq)
-                        {
-                            ?tune_file mm:title ?tune_name.
-                            FILTER (?tune_name = \"""" + tune + """\").
-                            ?xx jams:isJAMSAnnotationOf ?tune_file.
-                            ?xx jams:includesObservation ?observation .
-                            ?observation jams:ofPattern ?pattern .
-                        } group by ?tune_name ?pattern
-                        order by DESC (?patternFreq )"""
-    return sparql_query
+# The values of a variable in the bindings of a JSON SPARQL result.
+def values(response, variable):
+    try:
+        bindings = response.json()['results']['bindings']
+    except (ValueError, KeyError, TypeError):
+        return []
+    return [binding[variable]['value'] for binding in bindings if variable in binding]
 
 
-class ApiUser(HttpUser):
+class CompositionPageUser(HttpUser):
     wait_time = between(1, 2)  # Wait between 1 to 2 seconds between tasks
 
+    def on_start(self):
+        self.random = random.Random(seeds.random())
+        # Find the tunes to start from, as a user would on the search page
+        self.tune_ids = []
+        for title in TITLES:
+            response = self.client.get("/api/search", params={'searchType': 'title', 'searchTerm': title},
+                                       name="/api/search?searchType=title")
+            self.tune_ids.extend(values(response, 'id'))
+        self.previous_id = None
+
     @task
-    def make_api_calls(self):
-        # Simulating 5 simultaneous API calls
-        self.client.get("/api1")
-        self.client.get("/api2")
-        self.client.get("/api3")
-        self.client.get("/api4")
-        self.client.get("/api5")
+    def browse(self):
+        if not self.tune_ids:
+            return
+        tune_id = self.random.choice(self.tune_ids)
+        patterns, neighbour_ids = self.open_page(tune_id)
+        # Expand the networks
+        for click_num in range(1, self.random.randint(0, MAX_CLICKS) + 1):
+            self.client.get("/api/neighbour_patterns", name="/api/neighbour_patterns",
+                            params={'id': tune_id, 'click_num': click_num, 'excludeTrivialPatterns': 'true'})
+            neighbour_ids.extend(values(
+                self.client.get("/api/neighbour_tunes_by_common_patterns",
+                                name="/api/neighbour_tunes_by_common_patterns",
+                                params={'id': tune_id, 'click_num': click_num}), 'id'))
+        # Compare the tune with the one visited before it
+        if self.previous_id is not None and self.previous_id != tune_id:
+            self.client.get("/api/common_patterns", name="/api/common_patterns",
+                            params={'id': tune_id, 'prev': self.previous_id, 'excludeTrivialPatterns': 'true'})
+        self.previous_id = tune_id
+        # Follow a pattern to the tunes containing it
+        if patterns:
+            pattern = self.random.choice(patterns)
+            self.client.get("/api/tunes_by_pattern", params={'pattern': pattern}, name="/api/tunes_by_pattern")
+            self.client.get("/api/neighbour_tunes", params={'id': pattern, 'click_num': 0},
+                            name="/api/neighbour_tunes")
+        # Visit one of the neighbouring tunes next time
+        if neighbour_ids and len(self.tune_ids) < 1000:
+            self.tune_ids.append(self.random.choice(neighbour_ids))
+
+    # Load the parts of the page of a tune. Returns its patterns and the ids
+    # of the tunes in its network.
+    def open_page(self, tune_id):
+        if COMPOSITION_ROUTE:
+            response = self.client.get("/api/composition", params={'id': tune_id}, name="/api/composition")
+            try:
+                parts = response.json()
+                return ([binding['pattern']['value'] for binding in parts['patterns']['results']['bindings']],
+                        [binding['id']['value'] for binding in parts['neighbour_tunes']['results']['bindings']])
+            except (ValueError, KeyError, TypeError):
+                return [], []
+        self.client.get("/api/tune_by_id", params={'id': tune_id}, name="/api/tune_by_id")
+        patterns = values(self.client.get("/api/patterns", name="/api/patterns",
+                                          params={'id': tune_id, 'excludeTrivialPatterns': 'true'}), 'pattern')
+        self.client.get("/api/neighbour_patterns", name="/api/neighbour_patterns",
+                        params={'id': tune_id, 'click_num': 0, 'excludeTrivialPatterns': 'true'})
+        neighbour_ids = values(self.client.get("/api/neighbour_tunes_by_common_patterns",
+                                               name="/api/neighbour_tunes_by_common_patterns",
+                                               params={'id': tune_id, 'click_num': 0}), 'id')
+        return patterns, neighbour_ids
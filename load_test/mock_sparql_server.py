@@ -0,0 +1,174 @@
+import gzip
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+# A stand-in for the SPARQL endpoint that replays recorded responses, so that
+# the load tests can be run offline and give the same results every time.
+#
+# Record the responses to the queries the server makes by running this with
+# --record while the server and the load tests run against it:
+#     python load_test/mock_sparql_server.py --record
+#     BLAZEGRAPH_URL=http://localhost:8890/sparql python app.py
+# and replay them afterwards by running it without --record.
+
+# Port the stand-in listens on.
+PORT = int(os.environ.get('MOCK_SPARQL_PORT', 8890))
+# Directory holding one gzipped recording per query.
+RECORDINGS_DIR = os.environ.get('MOCK_SPARQL_RECORDINGS',
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings'))
+# The endpoint the responses are recorded from.
+RECORD_URL = os.environ.get('MOCK_SPARQL_RECORD_URL', 'https://polifonia.disi.unibo.it/fonn/sparql')
+# Seconds added to every response, and the most a response is randomly made
+# faster or slower than that.
+LATENCY = float(os.environ.get('MOCK_SPARQL_LATENCY', 0.05))
+JITTER = float(os.environ.get('MOCK_SPARQL_JITTER', 0.02))
+# If set, each response also takes this fraction of the time the endpoint
+# took to answer it when it was recorded.
+RECORDED_LATENCY_SCALE = float(os.environ.get('MOCK_SPARQL_RECORDED_LATENCY_SCALE', 0))
+# Seed of the jitter, so that runs are repeatable.
+SEED = int(os.environ.get('MOCK_SPARQL_SEED', 0))
+# Status of the response to a query that was never recorded.
+MISSING_STATUS = 404
+
+# The recording of a query is named after a digest of it, ignoring the
+# indentation and line breaks, which don't change what it asks for.
+def recording_path(sparql_query):
+    normalised = ' '.join(sparql_query.split())
+    return os.path.join(RECORDINGS_DIR, hashlib.sha1(normalised.encode('utf-8')).hexdigest() + '.json.gz')
+
+
+def read_recording(sparql_query):
+    try:
+        with gzip.open(recording_path(sparql_query), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_recording(sparql_query, status, content_type, elapsed, body):
+    os.makedirs(RECORDINGS_DIR, exist_ok=True)
+    path = recording_path(sparql_query)
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump({'query': sparql_query, 'status': status, 'content_type': content_type,
+                   'elapsed': elapsed, 'body': body}, f)
+    os.replace(path + '.tmp', path)
+
+
+class MockSparqlServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, record=False):
+        super().__init__(address, MockSparqlHandler)
+        self.record = record
+        self.session = requests.Session()
+        self.random = random.Random(SEED)
+        self.replayed = 0
+        self.recorded = 0
+        self.missing = 0
+        self._lock = threading.Lock()
+
+    def delay(self, recording):
+        with self._lock:
+            jitter = self.random.uniform(-JITTER, JITTER)
+        delay = LATENCY + jitter
+        if recording is not None:
+            delay += RECORDED_LATENCY_SCALE * recording['elapsed']
+        return max(0.0, delay)
+
+    def counts(self):
+        with self._lock:
+            return {'replayed': self.replayed, 'recorded': self.recorded, 'missing': self.missing}
+
+    def count(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+
+class MockSparqlHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # The counts so far, to check a run replayed every query it made
+        if urlparse(self.path).path == '/stats':
+            self.send_body(200, 'application/json', json.dumps(self.server.counts()))
+            return
+        self.answer(parse_qs(urlparse(self.path).query).get('query', [''])[0])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        self.answer(parse_qs(body).get('query', [''])[0])
+
+    def answer(self, sparql_query):
+        if not sparql_query:
+            self.send_body(400, 'text/plain', 'No query given')
+            return
+        if self.server.record:
+            recording = self.record(sparql_query)
+        else:
+            recording = read_recording(sparql_query)
+            if recording is None:
+                self.server.count('missing')
+                print(f"No recording of Sparql Query = {' '.join(sparql_query.split())[:200]}")
+            else:
+                self.server.count('replayed')
+            time.sleep(self.server.delay(recording))
+        if recording is None:
+            # Fail loudly, so that a missing recording shows up as failed
+            # requests in the load test rather than as fast empty results.
+            self.send_body(MISSING_STATUS, 'text/plain', 'No recording of the query')
+        else:
+            self.send_body(recording['status'], recording['content_type'], recording['body'])
+
+    # Forward the query to the real endpoint and keep what it returned. Errors
+    # are passed on but not recorded, so that the query is asked again.
+    def record(self, sparql_query):
+        start = time.perf_counter()
+        response = self.server.session.post(RECORD_URL, data={'query': sparql_query, 'format': 'json'},
+                                            timeout=120)
+        recording = {'status': response.status_code,
+                     'content_type': response.headers.get('Content-Type', 'application/json'),
+                     'elapsed': time.perf_counter() - start, 'body': response.text}
+        if response.status_code == 200:
+            write_recording(sparql_query, **recording)
+            self.server.count('recorded')
+        return recording
+
+    def send_body(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    record = '--record' in sys.argv
+    server = MockSparqlServer(('', PORT), record=record)
+    mode = f"recording from {RECORD_URL}" if record else "replaying"
+    print(f"Mock SPARQL endpoint on http://localhost:{PORT}/sparql {mode} {RECORDINGS_DIR}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Replayed {server.replayed}, recorded {server.recorded}, "
+              f"{server.missing} queries not recorded")
+        if server.missing:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
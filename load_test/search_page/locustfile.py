@@ -1,37 +1,84 @@
+# Search page load test
+# Each user loads the search page's drop-down lists, then searches by title,
+# by pattern and with the advanced search filters. Run it against a server
+# querying load_test/mock_sparql_server.py:
+#     locust -f load_test/search_page/locustfile.py --host http://localhost:5000
+
+import os
 import random
+
 from locust import HttpUser, task, between
 
-BLAZEGRAPH_URL = 'https://polifonia.disi.unibo.it/fonn/sparql'
+# Titles searched for, separated by commas.
+TITLES = os.environ.get('LOAD_TEST_TITLES', "Maggie,Johnny,DE RUITER,Foxhunters,First Of May,"
+                                            "College Groves,Gilderoy,PINKSTERLIED I").split(',')
+# Seed of the users' choices, so that runs are repeatable.
+SEED = int(os.environ.get('LOAD_TEST_SEED', 0))
+
+seeds = random.Random(SEED)
+
+
+# The values of a variable in the bindings of a JSON SPARQL result.
+def values(response, variable):
+    try:
+        bindings = response.json()['results']['bindings']
+    except (ValueError, KeyError, TypeError):
+        return []
+    return [binding[variable]['value'] for binding in bindings if variable in binding]
 
-def get_tune_given_name2(name):
-    sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
-                        PREFIX mm: <http://w3id.org/polifonia/ontology/music-meta/>
-                        SELECT DISTINCT ?tune_name ?tuneType ?key ?signature
-                        {
-                            ?tune mm:title ?tune_name.
-                            ?tune jams:tuneType ?tuneType.
-                            ?tune jams:key ?key.
-                            ?tune jams:timeSignature ?signature .
-                            FILTER (CONTAINS( ?tune_name, \"""" + name + """\" )).
-                        } LIMIT 10
-                     """
-    return sparql_query
 
+# The values of a drop-down list, which the list routes return as a JSON array.
+def options(response):
+    try:
+        values = response.json()
+    except ValueError:
+        return []
+    return values if isinstance(values, list) else []
 
-class ApiUser(HttpUser):
+
+class SearchPageUser(HttpUser):
     wait_time = between(1, 2)  # Wait between 1 to 2 seconds between tasks
-    names = ["Maggie", "Johnny", "DE RUITER", "Foxhunters", "First Of May", "College Groves", "Gilderoy", "PINKSTERLIED I"]
-
-    @task
-    def make_api_calls(self):
-        idxs = list(range(len(self.names)))
-        random.shuffle(idxs)
-
-        query = get_tune_given_name2(self.names[idxs[0]])
-        response = self.client.post(
-            BLAZEGRAPH_URL,
-            data={
-                'query': query,
-                'format': 'json'
-            }
-        )
+
+    def on_start(self):
+        self.random = random.Random(seeds.random())
+        # The drop-down lists are loaded when the page is opened
+        self.facets = {
+            'corpus': options(self.client.get("/api/corpus_list")),
+            'key': options(self.client.get("/api/keys_list")),
+            'timeSignature': options(self.client.get("/api/time_sig_list")),
+            'tuneType': options(self.client.get("/api/tune_type_list")),
+        }
+        self.patterns = []
+
+    @task(3)
+    def title_search(self):
+        title = self.random.choice(TITLES)
+        response = self.client.get("/api/search", params={'searchType': 'title', 'searchTerm': title},
+                                   name="/api/search?searchType=title")
+        # Remember some patterns of a tune found, to search for them later
+        tune_ids = values(response, 'id')
+        if tune_ids and len(self.patterns) < 50:
+            response = self.client.get("/api/patterns", name="/api/patterns",
+                                       params={'id': self.random.choice(tune_ids), 'excludeTrivialPatterns': 'true'})
+            self.patterns.extend(values(response, 'pattern')[:5])
+
+    @task(1)
+    def pattern_search(self):
+        if not self.patterns:
+            return
+        self.client.get("/api/search", params={'searchType': 'pattern',
+                                               'searchTerm': self.random.choice(self.patterns)},
+                        name="/api/search?searchType=pattern")
+
+    @task(2)
+    def advanced_search(self):
+        params = {'searchType': 'advanced', 'title': '', 'pattern': ''}
+        if self.random.random() < 0.5:
+            params['title'] = self.random.choice(TITLES)
+        if self.patterns and self.random.random() < 0.2:
+            params['pattern'] = self.random.choice(self.patterns)
+        # Filter on one or two of the drop-down lists
+        facets = [facet for facet, options in self.facets.items() if options]
+        for facet in self.random.sample(facets, min(len(facets), self.random.randint(1, 2))):
+            params[facet] = self.random.choice(self.facets[facet])
+        self.client.get("/api/search", params=params, name="/api/search?searchType=advanced")
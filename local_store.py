@@ -0,0 +1,256 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+try:
+    import pyoxigraph
+except ImportError:
+    pyoxigraph = None
+
+import metrics
+from circuit_breaker import CircuitBreaker
+from query_factory import get_kg_version
+from sparql_client import BLAZEGRAPH_URL, CallStats, SparqlClient
+
+# Directory of the embedded stores built by the loader, one per knowledge
+# graph release, and a 'current' link to the latest. If it is set, the
+# queries are run on the current store instead of the SPARQL endpoint.
+STORE_DIR = os.environ.get('LOCAL_STORE_DIR')
+# Query the union of the named graphs as the default graph, as Blazegraph
+# does in quads mode. Set to 0 to query the default graph of the dump only.
+UNION_DEFAULT_GRAPH = os.environ.get('LOCAL_STORE_UNION_DEFAULT_GRAPH', '1') == '1'
+CURRENT_LINK = 'current'
+# Written in each store, with the dump files it was loaded from.
+SOURCE_FILE = 'source.json'
+# Prefixes Blazegraph declares itself, which some of the queries rely on.
+DEFAULT_PREFIXES = {
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+}
+JSON_CONTENT_TYPE = 'application/sparql-results+json'
+
+
+# The client the server and the jobs query through: the embedded store when
+# LOCAL_STORE_DIR is set, and the SPARQL endpoint otherwise.
+def make_sparql_client(endpoint_url=BLAZEGRAPH_URL):
+    if STORE_DIR:
+        return LocalSparqlClient(os.path.join(STORE_DIR, CURRENT_LINK))
+    return SparqlClient(endpoint_url)
+
+
+# The result of a query on the embedded store, with the parts of a
+# requests.Response (and httpx.Response) the callers use.
+class LocalResponse:
+    def __init__(self, status_code, content, content_type=JSON_CONTENT_TYPE):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {'Content-Type': content_type}
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Runs the query_factory queries on an embedded Oxigraph store built by the
+# loader below, in place of SparqlClient. The results are serialized as
+# SPARQL JSON, the same shape the endpoint returns. The store is opened
+# read-only, so every worker process can open it.
+class LocalSparqlClient:
+    def __init__(self, store_path, breaker=None):
+        if pyoxigraph is None:
+            raise ImportError("The local store needs pyoxigraph: pip install -r requirements-local-store.txt")
+        self.endpoint_url = os.path.realpath(store_path)
+        self.store = pyoxigraph.Store.read_only(self.endpoint_url)
+        # Kept for the callers that check it. Only a failing store opens it.
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._stats = CallStats()
+
+    # Execute a SPARQL query, returning a LocalResponse. A query the store
+    # can't parse gets a 400 response, and one it fails to evaluate a 500,
+    # like the endpoint's. The whole result is always read, so stream is ignored.
+    def query(self, sparql_query, stream=False):
+        start = time.perf_counter()
+        try:
+            solutions = self.store.query(sparql_query, prefixes=DEFAULT_PREFIXES,
+                                         use_default_graph_as_union=UNION_DEFAULT_GRAPH)
+            response = LocalResponse(200, solutions.serialize(
+                format=pyoxigraph.QueryResultsFormat.JSON))
+        except SyntaxError as e:
+            response = LocalResponse(400, str(e).encode('utf-8'), 'text/plain')
+        except Exception as e:
+            # The store failing, or the evaluation of the query
+            response = LocalResponse(500, str(e).encode('utf-8'), 'text/plain')
+        elapsed = time.perf_counter() - start
+        self._stats.record(elapsed, response.status_code != 200)
+        metrics.observe_stage('sparql', elapsed)
+        metrics.SPARQL_RESPONSES.labels(str(response.status_code)).inc()
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    # Execute a SPARQL query and iterate over the bindings of its result.
+    # Raises ConnectionError if the store returns an error.
+    def iter_bindings(self, sparql_query):
+        response = self.query(sparql_query)
+        if response.status_code != 200:
+            raise ConnectionError(f"Unable to execute the query on the local store: {self.endpoint_url}.\n"
+                                  f"{response.text}")
+        return iter(response.json()['results']['bindings'])
+
+    def stats(self):
+        return self._stats.stats()
+
+
+# A LocalSparqlClient for the asynchronous server. The queries run in
+# threads, so that they don't hold up its event loop.
+class AsyncLocalSparqlClient:
+    def __init__(self, client):
+        self.client = client
+        self.breaker = self.client.breaker
+        self.endpoint_url = self.client.endpoint_url
+
+    async def query(self, sparql_query):
+        return await asyncio.to_thread(self.client.query, sparql_query)
+
+    async def aclose(self):
+        pass
+
+    def stats(self):
+        return self.client.stats()
+
+
+# Identifies the dump files a store is loaded from by their names, sizes and
+# modification times, so that the same release isn't loaded twice.
+def dump_fingerprint(paths):
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        status = os.stat(path)
+        digest.update(f"{os.path.basename(path)}\n{status.st_size}\n{int(status.st_mtime)}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_source(store_path):
+    try:
+        with open(os.path.join(store_path, SOURCE_FILE)) as source_file:
+            return json.load(source_file)
+    except (OSError, ValueError):
+        return None
+
+
+# Load a dump file into the store. The format is found from the extension,
+# under a .gz one if the file is gzipped.
+def load_dump(store, path):
+    name = path[:-3] if path.endswith('.gz') else path
+    rdf_format = pyoxigraph.RdfFormat.from_extension(name.rsplit('.', 1)[-1])
+    if rdf_format is None:
+        raise ValueError(f"Unknown RDF format of the dump file {path}")
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as dump_file:
+            store.bulk_load(dump_file, rdf_format)
+    else:
+        store.bulk_load(path=path, format=rdf_format)
+
+
+# Build a store from the dump files of a knowledge graph release, in a
+# directory named after the release and the dump files, and point the current
+# link to it. The servers open the current store when they start, so they
+# must be restarted to use a new one. Until then they keep using the store
+# the link pointed to before, so that one is kept and any older ones removed.
+def build(paths, force=False):
+    fingerprint = dump_fingerprint(paths)
+    current = os.path.join(STORE_DIR, CURRENT_LINK)
+    source = read_source(current)
+    if source is not None and source['fingerprint'] == fingerprint and not force:
+        print(f"The local store is up to date for version {source['version']}")
+        return
+    os.makedirs(STORE_DIR, exist_ok=True)
+    building = os.path.join(STORE_DIR, f"building.{os.getpid()}")
+    start = time.perf_counter()
+    store = pyoxigraph.Store(building)
+    for path in paths:
+        print(f"Loading {path}")
+        load_dump(store, path)
+    store.optimize()
+    # Find the release from the store itself, as the server does
+    bindings = json.loads(store.query(get_kg_version(), prefixes=DEFAULT_PREFIXES,
+                                      use_default_graph_as_union=UNION_DEFAULT_GRAPH)
+                          .serialize(format=pyoxigraph.QueryResultsFormat.JSON))['results']['bindings']
+    versions = sorted(item['version']['value'] for item in bindings if 'version' in item)
+    version = versions[-1] if versions else 'unknown'
+    store.flush()
+    del store
+    with open(os.path.join(building, SOURCE_FILE), 'w') as source_file:
+        json.dump({'version': version, 'fingerprint': fingerprint,
+                   'dumps': [os.path.abspath(path) for path in paths]}, source_file)
+    name = ''.join(c if c.isalnum() or c in '.-_' else '_' for c in version)
+    store_path = os.path.join(STORE_DIR, f"{name}-{fingerprint[:12]}")
+    # When it is rebuilt with --force, the new store gets a new name rather
+    # than replacing the one the link points to.
+    rebuild = 1
+    while os.path.exists(store_path):
+        rebuild += 1
+        store_path = os.path.join(STORE_DIR, f"{name}-{fingerprint[:12]}-{rebuild}")
+    os.rename(building, store_path)
+    previous = os.path.realpath(current) if os.path.islink(current) else None
+    # Replace the link atomically, so that a server starting now opens either
+    # store whole.
+    link = f"{current}.{os.getpid()}"
+    os.symlink(os.path.basename(store_path), link)
+    os.replace(link, current)
+    remove_old_stores(keep=[store_path, previous])
+    print(f"Local store for version {version} built in {time.perf_counter() - start:.0f}s: {store_path}")
+
+
+# Remove the stores other than those in keep. Those still being built, by
+# another loader, are left alone.
+def remove_old_stores(keep):
+    keep = {os.path.realpath(path) for path in keep if path is not None}
+    for entry in os.listdir(STORE_DIR):
+        path = os.path.join(STORE_DIR, entry)
+        if (os.path.islink(path) or not os.path.isdir(path) or entry.startswith('building.')
+                or os.path.realpath(path) in keep):
+            continue
+        print(f"Removing the old local store {path}")
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# Build the local store from the dump files of a release:
+#     LOCAL_STORE_DIR=/srv/kg python local_store.py patterns.nt.gz tunes.ttl.gz
+def main():
+    paths = [arg for arg in sys.argv[1:] if arg != '--force']
+    if not STORE_DIR or not paths:
+        print("Usage: LOCAL_STORE_DIR=<directory> python local_store.py [--force] <dump files>")
+        sys.exit(2)
+    if pyoxigraph is None:
+        print("The local store needs pyoxigraph: pip install -r requirements-local-store.txt")
+        sys.exit(1)
+    build(paths, force='--force' in sys.argv)
+
+
+if __name__ == "__main__":
+    main()
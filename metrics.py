@@ -0,0 +1,122 @@
+import contextvars
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Histogram, generate_latest)
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+# When the app runs in several worker processes, set PROMETHEUS_MULTIPROC_DIR
+# to an empty directory shared by them so that the counters and histograms
+# are summed across the workers (see the prometheus_client documentation).
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+REQUEST_SECONDS = Histogram(
+    'api_request_duration_seconds',
+    'Time taken to handle an API request and send its response.',
+    ['route'], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram(
+    'api_stage_duration_seconds',
+    'Time spent in each stage of handling API requests.',
+    ['route', 'stage'], buckets=LATENCY_BUCKETS)
+RESPONSES = Counter(
+    'api_responses_total',
+    'API responses sent, by status code.',
+    ['route', 'status'])
+RESPONSE_BYTES = Histogram(
+    'api_response_size_bytes',
+    'Size of the API response bodies, before compression.',
+    ['route'], buckets=SIZE_BUCKETS)
+SPARQL_RESPONSES = Counter(
+    'sparql_responses_total',
+    'Responses from the SPARQL endpoint, by status code.',
+    ['status'])
+SPARQL_ERRORS = Counter(
+    'sparql_errors_total',
+    'Calls to the SPARQL endpoint that got no response, by error.',
+    ['error'])
+
+# The route a stage is timed for. Work done outside a request, such as
+# building the pattern index, is recorded under 'background'.
+_route = contextvars.ContextVar('route', default='background')
+
+
+# Set the route of the request being handled by the current context.
+def set_route(route):
+    _route.set(route)
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.labels(_route.get(), stage).observe(seconds)
+
+
+# Time a stage of the current request, as
+#     with metrics.stage('title_match'):
+#         ...
+def stage(name):
+    return _Stage(name)
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        observe_stage(self.name, time.perf_counter() - self.start)
+
+
+# Exposes the statistics the caches and other components keep themselves, as
+# gauges named <source>_<statistic>. Sources with both hits and misses also
+# get a <source>_hit_ratio. With several worker processes these are the
+# statistics of the worker serving the scrape.
+class StatsCollector:
+    def __init__(self):
+        self._sources = []
+
+    # Add a function returning a dict of statistics. If label is given, the
+    # dict maps each value of the label to a dict of statistics.
+    def add(self, source, stats, label=None):
+        self._sources.append((source, stats, label))
+
+    def collect(self):
+        for source, stats, label in self._sources:
+            groups = stats() if label else {None: stats()}
+            metrics = {}
+            for label_value, values in groups.items():
+                values = dict(values)
+                if 'hits' in values and 'misses' in values:
+                    lookups = values['hits'] + values['misses']
+                    values['hit_ratio'] = values['hits'] / lookups if lookups else 0.0
+                for name, value in values.items():
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        continue
+                    metric = metrics.get(name)
+                    if metric is None:
+                        metric = metrics[name] = GaugeMetricFamily(
+                            f'{source}_{name}', f'{name} of the {source}.',
+                            labels=[label] if label else [])
+                    metric.add_metric([label_value] if label else [], value)
+            yield from metrics.values()
+
+
+stats_collector = StatsCollector()
+registry = REGISTRY
+if MULTIPROCESS:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+registry.register(stats_collector)
+
+
+# The current metrics in the Prometheus text format.
+def render():
+    return generate_latest(registry)
@@ -0,0 +1,467 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+from facet_index import FACET_VARS, FacetIndex
+from kg_version import KGVersionMonitor
+from local_store import make_sparql_client
+from pattern_suggest import MAX_SUGGEST_LIMIT, PatternSuggestIndex
+from query_factory import (get_pattern_complexity_export,
+                           get_pattern_occurrences_export, get_tune_corpus_export,
+                           get_tune_metadata_export, get_tune_titles_export)
+from sparql_client import BLAZEGRAPH_URL
+
+# Set to 0 to answer the pattern endpoints from the SPARQL endpoint only.
+# Otherwise each worker process loads the index saved by the job (see main)
+# for the current KG version, and the endpoint is queried until there is one.
+ENABLED = os.environ.get('PATTERN_INDEX_ENABLED', '1') == '1'
+# Where the job saves the index and the workers load it from.
+INDEX_PATH = os.environ.get('PATTERN_INDEX_PATH', 'pattern_index.npz')
+# Rows fetched per request of the bulk export.
+PAGE_SIZE = int(os.environ.get('PATTERN_INDEX_PAGE_SIZE', 100000))
+# Seconds between checks for a new file in the workers.
+RELOAD_INTERVAL = 60
+# Patterns at or below this complexity are trivial (see query_factory). The
+# complexities are xsd:float, so they are compared in single precision.
+TRIVIAL_COMPLEXITY = np.float32(0.4)
+# Number of rows returned for the most common and common patterns.
+PATTERN_LIST_LIMIT = 18
+XSD_INTEGER = 'http://www.w3.org/2001/XMLSchema#integer'
+TUNE_VARS = ['title', 'tuneType', 'key', 'signature', 'id']
+
+
+# The values of an index file that aren't arrays are saved as UTF-8 JSON.
+def _to_json_array(value):
+    return np.frombuffer(json.dumps(value, separators=(',', ':')).encode('utf-8'), dtype=np.uint8)
+
+
+def _from_json_array(array):
+    return json.loads(array.tobytes())
+
+
+# The arrays whose names start with prefix, without it.
+def _prefixed(arrays, prefix):
+    return {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)}
+
+
+# The number of times each pattern occurs in each tune, as a sparse
+# tune x pattern matrix stored both by tune (CSR) and by pattern (CSC), with
+# the content string and complexity of each pattern, the FacetIndex of the
+# advanced search filters and the PatternSuggestIndex of the pattern contents.
+class OccurrenceIndex:
+    # The arrays saved in an index file as they are.
+    ARRAYS = ['complexity', 'tune_indptr', 'tune_patterns', 'tune_counts',
+              'pattern_indptr', 'pattern_tunes', 'pattern_counts', 'pattern_rank']
+
+    # occurrences are (tune id, pattern, count) triples, complexities maps
+    # pattern content to its complexity (None if it has none), tune_rows
+    # maps a tune id to its pattern search result rows, neighbour_rows to
+    # its tune-tune network rows, and corpus_rows are the (tune id, corpus)
+    # pairs of the tunes with an annotation.
+    def __init__(self, occurrences, complexities, tune_rows, neighbour_rows, corpus_rows):
+        self.tune_rows = tune_rows
+        self.neighbour_rows = neighbour_rows
+        self.facets = FacetIndex(tune_rows, corpus_rows)
+        self.pattern_columns = {}
+        self.patterns = []
+        complexity = []
+        for pattern, comp in complexities.items():
+            self.pattern_columns[pattern] = len(self.patterns)
+            self.patterns.append(pattern)
+            complexity.append(np.nan if comp is None else comp)
+
+        self.tune_ids = {}
+        rows, columns, counts = [], [], []
+        for tune_id, pattern, count in occurrences:
+            row = self.tune_ids.setdefault(tune_id, len(self.tune_ids))
+            column = self.pattern_columns.get(pattern)
+            if column is None:
+                column = self.pattern_columns[pattern] = len(self.patterns)
+                self.patterns.append(pattern)
+                complexity.append(np.nan)
+            rows.append(row)
+            columns.append(column)
+            counts.append(count)
+        self.complexity = np.array(complexity, dtype=np.float32)
+        self.tune_id_list = list(self.tune_ids)
+
+        rows = np.array(rows, dtype=np.int32)
+        columns = np.array(columns, dtype=np.int32)
+        counts = np.array(counts, dtype=np.int32)
+        by_tune = np.lexsort((columns, rows))
+        self.tune_indptr = self._indptr(rows, len(self.tune_ids))
+        self.tune_patterns = columns[by_tune]
+        self.tune_counts = counts[by_tune]
+        by_pattern = np.lexsort((rows, columns))
+        self.pattern_indptr = self._indptr(columns, len(self.patterns))
+        self.pattern_tunes = rows[by_pattern]
+        self.pattern_counts = counts[by_pattern]
+
+        # The position of each pattern in string order, for breaking ties the
+        # way ORDER BY ?pattern does.
+        order = sorted(range(len(self.patterns)), key=self.patterns.__getitem__)
+        self.pattern_rank = np.empty(len(self.patterns), dtype=np.int32)
+        self.pattern_rank[order] = np.arange(len(self.patterns), dtype=np.int32)
+
+        # The number of times each pattern occurs in the corpus
+        frequencies = np.bincount(columns, weights=counts, minlength=len(self.patterns)).astype(np.int64)
+        self.suggestions = PatternSuggestIndex(self.patterns, frequencies)
+
+    # The index as arrays, for saving with np.savez.
+    def to_arrays(self):
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        arrays.update(patterns=_to_json_array(self.patterns), tune_ids=_to_json_array(self.tune_id_list),
+                      tune_rows=_to_json_array(self.tune_rows),
+                      neighbour_rows=_to_json_array(self.neighbour_rows))
+        arrays.update({f'facet_{name}': array for name, array in self.facets.to_arrays().items()})
+        arrays.update({f'suggest_{name}': array for name, array in self.suggestions.to_arrays().items()})
+        return arrays
+
+    # The index saved by to_arrays.
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, arrays[name])
+        index.patterns = _from_json_array(arrays['patterns'])
+        index.pattern_columns = {pattern: column for column, pattern in enumerate(index.patterns)}
+        index.tune_id_list = _from_json_array(arrays['tune_ids'])
+        index.tune_ids = {tune_id: row for row, tune_id in enumerate(index.tune_id_list)}
+        index.tune_rows = _from_json_array(arrays['tune_rows'])
+        index.neighbour_rows = _from_json_array(arrays['neighbour_rows'])
+        # The facet index is over the tunes of the tune rows, in their order
+        index.facets = FacetIndex.from_arrays(list(index.tune_rows), _prefixed(arrays, 'facet_'))
+        index.suggestions = PatternSuggestIndex.from_arrays(index.patterns, _prefixed(arrays, 'suggest_'))
+        return index
+
+    @staticmethod
+    def _indptr(keys, size):
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=size), out=indptr[1:])
+        return indptr
+
+    # The (pattern columns, counts) of a tune, empty if it has no patterns.
+    def tune(self, tune_id):
+        row = self.tune_ids.get(tune_id)
+        if row is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        start, end = self.tune_indptr[row], self.tune_indptr[row + 1]
+        return self.tune_patterns[start:end], self.tune_counts[start:end]
+
+    # The (tune rows, counts) of a pattern, empty if no tune contains it.
+    def pattern(self, pattern):
+        column = self.pattern_columns.get(pattern)
+        if column is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        start, end = self.pattern_indptr[column], self.pattern_indptr[column + 1]
+        return self.pattern_tunes[start:end], self.pattern_counts[start:end]
+
+    # Mask of the given patterns that are not trivial.
+    def non_trivial(self, columns):
+        # NaN (no complexity) compares False, as the SPARQL FILTER drops them.
+        return self.complexity[columns] > TRIVIAL_COMPLEXITY
+
+
+# Answers the pattern endpoints from an OccurrenceIndex built from a bulk
+# export of the knowledge graph, in the same form as the SPARQL endpoint.
+# The job builds the index once per KG version and saves it, and the workers
+# load it in the background. Until an index for the current version is
+# loaded every method returns None, and the caller should query the endpoint
+# instead.
+class PatternIndex:
+    def __init__(self, sparql_client, page_size=PAGE_SIZE, path=INDEX_PATH):
+        self.sparql_client = sparql_client
+        self.page_size = page_size
+        self.path = path
+        # The version of the index, and the current KG version, if known
+        self.version = None
+        self.kg_version = None
+        self._index = None
+        self._pattern_term = {'type': 'literal'}
+        self._refresh_lock = threading.Lock()
+        self._mtime = None
+        self._wake = threading.Event()
+
+    # Load the index saved for a KG version in a background thread, and keep
+    # checking for a new file every RELOAD_INTERVAL seconds.
+    def start(self, version):
+        self.kg_version = version
+        threading.Thread(target=self._watch, name='pattern-index', daemon=True).start()
+
+    # Follow the KG version, as a KGVersionMonitor listener. The index of the
+    # previous version is no longer used, and the file is checked at once.
+    def set_version(self, version):
+        self.kg_version = version
+        self._wake.set()
+
+    def _watch(self):
+        while True:
+            self.load()
+            self._wake.wait(RELOAD_INTERVAL)
+            self._wake.clear()
+
+    # Load the index saved in path, if the file has changed and is for the
+    # current KG version (or the version isn't known).
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        start = time.perf_counter()
+        try:
+            with np.load(self.path) as data:
+                version = str(data['version'])
+                if self.kg_version is not None and version != self.kg_version:
+                    return
+                arrays = {name: data[name] for name in data.files}
+            index = OccurrenceIndex.from_arrays(arrays)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Unable to load the pattern index from {self.path}: {e}")
+            return
+        with self._refresh_lock:
+            self._pattern_term = _from_json_array(arrays['pattern_term'])
+            self.version = version
+            self._index = index
+            self._mtime = mtime
+        print(f"Pattern index loaded for version {version} in {time.perf_counter() - start:.1f}s: "
+              f"{len(index.tune_ids)} tunes, {len(index.patterns)} patterns, "
+              f"{len(index.tune_patterns)} occurrences")
+
+    # Save the index to path, writing a temporary file and renaming it so
+    # that the workers never read a partly written file.
+    def save(self):
+        temp_path = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(temp_path, version=np.array(self.version, dtype=str),
+                 pattern_term=_to_json_array(self._pattern_term), **self._index.to_arrays())
+        os.replace(temp_path, self.path)
+
+    # Build the index for a new knowledge graph version. If the export fails
+    # the current index is kept.
+    def refresh(self, version):
+        with self._refresh_lock:
+            if self._index is not None and version == self.version:
+                return
+            # The exports are parsed as they are read, and the occurrences
+            # are kept as tuples rather than as the parsed bindings.
+            occurrences = []
+            tune_rows = {}
+            neighbour_rows = {}
+            corpus_rows = []
+            try:
+                for binding in self._export(get_pattern_occurrences_export):
+                    occurrences.append((binding['id']['value'], binding['pattern']['value'],
+                                        int(binding['count']['value'])))
+                    pattern_term = binding['pattern']
+                complexities = {binding['pattern']['value']: float(binding['comp']['value']) if 'comp' in binding else None
+                                for binding in self._export(get_pattern_complexity_export)}
+                for binding in self._export(get_tune_metadata_export):
+                    tune_rows.setdefault(binding['id']['value'], []).append(binding)
+                for binding in self._export(get_tune_titles_export):
+                    neighbour_rows.setdefault(binding['id']['value'], []).append(binding)
+                for binding in self._export(get_tune_corpus_export):
+                    corpus_rows.append((binding['id']['value'],
+                                        binding['corpus']['value'] if 'corpus' in binding else None))
+            except (ConnectionError, requests.RequestException) as e:
+                print(f"Unable to build the pattern index, keeping version {self.version}: {e}")
+                return
+            if occurrences:
+                # The pattern literals are returned with the same type (and
+                # datatype, if any) as in the export.
+                self._pattern_term = {name: value for name, value in pattern_term.items()
+                                      if name != 'value'}
+            index = OccurrenceIndex(occurrences, complexities, tune_rows, neighbour_rows, corpus_rows)
+            self._index = index
+            self.version = version
+            print(f"Pattern index built for version {version}: {len(index.tune_ids)} tunes, "
+                  f"{len(index.patterns)} patterns, {len(index.tune_patterns)} occurrences")
+
+    # Iterate over every row of a bulk export, fetched a page at a time.
+    def _export(self, query_builder):
+        offset = 0
+        while True:
+            rows = 0
+            for binding in self.sparql_client.iter_bindings(query_builder(offset, self.page_size)):
+                rows += 1
+                yield binding
+            if rows < self.page_size:
+                return
+            offset += self.page_size
+
+    @property
+    def ready(self):
+        return self.index is not None
+
+    # The current OccurrenceIndex, or None if it hasn't been built or loaded
+    # yet, or is for another KG version.
+    @property
+    def index(self):
+        index = self._index
+        if self.kg_version is not None and self.version != self.kg_version:
+            return None
+        return index
+
+    def _pattern_binding(self, index, column):
+        return {**self._pattern_term, 'value': index.patterns[column]}
+
+    # Same as get_most_common_patterns_for_a_tune.
+    def most_common_patterns(self, tune_id, excludeTrivialPatterns):
+        index = self.index
+        if index is None:
+            return None
+        columns, counts = index.tune(tune_id)
+        if excludeTrivialPatterns == "true":
+            keep = index.non_trivial(columns)
+            columns, counts = columns[keep], counts[keep]
+        order = np.lexsort((index.pattern_rank[columns], -counts))[:PATTERN_LIST_LIMIT]
+        return {'head': {'vars': ['pattern', 'patternFreq']},
+                'results': {'bindings': [
+                    {'pattern': self._pattern_binding(index, columns[i]),
+                     'patternFreq': {'datatype': XSD_INTEGER, 'type': 'literal', 'value': str(counts[i])}}
+                    for i in order]}}
+
+    # Same as get_patterns_in_common_between_two_tunes.
+    def common_patterns(self, tune_id, prev, excludeTrivialPatterns):
+        index = self.index
+        if index is None:
+            return None
+        columns, counts = index.tune(tune_id)
+        prev_columns, prev_counts = index.tune(prev)
+        columns, position, prev_position = np.intersect1d(
+            columns, prev_columns, assume_unique=True, return_indices=True)
+        # Every pair of observations of a pattern in the two tunes is a match.
+        counts = counts[position].astype(np.int64) * prev_counts[prev_position]
+        if excludeTrivialPatterns == "true":
+            keep = index.non_trivial(columns)
+            columns, counts = columns[keep], counts[keep]
+        order = np.lexsort((index.pattern_rank[columns], -counts))[:PATTERN_LIST_LIMIT]
+        return {'head': {'vars': ['pattern']},
+                'results': {'bindings': [{'pattern': self._pattern_binding(index, columns[i])}
+                                         for i in order]}}
+
+    # Same as get_ranked_patterns_by_tune.
+    def ranked_patterns(self, tune_id, excludeTrivialPatterns):
+        index = self.index
+        if index is None:
+            return None
+        columns, counts = index.tune(tune_id)
+        complexity = index.complexity[columns]
+        if excludeTrivialPatterns == "true":
+            keep = complexity > TRIVIAL_COMPLEXITY
+        else:
+            keep = ~np.isnan(complexity)
+        columns, counts, complexity = columns[keep], counts[keep], complexity[keep]
+        weight = complexity * counts.astype(np.float32)
+        order = np.lexsort((index.pattern_rank[columns], -counts, -complexity, -weight))
+        return {'head': {'vars': ['pattern']},
+                'results': {'bindings': [{'pattern': self._pattern_binding(index, columns[i])}
+                                         for i in order]}}
+
+    # Same as get_pattern_search_query.
+    def tunes_by_pattern(self, pattern):
+        index = self.index
+        if index is None:
+            return None
+        rows, _ = index.pattern(pattern)
+        bindings = [binding for row in rows
+                    for binding in index.tune_rows.get(index.tune_id_list[row], [])]
+        # ORDER BY ?title ?id, with untitled tunes first.
+        bindings.sort(key=lambda binding: ('title' in binding,
+                                           binding['title']['value'] if 'title' in binding else '',
+                                           binding['id']['value']))
+        return {'head': {'vars': TUNE_VARS},
+                'results': {'bindings': bindings}}
+
+    # Same as advanced_search. The filters are resolved with the facet index,
+    # and the tunes found are narrowed down to those containing the pattern
+    # and to the matched titles, if they are searched for.
+    def advanced_search(self, query_params, matched_ids):
+        index = self.index
+        if index is None:
+            return None
+        facets = index.facets
+        bits = facets.candidates(query_params)
+        pattern = query_params['pattern'][0]
+        if pattern:
+            rows, _ = index.pattern(pattern)
+            np.bitwise_and(bits, facets.bitset(index.tune_id_list[row] for row in rows), out=bits)
+        matches = {}
+        if query_params['title'][0]:
+            for title, score, tune_id in matched_ids:
+                matches.setdefault(str(tune_id), (str(title), int(score)))
+            np.bitwise_and(bits, facets.bitset(matches), out=bits)
+        # The rows of the tunes found, with the values chosen for each filter
+        chosen = {variable: set(query_params[facet]) for facet, variable in FACET_VARS.items()
+                  if variable is not None and query_params.get(facet)}
+        bindings = []
+        for tune_id in facets.tunes(bits):
+            for binding in index.tune_rows.get(tune_id, []):
+                if not all(variable in binding and binding[variable]['value'] in values
+                           for variable, values in chosen.items()):
+                    continue
+                if matches and ('title' not in binding or binding['title']['value'] != matches[tune_id][0]):
+                    continue
+                bindings.append(binding)
+        if matches:
+            # ORDER BY DESC(xsd:integer(?match_strength)) ?title ?id
+            bindings.sort(key=lambda binding: (-matches[binding['id']['value']][1],
+                                               binding['title']['value'], binding['id']['value']))
+        else:
+            # ORDER BY ?title ?id, with untitled tunes first.
+            bindings.sort(key=lambda binding: ('title' in binding,
+                                               binding['title']['value'] if 'title' in binding else '',
+                                               binding['id']['value']))
+        return {'head': {'vars': TUNE_VARS},
+                'results': {'bindings': bindings}}
+
+    # The most frequent patterns starting with (or, if match is 'substring',
+    # containing) term, with their number of occurrences in the corpus.
+    def suggest_patterns(self, term, match, limit):
+        index = self.index
+        if index is None:
+            return None
+        columns, frequencies = index.suggestions.suggest(term, match, max(1, min(limit, MAX_SUGGEST_LIMIT)))
+        return {'head': {'vars': ['pattern', 'patternFreq']},
+                'results': {'bindings': [
+                    {'pattern': self._pattern_binding(index, column),
+                     'patternFreq': {'datatype': XSD_INTEGER, 'type': 'literal', 'value': str(frequency)}}
+                    for column, frequency in zip(columns, frequencies)]}}
+
+
+# The KG version of the index saved in path, or None if there is none.
+def read_version(path=INDEX_PATH):
+    try:
+        with np.load(path) as data:
+            return str(data['version'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+# Build the index from a bulk export of the knowledge graph and save it for
+# the workers. Run it after each release of the knowledge graph:
+#     python pattern_index.py
+def main():
+    sparql_client = make_sparql_client(BLAZEGRAPH_URL)
+    version = KGVersionMonitor(sparql_client).fetch()
+    if version is None:
+        print("Unable to read the knowledge graph version")
+        sys.exit(1)
+    if read_version() == version and '--force' not in sys.argv:
+        print(f"Pattern index is up to date for version {version}")
+        return
+    pattern_index = PatternIndex(sparql_client)
+    pattern_index.refresh(version)
+    if not pattern_index.ready:
+        sys.exit(1)
+    pattern_index.save()
+    print(f"Pattern index saved to {pattern_index.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import os
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+# Number of suggestions returned by default, and the most that can be asked for.
+SUGGEST_LIMIT = int(os.environ.get('PATTERN_SUGGEST_LIMIT', 10))
+MAX_SUGGEST_LIMIT = 50
+# Suggest the patterns starting with the search term, or containing it.
+PREFIX = 'prefix'
+SUBSTRING = 'substring'
+# Searches matching more positions of the sorted arrays than this (short
+# terms) are ranked once, and their top suggestions remembered.
+REMEMBER_RANGE = 4096
+
+
+# The suffix array of a string of character codes: the start positions of its
+# suffixes in sorted order. It is built by prefix doubling, sorting by the
+# first 2k characters from the ranks by the first k, so it takes as many
+# rounds as the log of the longest repeated substring.
+def suffix_array(codes):
+    size = len(codes)
+    _, rank = np.unique(codes, return_inverse=True)
+    rank = rank.astype(np.int32)
+    step = 1
+    while True:
+        second = np.full(size, -1, dtype=np.int32)
+        second[:size - step] = rank[step:]
+        order = np.lexsort((second, rank))
+        first, second = rank[order], second[order]
+        new_group = np.empty(size, dtype=bool)
+        new_group[0] = True
+        new_group[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+        rank = np.empty(size, dtype=np.int32)
+        rank[order] = np.cumsum(new_group, dtype=np.int32) - 1
+        if new_group.all() or step >= size:
+            return order.astype(np.int32)
+        step *= 2
+
+
+# Completions of a partly typed pattern, ranked by how often the patterns
+# occur in the corpus. The patterns are kept in string order, so those
+# starting with a term are a range of them found by binary search, and a
+# suffix array over all of them gives the range of their suffixes starting
+# with it, that is the patterns containing it. The matches are ranked with a
+# partial sort of their frequencies.
+class PatternSuggestIndex:
+    # patterns are the distinct pattern contents, and frequencies (an array)
+    # the number of times each occurs in the tunes. Patterns that occur in no
+    # tune are left out.
+    def __init__(self, patterns, frequencies):
+        order = sorted(np.flatnonzero(frequencies > 0).tolist(), key=patterns.__getitem__)
+        # The index of each pattern in the lists given, in string order
+        self.columns = np.array(order, dtype=np.int32)
+        self.patterns = [patterns[column] for column in order]
+        self.frequencies = np.asarray(frequencies)[self.columns].astype(np.int64)
+        # The patterns joined by a separator, and the start of each in it
+        self.text = ''.join(pattern + '\0' for pattern in self.patterns)
+        lengths = np.array([len(pattern) + 1 for pattern in self.patterns], dtype=np.int64)
+        starts = np.zeros(len(self.patterns), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+        codes = np.frombuffer(self.text.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        # Each separator is given its own code, below any character, so that
+        # suffixes are only compared up to the end of their pattern.
+        separators = starts + lengths - 1
+        codes[separators] = np.arange(len(self.patterns)) - len(self.patterns)
+        suffixes = suffix_array(codes) if len(codes) else np.empty(0, dtype=np.int32)
+        self.suffixes = suffixes[codes[suffixes] >= 0]
+        # The pattern each suffix belongs to
+        self.suffix_patterns = (np.searchsorted(starts, self.suffixes, side='right') - 1).astype(np.int32)
+        self._remembered = {}
+
+    def __len__(self):
+        return len(self.patterns)
+
+    # The index as arrays, for saving with np.savez.
+    def to_arrays(self):
+        return {'columns': self.columns, 'frequencies': self.frequencies,
+                'suffixes': self.suffixes, 'suffix_patterns': self.suffix_patterns}
+
+    # The index saved by to_arrays, for the same patterns.
+    @classmethod
+    def from_arrays(cls, patterns, arrays):
+        index = cls.__new__(cls)
+        index.columns = arrays['columns']
+        index.patterns = [patterns[column] for column in index.columns]
+        index.frequencies = arrays['frequencies']
+        index.text = ''.join(pattern + '\0' for pattern in index.patterns)
+        index.suffixes = arrays['suffixes']
+        index.suffix_patterns = arrays['suffix_patterns']
+        index._remembered = {}
+        return index
+
+    # The (pattern indexes, frequencies) of the most frequent patterns
+    # starting with or containing term, with ties in string order.
+    def suggest(self, term, match=PREFIX, limit=SUGGEST_LIMIT):
+        # No pattern contains the separator
+        if '\0' in term:
+            return self.columns[:0], self.frequencies[:0]
+        remembered = self._remembered.get((match, term))
+        if remembered is not None:
+            positions = remembered[:limit]
+            return self.columns[positions], self.frequencies[positions]
+        length = len(term)
+        if match == SUBSTRING:
+            key = lambda suffix: self.text[suffix:suffix + length]
+            start = bisect_left(self.suffixes, term, key=key)
+            end = bisect_right(self.suffixes, term, lo=start, key=key)
+            found = np.zeros(len(self.patterns), dtype=bool)
+            found[self.suffix_patterns[start:end]] = True
+            positions = np.flatnonzero(found)
+        else:
+            key = lambda pattern: pattern[:length]
+            start = bisect_left(self.patterns, term, key=key)
+            end = bisect_right(self.patterns, term, lo=start, key=key)
+            positions = np.arange(start, end)
+        if end - start > REMEMBER_RANGE:
+            self._remembered[(match, term)] = self._rank(positions, MAX_SUGGEST_LIMIT)
+            return self.suggest(term, match, limit)
+        positions = self._rank(positions, limit)
+        return self.columns[positions], self.frequencies[positions]
+
+    # The limit most frequent of the given positions, which are in string
+    # order. Only those at least as frequent as the last one returned are
+    # sorted.
+    def _rank(self, positions, limit):
+        frequencies = self.frequencies[positions]
+        if len(positions) > limit:
+            kth = len(positions) - limit
+            keep = frequencies >= np.partition(frequencies, kth)[kth]
+            positions, frequencies = positions[keep], frequencies[keep]
+        return positions[np.argsort(-frequencies, kind='stable')[:limit]]
@@ -1,6 +1,19 @@
 import requests
 
 NUM_NODES = 5
+# The most rows of a ranked node list that are fetched at once and paged
+# through in memory. Pages past this are queried for individually.
+RANKED_LIST_MAX_ROWS = 500
+# Escapes for writing text typed by a user in a double quoted SPARQL string:
+# the characters with an escape of their own use it, and the other control
+# characters are written as code points.
+STRING_ESCAPES = str.maketrans({
+    **{chr(code): f'\\u{code:04X}' for code in [*range(0x20), 0x7f]},
+    '\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r', '\t': '\\t', '\b': '\\b', '\f': '\\f'})
+
+
+def escape_string(text):
+    return text.translate(STRING_ESCAPES)
 
 
 # A search for tunes containing a given pattern.
@@ -30,6 +43,30 @@ def get_pattern_search_query(pattern):
     return sparql_query
 
 
+# The most frequent patterns starting with (or, if match is 'substring',
+# containing) a search term, for completing a pattern search.
+def get_pattern_suggestions(term, match, limit):
+    term = escape_string(term)
+    test = "CONTAINS" if match == "substring" else "STRSTARTS"
+    sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
+                        PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                        PREFIX xyz:<http://sparql.xyz/facade-x/data/>
+                        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                        PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                        SELECT ?pattern (COUNT(?pattern) AS ?patternFreq)
+                        WHERE {
+                            ?patternURI xyz:pattern_content ?pattern.
+                            FILTER (""" + test + """(?pattern, \"""" + term + """\")).
+                            ?observation jams:ofPattern ?patternURI.
+                            ?annotation jams:includesObservation ?observation.
+                            ?annotation jams:isJAMSAnnotationOf ?tune.
+                            ?tune rdf:type mm:MusicEntity.
+                            ?tune core:id ?id.
+                        } GROUP BY ?pattern
+                        ORDER BY DESC (?patternFreq) ?pattern LIMIT """ + str(limit)
+    return sparql_query
+
+
 # Return a list of the most frequent patterns in a tune.
 def get_most_common_patterns_for_a_tune(id, excludeTrivialPatterns):
     sparql_query = """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
@@ -208,9 +245,32 @@ def get_all_tune_names():
     return sparql_query
 
 
-# Get the pattern node data for the tune-pattern network visualisation.
-def get_neighbour_patterns_by_tune(id, click_num, excludeTrivialPatterns):
-    offset = NUM_NODES*int(click_num)
+# Restrict a ranked query to limit rows starting at offset.
+def paginate(sparql_query, offset, limit):
+    return sparql_query + """
+                        OFFSET """ + str(offset) + """ LIMIT """ + str(limit)
+
+
+# Take the rows of a page from the result of a ranked query.
+def get_page(result, offset, limit):
+    return {'head': result['head'],
+            'results': {'bindings': result['results']['bindings'][offset:offset + limit]}}
+
+
+# The compact form of a query result: the value of each variable as an array,
+# in the order of head.vars, with null where the variable is unbound.
+def get_columns(result):
+    variables = result['head']['vars']
+    bindings = result['results']['bindings']
+    return {'head': {'vars': variables},
+            'columns': [[binding[var]['value'] if var in binding else None
+                         for binding in bindings]
+                        for var in variables]}
+
+
+# All the pattern nodes of a tune, most significant first. A pattern has one
+# complexity, which is SAMPLEd as ?comp isn't grouped on.
+def get_ranked_patterns_by_tune(id, excludeTrivialPatterns):
     sparql_query =   """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
                         PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
                         PREFIX core:<http://w3id.org/polifonia/ontology/core/>
@@ -229,14 +289,13 @@ def get_neighbour_patterns_by_tune(id, click_num, excludeTrivialPatterns):
         sparql_query += """FILTER (?comp > "0.4"^^xsd:float) .
                         """
     sparql_query +=     """?patternURI xyz:pattern_content ?pattern.
-                        } group by ?pattern ORDER BY DESC(?comp*COUNT(?pattern)) DESC(?comp) DESC(COUNT(?pattern)) ?pattern
-                        OFFSET """ + str(offset) + """ LIMIT """ + str(NUM_NODES)
+                        } group by ?pattern
+                        ORDER BY DESC(SAMPLE(?comp)*COUNT(?pattern)) DESC(SAMPLE(?comp)) DESC(COUNT(?pattern)) ?pattern"""
     return sparql_query
 
 
-# Get the tune node data for the tune-pattern network visualisation.
-def get_neighbour_tunes_by_pattern(pattern, click_num):
-    offset = NUM_NODES*int(click_num)
+# All the tunes containing a pattern, those containing it most often first.
+def get_ranked_tunes_by_pattern(pattern):
     sparql_query =       """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
                             PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
                             PREFIX core:  <http://w3id.org/polifonia/ontology/core/>
@@ -257,8 +316,7 @@ def get_neighbour_tunes_by_pattern(pattern, click_num):
                                 ?tuneFamilyURI rdf:type tunes:TuneFamily.
                                 ?tuneFamilyURI mm:tuneFamilyName ?family.
                                 OPTIONAL {?tune core:title ?title}
-                            } GROUP BY ?id ?title ?family ORDER BY DESC(COUNT(?pattern)) ?title ?id
-                            OFFSET """ + str(offset) + """ LIMIT """ + str(NUM_NODES)
+                            } GROUP BY ?id ?title ?family ORDER BY DESC(COUNT(?pattern)) ?title ?id"""
     return sparql_query
 
 
@@ -302,9 +360,8 @@ def get_tune_family_members(family):
     return sparql_query
 
 
-# Get the tune node data for the tune-tune network visualisation.
-def get_neighbour_tunes_by_common_patterns(id, click_num):
-    offset = NUM_NODES*int(click_num)
+# All the tunes sharing patterns with a tune, the most similar first.
+def get_ranked_tunes_by_common_patterns(id):
     sparql_query =       """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
                             PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
                             PREFIX core:<http://w3id.org/polifonia/ontology/core/>
@@ -336,8 +393,7 @@ def get_neighbour_tunes_by_common_patterns(id, click_num):
                                     ?patternURI xyz:pattern_complexity ?complexity.
                                 } GROUP BY ?title ?id ?family ?pattern ?complexity
                             } GROUP BY ?title ?id ?family
-                            ORDER BY DESC(SUM(?count_pattern_by_c))
-                            OFFSET """ + str(offset) + """ LIMIT """ + str(NUM_NODES)
+                            ORDER BY DESC(SUM(?count_pattern_by_c))"""
     return sparql_query
 
 
@@ -394,6 +450,99 @@ def get_tune_type_list():
     return sparql_query
 
 
+# Bulk export of the number of times each pattern occurs in each tune, for
+# building the pattern index. Ordered so that it can be paged.
+def get_pattern_occurrences_export(offset, limit):
+    sparql_query =   """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
+                        PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                        PREFIX xyz:<http://sparql.xyz/facade-x/data/>
+                        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                        PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                        SELECT ?id ?pattern (COUNT(?pattern) AS ?count)
+                        WHERE {
+                            ?tune rdf:type mm:MusicEntity.
+                            ?tune core:id ?id.
+                            ?annotation jams:isJAMSAnnotationOf ?tune.
+                            ?annotation jams:includesObservation ?observation.
+                            ?observation jams:ofPattern ?patternURI.
+                            ?patternURI xyz:pattern_content ?pattern.
+                        } GROUP BY ?id ?pattern ORDER BY ?id ?pattern"""
+    return paginate(sparql_query, offset, limit)
+
+
+# Bulk export of the complexity of every pattern, for building the pattern index.
+def get_pattern_complexity_export(offset, limit):
+    sparql_query =   """PREFIX xyz:<http://sparql.xyz/facade-x/data/>
+                        SELECT ?pattern ?comp
+                        WHERE {
+                            ?patternURI xyz:pattern_content ?pattern.
+                            OPTIONAL {?patternURI xyz:pattern_complexity ?comp.}
+                        } ORDER BY ?pattern ?comp"""
+    return paginate(sparql_query, offset, limit)
+
+
+# Bulk export of the tune data shown in the pattern search results, for
+# building the pattern index.
+def get_tune_metadata_export(offset, limit):
+    sparql_query =   """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
+                        PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                        PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                        SELECT DISTINCT ?title ?tuneType ?key ?signature ?id
+                        WHERE
+                        {
+                            ?tune rdf:type mm:MusicEntity.
+                            ?tune core:id ?id.
+                            OPTIONAL {?tune core:title ?title}
+                            OPTIONAL {?tune mm:hasFormType ?tuneTypeURI.
+                               ?tuneTypeURI core:name ?tuneType.}
+                            OPTIONAL {?tune mm:hasKey ?keyURI.
+                               ?keyURI mm:tuneKeyName ?key.}
+                            OPTIONAL {?tune jams:timeSignature ?signatureURI.
+                               ?signatureURI mm:timesig ?signature.}
+                        } ORDER BY ?id ?title ?tuneType ?key ?signature"""
+    return paginate(sparql_query, offset, limit)
+
+
+# Bulk export of the tunes the advanced search can find, those with an
+# annotation, and the corpora they belong to, for building the facet index.
+def get_tune_corpus_export(offset, limit):
+    sparql_query =   """PREFIX jams:<http://w3id.org/polifonia/ontology/jams/>
+                        PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                        PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                        SELECT DISTINCT ?id ?corpus
+                        WHERE
+                        {
+                            ?tune rdf:type mm:MusicEntity.
+                            ?tune core:id ?id.
+                            ?annotation jams:isJAMSAnnotationOf ?tune.
+                            OPTIONAL {?tune core:isMemberOf ?corpusURI.
+                               ?corpusURI core:isDefinedBy <http://w3id.org/polifonia/resource/tunes/CollectionConcept/ElectronicCollection>.
+                               ?corpusURI core:name ?corpus.}
+                        } ORDER BY ?id ?corpus"""
+    return paginate(sparql_query, offset, limit)
+
+
+# Bulk export of the title and tune family of every tune, as shown in the
+# tune-tune network, for building the pattern index.
+def get_tune_titles_export(offset, limit):
+    sparql_query =   """PREFIX mm:<http://w3id.org/polifonia/ontology/music-meta/>
+                        PREFIX core:<http://w3id.org/polifonia/ontology/core/>
+                        PREFIX tunes:<http://w3id.org/polifonia/ontology/tunes/>
+                        PREFIX rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                        SELECT DISTINCT ?title ?id ?family
+                        WHERE {
+                            ?tune rdf:type mm:MusicEntity.
+                            ?tune core:id ?id.
+                            ?tune core:title ?title.
+                            OPTIONAL{?tune core:isMemberOf ?tuneFamilyURI.
+                            ?tuneFamilyURI rdf:type tunes:TuneFamily.
+                            ?tuneFamilyURI mm:tuneFamilyName ?family.}
+                        } ORDER BY ?id ?title ?family"""
+    return paginate(sparql_query, offset, limit)
+
+
 # Return the release version of the knowledge graph.
 # Is there a risk of multiple results?
 def get_kg_version():
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Stale results refreshed at the same time by each worker process, so that
+# refreshing a burst of them can't overload the SPARQL endpoint.
+CONCURRENCY = int(os.environ.get('STALE_REFRESH_CONCURRENCY', 2))
+# Refreshes that can be waiting at once. Beyond this, a refresh is skipped;
+# the stale result is served again and a later request asks for it again.
+MAX_PENDING = int(os.environ.get('STALE_REFRESH_MAX_PENDING', 100))
+
+
+# Re-runs the queries of stale cached results in the background, a bounded
+# number at a time. A query that is already waiting to be refreshed isn't
+# queued again.
+class Refresher:
+    def __init__(self, concurrency=CONCURRENCY, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self.refreshed = 0
+        self.skipped = 0
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+                                            thread_name_prefix='refresher')
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    # Call refresh(sparql_query, *args) in the background.
+    def submit(self, sparql_query, refresh, *args):
+        with self._lock:
+            if sparql_query in self._pending:
+                return
+            if len(self._pending) >= self.max_pending:
+                self.skipped += 1
+                return
+            self._pending.add(sparql_query)
+        self._executor.submit(self._refresh, sparql_query, refresh, args)
+
+    def _refresh(self, sparql_query, refresh, args):
+        try:
+            refresh(sparql_query, *args)
+            self.refreshed += 1
+        except Exception as e:
+            print(f"Unable to refresh Sparql Query = {sparql_query}")
+            print(e)
+        finally:
+            with self._lock:
+                self._pending.discard(sparql_query)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'refreshed': self.refreshed,
+                'skipped': self.skipped,
+            }
+
+
+# The Refresher of the asynchronous server, running the refreshes as tasks on
+# its event loop.
+class AsyncRefresher:
+    def __init__(self, concurrency=CONCURRENCY, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self.refreshed = 0
+        self.skipped = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending = {}
+
+    # Run the coroutine function refresh(sparql_query, *args) in the
+    # background.
+    def submit(self, sparql_query, refresh, *args):
+        if sparql_query in self._pending:
+            return
+        if len(self._pending) >= self.max_pending:
+            self.skipped += 1
+            return
+        self._pending[sparql_query] = asyncio.ensure_future(
+            self._refresh(sparql_query, refresh, args))
+
+    async def _refresh(self, sparql_query, refresh, args):
+        try:
+            async with self._semaphore:
+                await refresh(sparql_query, *args)
+            self.refreshed += 1
+        except Exception as e:
+            print(f"Unable to refresh Sparql Query = {sparql_query}")
+            print(e)
+        finally:
+            self._pending.pop(sparql_query, None)
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'refreshed': self.refreshed,
+            'skipped': self.skipped,
+        }
@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Total size of the cached SPARQL responses held by each worker process.
+MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+# Responses larger than this are not cached, so that one large pattern search
+# can't flush the rest of the cache.
+MAX_ENTRY_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRY_BYTES', 8 * 1024 * 1024))
+# The ranked node lists the network pages are sliced from. They are only kept
+# while someone is likely to still be paging through them.
+RANKED_LIST_MAX_BYTES = int(os.environ.get('RANKED_LIST_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+RANKED_LIST_MAX_AGE = float(os.environ.get('RANKED_LIST_CACHE_MAX_AGE', 600))
+# Seconds a result can still be served after it has expired, or after the KG
+# version has changed, while it is refreshed in the background.
+STALE_GRACE = float(os.environ.get('RESPONSE_CACHE_STALE_GRACE', 300))
+
+
+# An in-process LRU cache of SPARQL results, keyed on the query text and the
+# release version of the knowledge graph. The data only changes when the KG is
+# re-released, so entries never expire; they are evicted when the cache is
+# over its byte limit, and all of them are dropped when the version changes.
+# If max_age is given, entries also expire that many seconds after being stored.
+#
+# Expired entries, and the entries of the previous version, are returned by
+# get_stale() for stale_grace seconds, so that a result can be served while it
+# is being refreshed.
+class ResponseCache:
+    def __init__(self, max_bytes=MAX_BYTES, max_entry_bytes=MAX_ENTRY_BYTES,
+                 max_age=None, stale_grace=STALE_GRACE):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_age = max_age
+        self.stale_grace = stale_grace
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._previous_version = None
+        self._version_changed = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, sparql_query):
+        with self._lock:
+            key = (self.version, sparql_query)
+            entry = self._entries.get(key)
+            # Expired entries are left to be evicted, as the last known good
+            # results for get_stale(any_age=True).
+            if entry is not None and self._expired(entry):
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # Return a result that is no longer fresh but is within the grace period:
+    # one that has expired, or one from the previous KG version. Returns None
+    # if there isn't one. With any_age, a result past the grace period is
+    # also returned, for when nothing fresher can be had.
+    def get_stale(self, sparql_query, any_age=False):
+        with self._lock:
+            key = (self.version, sparql_query)
+            entry = self._entries.get(key)
+            # A fresh entry is left to get().
+            if entry is not None and (not self._expired(entry) or
+                                      (self._past_grace(entry[2] + self.max_age) and not any_age)):
+                entry = None
+            if entry is None and self._version_changed is not None:
+                if self._past_grace(self._version_changed) and not any_age:
+                    self._drop_previous_version()
+                else:
+                    key = (self._previous_version, sparql_query)
+                    entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.stale_hits += 1
+            return entry[0]
+
+    # Store a result. size is the length in bytes of the endpoint's response,
+    # and version the KG version current when the query was sent; results that
+    # raced with a version change are dropped.
+    def put(self, sparql_query, result, size, version):
+        if size > self.max_entry_bytes:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            key = (self.version, sparql_query)
+            for replaced in (key, (self._previous_version, sparql_query)):
+                if replaced in self._entries:
+                    self._bytes -= self._entries.pop(replaced)[1]
+            self._entries[key] = (result, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def _expired(self, entry):
+        return self.max_age is not None and time.monotonic() - entry[2] > self.max_age
+
+    # Whether the grace period of something that went stale at a time has
+    # passed.
+    def _past_grace(self, stale_since):
+        return time.monotonic() - stale_since > self.stale_grace
+
+    # Drop the entries left from versions before the current one.
+    def _drop_previous_version(self):
+        for key in [key for key in self._entries if key[0] != self.version]:
+            self._bytes -= self._entries.pop(key)[1]
+        self._version_changed = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # Called when the KG release changes; everything cached so far is stale,
+    # and is only kept for the grace period.
+    def set_version(self, version):
+        with self._lock:
+            if version != self.version:
+                self._drop_previous_version()
+                self._previous_version = self.version
+                self.version = version
+                self._version_changed = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+            }
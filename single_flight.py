@@ -0,0 +1,177 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+# Directory shared by the worker processes for coalescing identical queries
+# across them. If it isn't set, queries are only coalesced within a process.
+SHARED_DIR = os.environ.get('SINGLE_FLIGHT_DIR')
+# Seconds to wait for a call made by someone else before making our own.
+WAIT_TIMEOUT = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 35))
+# Seconds the result of a call is kept in SHARED_DIR for the other workers.
+SHARED_RESULT_MAX_AGE = 60
+# Seconds between attempts to take a lock held by another worker.
+POLL_INTERVAL = 0.02
+# Number of byte-range locks in the shared lock file. Two queries only wait
+# for each other if they hash to the same one.
+LOCK_SLOTS = 1 << 20
+
+
+# One call to the endpoint, shared by every caller that joined it. Its leader
+# makes the call and finishes it with the body of the result, which is passed
+# to the other callers.
+class Flight:
+    def __init__(self, key):
+        self.key = key
+        self.body = None
+        self.started = time.monotonic()
+        self.lock_slot = None
+        self._done = threading.Event()
+
+    # The body of the result of the call, or None if it failed, its result
+    # couldn't be shared or it took longer than timeout seconds.
+    def wait(self, timeout=WAIT_TIMEOUT):
+        self._done.wait(timeout)
+        return self.body
+
+
+# Coalesces identical SPARQL queries that are running at the same time, so
+# that the endpoint only sees one of them. The first caller of join() leads
+# the call and the others wait for its result.
+#
+# With a shared directory the queries are also coalesced across worker
+# processes: the worker leading a call holds a lock on one byte of a lock
+# file, and writes the result next to it for the workers waiting on the lock.
+class SingleFlight:
+    def __init__(self, shared_dir=SHARED_DIR, timeout=WAIT_TIMEOUT):
+        self.shared_dir = shared_dir
+        self.timeout = timeout
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._lock_file_pid = None
+        self._last_cleanup = 0
+        if shared_dir is not None:
+            os.makedirs(shared_dir, exist_ok=True)
+
+    # Join the call for a query on a KG version. Returns (flight, leader): if
+    # leader is true the caller makes the call and must finish() the flight,
+    # even if the call fails, and otherwise it can wait() for the result.
+    def join(self, sparql_query, version):
+        key = (version, sparql_query)
+        with self._lock:
+            flight = self._flights.get(key)
+            # A leader that never finished its flight mustn't hold up every
+            # later caller.
+            if flight is not None and time.monotonic() - flight.started < self.timeout:
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = Flight(key)
+        if self.shared_dir is not None and not self._join_shared(flight):
+            return flight, False
+        return flight, True
+
+    # Finish a flight led by the caller with the body of the result, or None
+    # if the call failed.
+    def finish(self, flight, body):
+        if flight.lock_slot is not None and body is not None:
+            self._write_shared(flight.key, body)
+        self._complete(flight, body)
+
+    def _complete(self, flight, body):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        if flight.lock_slot is not None:
+            self._unlock(flight.lock_slot)
+            flight.lock_slot = None
+        flight.body = body
+        flight._done.set()
+
+    # Take this worker's flight to the lock of its query. Returns True if no
+    # other worker was running the query, and False if one was and its result
+    # has been read, in which case the flight is complete.
+    def _join_shared(self, flight):
+        slot = self._lock_slot(flight.key)
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        while True:
+            try:
+                fcntl.lockf(self._shared_lock_file(), fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    # Make the call without the lock rather than keep waiting.
+                    return True
+                waited = True
+                time.sleep(POLL_INTERVAL)
+        flight.lock_slot = slot
+        if waited:
+            body = self._read_shared(flight.key)
+            if body is not None:
+                self.coalesced += 1
+                self._complete(flight, body)
+                return False
+        return True
+
+    @staticmethod
+    def _digest(key):
+        version, sparql_query = key
+        return hashlib.sha1(f"{version}\n{sparql_query}".encode('utf-8')).hexdigest()
+
+    def _lock_slot(self, key):
+        return int(self._digest(key), 16) % LOCK_SLOTS
+
+    # The lock file, opened once per process: a record lock is released when
+    # the process closes any descriptor of its file, and isn't inherited by a
+    # forked worker.
+    def _shared_lock_file(self):
+        with self._lock:
+            if self._lock_file is None or self._lock_file_pid != os.getpid():
+                self._lock_file = open(os.path.join(self.shared_dir, 'single_flight.lock'), 'a+b')
+                self._lock_file_pid = os.getpid()
+            return self._lock_file
+
+    def _unlock(self, slot):
+        fcntl.lockf(self._shared_lock_file(), fcntl.LOCK_UN, 1, slot)
+
+    def _result_path(self, key):
+        return os.path.join(self.shared_dir, self._digest(key) + '.json')
+
+    def _read_shared(self, key):
+        path = self._result_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > SHARED_RESULT_MAX_AGE:
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    # Write the result where the waiting workers will read it, replacing it
+    # atomically so they never see part of it, and remove old results.
+    def _write_shared(self, key, body):
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.shared_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(temp_path, self._result_path(key))
+        except OSError as e:
+            print(f"Unable to share the result of a query: {e}")
+        now = time.time()
+        if now - self._last_cleanup > SHARED_RESULT_MAX_AGE:
+            self._last_cleanup = now
+            self._remove_old_results(now)
+
+    def _remove_old_results(self, now):
+        for entry in os.scandir(self.shared_dir):
+            if not entry.name.endswith(('.json', '.tmp')):
+                continue
+            try:
+                if now - entry.stat().st_mtime > SHARED_RESULT_MAX_AGE:
+                    os.remove(entry.path)
+            except OSError:
+                pass
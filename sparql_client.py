@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+from collections import deque
+
+import ijson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from circuit_breaker import CircuitBreaker
+
+# The FONN SPARQL endpoint holding the Patterns and Tunes knowledge graphs.
+# Set BLAZEGRAPH_URL to point the server at another endpoint, such as the
+# stand-in used by the tests.
+BLAZEGRAPH_URL = os.environ.get('BLAZEGRAPH_URL', 'https://polifonia.disi.unibo.it/fonn/sparql')
+# Number of keep-alive connections kept open to the endpoint by each worker
+# process. This should be at least the number of request threads per worker.
+POOL_SIZE = int(os.environ.get('SPARQL_POOL_SIZE', 10))
+# Seconds allowed to establish a connection and to wait for the response.
+CONNECT_TIMEOUT = float(os.environ.get('SPARQL_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('SPARQL_READ_TIMEOUT', 30))
+# Retries for failed connections and gateway errors. A query whose response
+# times out, or is cut off, isn't sent again: it would most likely time out
+# again, holding the worker and loading the endpoint for several timeouts.
+MAX_RETRIES = int(os.environ.get('SPARQL_MAX_RETRIES', 2))
+RETRY_BACKOFF = float(os.environ.get('SPARQL_RETRY_BACKOFF', 0.3))
+RETRY_STATUS_CODES = (502, 503, 504)
+# Number of recent calls kept for latency percentiles.
+LATENCY_WINDOW = 1000
+# Size of the chunks read from a streamed response.
+CHUNK_SIZE = 64 * 1024
+
+
+# Call counts and latencies of the queries sent to the endpoint.
+class CallStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._errors = 0
+        self._total_time = 0.0
+        self._max_time = 0.0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, elapsed, failed):
+        with self._lock:
+            self._calls += 1
+            if failed:
+                self._errors += 1
+            self._total_time += elapsed
+            self._max_time = max(self._max_time, elapsed)
+            self._latencies.append(elapsed)
+
+    # Summary of the calls made so far. Latencies are in seconds, and the
+    # percentiles cover the most recent LATENCY_WINDOW calls.
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                'calls': self._calls,
+                'errors': self._errors,
+                'mean': self._total_time / self._calls if self._calls else 0.0,
+                'max': self._max_time,
+            }
+        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            stats[name] = latencies[int(fraction * (len(latencies) - 1))] if latencies else 0.0
+        return stats
+
+
+# Raised instead of calling the endpoint while the circuit breaker is open.
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+# A SPARQL client shared by all routes of a worker process. Connections to the
+# endpoint are pooled and kept alive, so a query doesn't pay for a new TCP+TLS
+# handshake. Calls go through a circuit breaker, which fails them fast while
+# the endpoint is down.
+class SparqlClient:
+    def __init__(self, endpoint_url, pool_size=POOL_SIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_factor=RETRY_BACKOFF,
+                 breaker=None):
+        self.endpoint_url = endpoint_url
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.timeout = (connect_timeout, read_timeout)
+        # The queries we send are all read-only SELECTs, so although they are
+        # POSTed they are idempotent and safe to retry. Errors reading the
+        # response aren't retried.
+        retry = Retry(total=max_retries,
+                      connect=max_retries,
+                      read=0,
+                      status=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUS_CODES,
+                      allowed_methods=frozenset(['POST']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._stats = CallStats()
+
+    # Execute a SPARQL query, returning the requests.Response. Connection
+    # errors that persist after retrying, and read timeouts, are raised as
+    # requests.RequestException, and CircuitOpenError (a subclass of it) is
+    # raised without calling the endpoint while the breaker is open. With
+    # stream=True the body is read as it is consumed, and the caller must
+    # close the response.
+    def query(self, sparql_query, stream=False):
+        if not self.breaker.allow():
+            metrics.SPARQL_ERRORS.labels('CircuitOpenError').inc()
+            raise CircuitOpenError(f"Not querying the failing SPARQL endpoint: {self.endpoint_url}")
+        start = time.perf_counter()
+        status_code = None
+        try:
+            response = self.session.post(
+                self.endpoint_url,
+                data={
+                    'query': sparql_query,
+                    'format': 'json'
+                },
+                timeout=self.timeout,
+                stream=stream
+            )
+            status_code = response.status_code
+            return response
+        except requests.RequestException as e:
+            metrics.SPARQL_ERRORS.labels(type(e).__name__).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stats.record(elapsed, status_code != 200)
+            metrics.observe_stage('sparql', elapsed)
+            if status_code is not None:
+                metrics.SPARQL_RESPONSES.labels(str(status_code)).inc()
+            # A query the endpoint rejects doesn't mean it is unwell.
+            if status_code is None or status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+    # Execute a SPARQL query and iterate over the bindings of its result. The
+    # response is parsed incrementally as it is read, so a large result is
+    # never held in memory as a whole. Raises ConnectionError if the endpoint
+    # returns an error or an incomplete result.
+    def iter_bindings(self, sparql_query):
+        response = self.query(sparql_query, stream=True)
+        if response.status_code != 200:
+            response.close()
+            raise ConnectionError(f"Unable to execute the query on SPARQL endpoint: {self.endpoint_url}.\n"
+                                  f"Server response code: {response.status_code}")
+        return self._parse_bindings(response)
+
+    def _parse_bindings(self, response):
+        bindings = ijson.sendable_list()
+        parser = ijson.items_coro(bindings, 'results.bindings.item')
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                parser.send(chunk)
+                yield from bindings
+                del bindings[:]
+            parser.close()
+        except ijson.JSONError as e:
+            raise ConnectionError(f"Incomplete response from SPARQL endpoint: {self.endpoint_url}: {e}")
+        finally:
+            response.close()
+        yield from bindings
+
+    def stats(self):
+        return self._stats.stats()
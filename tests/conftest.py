@@ -0,0 +1,124 @@
+import gzip
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+# The apps are tested against a stand-in for the SPARQL endpoint, which
+# answers every SELECT query with one row binding each selected variable to
+# "<variable>-value". The settings are read when the modules are imported, so
+# they are set here, before any test imports them.
+
+SELECT_VARS = re.compile(r"SELECT\s+(?:DISTINCT\s+)?(.*?)\s*WHERE", re.IGNORECASE | re.DOTALL)
+
+
+class StubSparqlServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubSparqlHandler)
+        # Seconds each query takes to answer, the status it is answered with
+        # and the queries answered so far
+        self.delay = 0.0
+        self.status = 200
+        self.queries = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/sparql'
+
+    def count(self, marker):
+        with self._lock:
+            return sum(marker in sparql_query for sparql_query in self.queries)
+
+
+class StubSparqlHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        sparql_query = parse_qs(body).get('query', [''])[0]
+        with self.server._lock:
+            self.server.queries.append(sparql_query)
+        time.sleep(self.server.delay)
+        if self.server.status != 200:
+            self.send_response(self.server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        match = SELECT_VARS.search(sparql_query)
+        variables = re.findall(r"\?(\w+)", match.group(1)) if match else []
+        binding = {variable: {'type': 'literal', 'value': f'{variable}-value'} for variable in variables}
+        document = json.dumps({'head': {'vars': variables}, 'results': {'bindings': [binding]}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        self.send_header('Content-Length', str(len(document)))
+        self.end_headers()
+        self.wfile.write(document)
+
+
+stub_server = StubSparqlServer()
+threading.Thread(target=stub_server.serve_forever, daemon=True).start()
+
+data_dir = tempfile.mkdtemp()
+snapshot_path = os.path.join(data_dir, 'tune_names_snapshot.json.gz')
+with gzip.open(snapshot_path, 'wt', encoding='utf-8') as snapshot_file:
+    json.dump({'version': 'version-value',
+               'names': {'1': 'The Foxhunters', '2': 'First Of May', '3': 'Johnny Cope'}}, snapshot_file)
+
+os.environ.update({
+    'BLAZEGRAPH_URL': stub_server.url,
+    'SPARQL_MAX_RETRIES': '0',
+    # No index is saved here, so the pattern endpoints query the stub
+    'PATTERN_INDEX_PATH': os.path.join(data_dir, 'pattern_index.npz'),
+    'TUNE_NAMES_SNAPSHOT': snapshot_path,
+    'TUNE_SIMILARITY_PATH': os.path.join(data_dir, 'tune_similarity.npz'),
+    'KG_VERSION_CHECK_INTERVAL': '3600',
+    'SINGLE_FLIGHT_TIMEOUT': '5',
+})
+os.environ.pop('LOCAL_STORE_DIR', None)
+os.environ.pop('SINGLE_FLIGHT_DIR', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def sparql_server():
+    stub_server.delay = 0.0
+    stub_server.status = 200
+    yield stub_server
+    stub_server.delay = 0.0
+    stub_server.status = 200
+
+
+# A monotonic clock that only moves when told to, in place of the time module
+# of the modules that time things out.
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    import circuit_breaker
+    import response_cache
+    clock = FakeClock()
+    for module in (circuit_breaker, response_cache):
+        monkeypatch.setattr(module, 'time', clock)
+    return clock
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+from werkzeug.datastructures import MultiDict
+
+import api
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_has_no_side_effects():
+    # Importing the ASGI app neither starts the Flask app nor queries the
+    # endpoint; that waits for the app to start serving.
+    code = ("import sys, asgi_app, api\n"
+            "assert 'app' not in sys.modules\n"
+            "assert api.sparql_client is None and api.kg_version_monitor is None\n")
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+
+
+def test_invalid_limits_are_rejected():
+    for handler in (api.getTitleSuggestions, api.getPatternSuggestions):
+        plan = handler(MultiDict({'searchTerm': 'ab', 'limit': 'abc'}))
+        assert isinstance(plan, api.Document)
+        assert plan.status == 400
+
+
+def test_invalid_match_is_rejected():
+    plan = api.getPatternSuggestions(MultiDict({'searchTerm': 'ab', 'match': 'suffix'}))
+    assert isinstance(plan, api.Document)
+    assert plan.status == 400
+
+
+def test_start_is_idempotent():
+    api.start()
+    sparql_client = api.sparql_client
+    api.start()
+    assert api.sparql_client is sparql_client
+    assert api.fuzzy_search.version == 'version-value'
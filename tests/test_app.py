@@ -0,0 +1,30 @@
+import pytest
+
+from app import app
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def test_routes(client, sparql_server):
+    response = client.get('/api/tune_by_id?id=1')
+    assert response.status_code == 200
+    assert response.get_json()['results']['bindings'][0]['title']['value'] == 'title-value'
+    response = client.get('/api/corpus_list')
+    assert (response.status_code, response.get_json()) == (200, ['corpus-value'])
+    response = client.get('/api/search?searchType=unknown')
+    assert response.status_code == 501
+    response = client.get('/api/title_suggest?searchTerm=fi&limit=abc')
+    assert response.status_code == 400
+    response = client.get('/api/composition?id=1&excludeTrivialPatterns=true')
+    assert response.status_code == 200
+    assert set(response.get_json()) == {'tune', 'patterns', 'neighbour_patterns', 'neighbour_tunes'}
+
+
+def test_columns_format(client, sparql_server):
+    response = client.get('/api/tune_by_id?id=1&format=columns')
+    assert response.status_code == 200
+    assert response.get_json() == {'head': {'vars': ['title', 'tuneFamily', 'link']},
+                                   'columns': [['title-value'], ['tuneFamily-value'], ['link-value']]}
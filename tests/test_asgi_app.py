@@ -0,0 +1,58 @@
+import asyncio
+
+import asgi_app
+from admission import CHEAP
+from query_factory import get_tune_data
+
+
+async def get_all(paths):
+    responses = []
+    async with asgi_app.app.test_app() as test_app:
+        client = test_app.test_client()
+        for path in paths:
+            response = await client.get(path)
+            responses.append((response.status_code, await response.get_json()))
+    return responses
+
+
+def test_routes(sparql_server):
+    (tune, kg_version, corpus_list, titles, invalid_limit, composition) = asyncio.run(get_all([
+        '/api/tune_by_id?id=1',
+        '/api/kg_version',
+        '/api/corpus_list',
+        '/api/title_suggest?searchTerm=fi',
+        '/api/pattern_suggest?searchTerm=ab&limit=abc',
+        '/api/composition?id=1&excludeTrivialPatterns=true',
+    ]))
+    assert tune[0] == 200
+    assert tune[1]['results']['bindings'][0]['title']['value'] == 'title-value'
+    assert kg_version == (200, {'head': {'vars': ['version']},
+                                'results': {'bindings': [{'version': {'type': 'literal',
+                                                                      'value': 'version-value'}}]}})
+    assert corpus_list == (200, ['corpus-value'])
+    assert titles[0] == 200
+    assert [row['title']['value'] for row in titles[1]['results']['bindings']] == ['First Of May']
+    assert invalid_limit[0] == 400
+    assert composition[0] == 200
+    assert set(composition[1]) == {'tune', 'patterns', 'neighbour_patterns', 'neighbour_tunes'}
+
+
+async def execute_around_version_change(sparql_query, monkeypatch):
+    async with asgi_app.app.test_app():
+        first = asyncio.ensure_future(asgi_app.execute(sparql_query, CHEAP))
+        second = asyncio.ensure_future(asgi_app.execute(sparql_query, CHEAP))
+        await asyncio.sleep(0.05)
+        monkeypatch.setattr(asgi_app.response_cache, 'version', 'version-next')
+        third = asyncio.ensure_future(asgi_app.execute(sparql_query, CHEAP))
+        return await asyncio.gather(first, second, third)
+
+
+def test_coalesced_queries_are_keyed_on_the_version(sparql_server, monkeypatch):
+    sparql_server.delay = 0.3
+    responses = asyncio.run(execute_around_version_change(get_tune_data('in-flight-test'), monkeypatch))
+    assert all(response.status_code == 200 for response in responses)
+    # The first two share a call, and the one sent after the version changed
+    # makes its own.
+    assert responses[0] is responses[1]
+    assert sparql_server.count('in-flight-test') == 2
+    assert not asgi_app.queries_in_flight
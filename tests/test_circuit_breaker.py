@@ -0,0 +1,79 @@
+import api
+import app
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from query_factory import get_tune_data
+from response_cache import ResponseCache
+
+
+def test_breaker_opens_half_opens_and_closes(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    assert breaker.allow()
+    breaker.record_failure()
+    breaker.record_failure()
+    # A success resets the count of consecutive failures
+    breaker.record_success()
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    clock.advance(29.9)
+    assert not breaker.allow()
+    clock.advance(0.1)
+    # One call is let through as a probe, and the others still fail fast
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    # The probe failed: open again, for another reset_timeout
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock.advance(29.9)
+    assert not breaker.allow()
+    clock.advance(0.1)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow() and breaker.allow()
+    assert breaker.stats() == {'state': CLOSED, 'open': 0, 'failures': 0, 'rejected': 4}
+
+
+def test_breaker_probes_again_after_a_lost_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow()
+    # Until the probe reports back, no other call is let through
+    clock.advance(300)
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.closed
+
+
+def test_stale_results_of_any_age_are_served_while_open(clock, sparql_server):
+    api.start()
+    breaker = api.sparql_client.breaker
+    cache = ResponseCache(stale_grace=60)
+    cache.set_version('version-1')
+    sparql_query = get_tune_data('breaker-test')
+    body = b''.join(app.run_raw_query(sparql_query, cache))
+    assert sparql_server.count('breaker-test') == 1
+    # A new version, long past the grace period of the results of the last
+    cache.set_version('version-2')
+    clock.advance(3600)
+    try:
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        assert not breaker.closed
+        assert b''.join(app.run_raw_query(sparql_query, cache)) == body
+        # Without a cached result, the request fails fast
+        assert app.run_query(sparql_query, ResponseCache(stale_grace=60)) is None
+    finally:
+        breaker.record_success()
+    assert sparql_server.count('breaker-test') == 1
+    # Once the endpoint is back, it is queried rather than serving the old result
+    assert b''.join(app.run_raw_query(sparql_query, cache)) == body
+    assert sparql_server.count('breaker-test') == 2
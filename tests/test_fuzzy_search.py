@@ -0,0 +1,243 @@
+import gzip
+import json
+import random
+
+import pytest
+from fuzzywuzzy import process as fuzzy_process, utils as fuzzy_utils
+from werkzeug.datastructures import MultiDict
+
+import api
+import fuzzy_search as fuzzy_search_module
+from fuzzy_search import MAX_TITLE_SUGGEST_LIMIT, RAPIDFUZZ_EXHAUSTIVE_LENGTH, FuzzySearch
+
+WORDS = ['the', 'of', 'reel', 'jig', 'hornpipe', 'lady', 'mary', 'morning', 'star',
+         'foxhunters', 'may', 'cope', 'johnny', 'bonnie', 'kitty', 'rakes', 'kildare',
+         'drowsy', 'maggie', 'humours', 'glen', 'silver', 'spear', 'road', 'lisdoonvarna']
+# Words that fuzzywuzzy's processing strips or keeps, forcing them to ASCII.
+NON_ASCII_WORDS = ['Ó', 'Néill', 'Mór', 'Sí', 'Bheag', 'Caoineadh', 'Dónal', 'Ælfric', 'Ŵyn', 'Ðá']
+PUNCTUATION = ['', '', '', "'s", '!', ',', ' -', '.']
+
+
+def make_title(rng):
+    words = [rng.choice(NON_ASCII_WORDS if rng.random() < .15 else WORDS)
+             for _ in range(rng.randint(1, 5))]
+    if rng.random() < .1:
+        # Longer than the strings rapidfuzz searches exhaustively
+        while len(' '.join(words)) <= RAPIDFUZZ_EXHAUSTIVE_LENGTH:
+            words.append(rng.choice(WORDS))
+    title = ' '.join(word.capitalize() if rng.random() < .5 else word for word in words)
+    return title + rng.choice(PUNCTUATION)
+
+
+# Tune titles keyed by id, none of them normalizing to the same string.
+def make_names(rng, count):
+    names = {}
+    seen = set()
+    while len(names) < count:
+        title = make_title(rng)
+        processed = fuzzy_utils.full_process(title, force_ascii=True)
+        if processed and processed not in seen:
+            seen.add(processed)
+            names[f'http://example.org/tune/{len(names)}'] = title
+    return names
+
+
+# Tune titles keyed by id, some of them the same title as another, or a
+# variant of it differing in case, punctuation or spacing, which extractBests
+# scores separately and the index scores once.
+def make_names_with_duplicates(rng, count):
+    names = make_names(rng, count)
+    titles = list(names.values())
+    for title in rng.sample(titles, count // 3):
+        variant = rng.choice([title, title.upper(), title.lower(), f'{title}!', f' {title}', title.replace(' ', '  ')])
+        for _ in range(rng.randint(1, 3)):
+            names[f'http://example.org/tune/{len(names)}'] = variant
+    # Interleave the duplicates with the titles they duplicate
+    ids = list(names)
+    rng.shuffle(ids)
+    return {tune_id: names[tune_id] for tune_id in ids}
+
+
+def add_typo(rng, text):
+    if len(text) < 2:
+        return text + 'x'
+    i = rng.randrange(len(text))
+    edit = rng.choice(['delete', 'insert', 'replace', 'swap'])
+    if edit == 'delete':
+        return text[:i] + text[i + 1:]
+    if edit == 'insert':
+        return text[:i] + rng.choice('abcdefghij') + text[i:]
+    if edit == 'replace':
+        return text[:i] + rng.choice('klmnopqrst') + text[i + 1:]
+    i = min(i, len(text) - 2)
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+def make_query(rng, titles):
+    title = rng.choice(titles)
+    kind = rng.choice(['exact', 'typo', 'partial', 'word', 'non_ascii', 'long', 'unrelated'])
+    if kind == 'exact':
+        return title
+    if kind == 'typo':
+        return add_typo(rng, add_typo(rng, title))
+    if kind == 'partial':
+        words = title.split()
+        start = rng.randrange(len(words))
+        return ' '.join(words[start:start + rng.randint(1, 3)])
+    if kind == 'word':
+        return rng.choice(WORDS)
+    if kind == 'non_ascii':
+        return f'{rng.choice(NON_ASCII_WORDS)} {rng.choice(WORDS)}'
+    if kind == 'long':
+        return ' '.join(rng.choice(titles) for _ in range(4))
+    # Only matches after the cutoff has been halved, if at all
+    return ''.join(rng.choice('qxzvwjk') for _ in range(rng.randint(2, 6)))
+
+
+# get_title_best_match as it was before the index: extractBests over every
+# title, retrying with a halved cutoff until there is a match.
+def extract_bests(names, title, score_cutoff=60, limit=None, retry_till_match=True, max_retries=3):
+    best_matches = fuzzy_process.extractBests(title, names, score_cutoff=score_cutoff, limit=limit)
+    retry_count = 0
+    while not best_matches and retry_till_match and retry_count < max_retries:
+        retry_count += 1
+        score_cutoff /= 2
+        best_matches = fuzzy_process.extractBests(title, names, score_cutoff=score_cutoff, limit=limit)
+    return best_matches, retry_count
+
+
+def make_fuzzy_search(tmp_path, names):
+    snapshot_path = tmp_path / 'tune_names_snapshot.json.gz'
+    with gzip.open(snapshot_path, 'wt', encoding='utf-8') as snapshot_file:
+        json.dump({'version': 'version-value', 'names': names}, snapshot_file)
+    # FuzzySearch is a singleton; its class is used to search other titles.
+    return FuzzySearch.__wrapped__(None, 'version-value', str(snapshot_path))
+
+
+def check_matches(tmp_path, rng, names, queries):
+    fuzzy_search = make_fuzzy_search(tmp_path, names)
+    titles = list(names.values())
+    retried = 0
+    for _ in range(queries):
+        query = make_query(rng, titles)
+        # With a limit, extractBests returns the first matches of the sorted
+        # list it returns without one.
+        expected, retry_count = extract_bests(names, query)
+        retried += retry_count > 0
+        for limit in (None, 50, 3):
+            assert fuzzy_search.get_title_best_match(query, limit=limit) == expected[:limit], (query, limit)
+    # The sample includes queries that only match with a lower cutoff
+    assert retried
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matches_extract_bests(tmp_path, seed):
+    rng = random.Random(seed)
+    check_matches(tmp_path, rng, make_names(rng, 250), 120)
+
+
+@pytest.mark.parametrize('seed', [3, 4])
+def test_duplicate_titles_match_extract_bests(tmp_path, seed):
+    rng = random.Random(seed)
+    check_matches(tmp_path, rng, make_names_with_duplicates(rng, 180), 100)
+
+
+# Answers the title query with the given titles.
+class TitlesClient:
+    def __init__(self, names):
+        self.names = names
+
+    def iter_bindings(self, sparql_query):
+        return ({'id': {'value': tune_id}, 'title': {'value': title}} for tune_id, title in self.names.items())
+
+
+def test_refresh_drops_cached_matches(tmp_path):
+    fuzzy_search = make_fuzzy_search(tmp_path, {'1': 'The Foxhunters', '2': 'First Of May'})
+    assert fuzzy_search.get_title_best_match('foxhunters') == [('The Foxhunters', 95, '1')]
+    assert fuzzy_search.get_title_best_match('Foxhunters') == [('The Foxhunters', 95, '1')]
+    assert fuzzy_search.match_cache_stats() == {'entries': 1, 'hits': 1, 'misses': 1}
+    fuzzy_search.sparql_client = TitlesClient({'3': 'Foxhunters', '2': 'First Of May'})
+    fuzzy_search.refresh('version-2')
+    assert fuzzy_search.match_cache_stats()['entries'] == 0
+    assert fuzzy_search.get_title_best_match('foxhunters') == [('Foxhunters', 100, '3')]
+    assert fuzzy_search.match_cache_stats() == {'entries': 1, 'hits': 1, 'misses': 2}
+
+
+# The titles suggested for the text typed, found by going through every
+# title: those with a word starting with the normalized text, those starting
+# with it first, then shorter titles first, then in string order. Titles
+# normalizing to the same string come together, in the order of names.
+def suggest_titles(names, text, limit):
+    query = fuzzy_utils.full_process(fuzzy_utils.full_process(text), force_ascii=True)
+    if not query:
+        return []
+    if text[-1:].isspace():
+        query += ' '
+    ranks = {}
+    members = {}
+    for tune_id, title in names.items():
+        processed = fuzzy_utils.full_process(title, force_ascii=True)
+        members.setdefault(processed, []).append((title, tune_id))
+        starts = [i for i, char in enumerate(processed) if char != ' ' and (i == 0 or processed[i - 1] == ' ')]
+        matches = [start for start in starts if (processed[start:] + ' ').startswith(query)]
+        if matches:
+            ranks[processed] = (min(matches) > 0, len(processed), processed)
+    suggestions = [suggestion for processed in sorted(ranks, key=ranks.get) for suggestion in members[processed]]
+    return suggestions[:limit]
+
+
+def make_typed_texts(rng, titles):
+    texts = ['', ' ', 'zzz', 'the ', 'Ó']
+    for _ in range(80):
+        title = rng.choice(titles)
+        words = title.split()
+        start = rng.randrange(len(words))
+        text = ' '.join(words[start:])
+        texts.append(text[:rng.randint(1, len(text))])
+    return texts
+
+
+@pytest.mark.parametrize('seed', [5, 6])
+def test_suggest_titles_match_full_scan(tmp_path, seed):
+    rng = random.Random(seed)
+    names = make_names_with_duplicates(rng, 300)
+    fuzzy_search = make_fuzzy_search(tmp_path, names)
+    for text in make_typed_texts(rng, list(names.values())):
+        for limit in (1, 3, 10, MAX_TITLE_SUGGEST_LIMIT):
+            assert fuzzy_search.suggest_titles(text, limit) == suggest_titles(names, text, limit), (text, limit)
+
+
+def test_remembered_title_suggestions_match_full_scan(tmp_path, monkeypatch):
+    # Every search is worked out up to the largest limit and remembered.
+    monkeypatch.setattr(fuzzy_search_module, 'REMEMBER_RANGE', 0)
+    rng = random.Random(7)
+    names = make_names_with_duplicates(rng, 300)
+    fuzzy_search = make_fuzzy_search(tmp_path, names)
+    for text in make_typed_texts(rng, list(names.values()))[:40]:
+        for limit in (MAX_TITLE_SUGGEST_LIMIT, 3, 10):
+            assert fuzzy_search.suggest_titles(text, limit) == suggest_titles(names, text, limit), (text, limit)
+
+
+def test_suggest_titles_by_word(tmp_path):
+    fuzzy_search = make_fuzzy_search(tmp_path, {
+        '1': 'The Foxhunters', '2': 'Foxhunters Reel', '3': 'The Fox', '4': 'Fox',
+        '5': 'Silver Spear', '6': 'The  Silver Spear', '7': 'FOX'})
+    # Titles starting with the text, shorter ones first, then those with a
+    # later word starting with it
+    assert fuzzy_search.suggest_titles('fox', 10) == [
+        ('Fox', '4'), ('FOX', '7'), ('Foxhunters Reel', '2'), ('The Fox', '3'), ('The Foxhunters', '1')]
+    # A space ends the last word
+    assert fuzzy_search.suggest_titles('fox ', 10) == [('Fox', '4'), ('FOX', '7'), ('The Fox', '3')]
+    assert fuzzy_search.suggest_titles('spe', 10) == [('Silver Spear', '5'), ('The  Silver Spear', '6')]
+    assert fuzzy_search.suggest_titles('silver spear', 10) == [('Silver Spear', '5'), ('The  Silver Spear', '6')]
+    assert fuzzy_search.suggest_titles('fox', 2) == [('Fox', '4'), ('FOX', '7')]
+    assert fuzzy_search.suggest_titles('oxh', 10) == []
+
+
+def test_title_suggest_limit_is_capped(tmp_path, monkeypatch):
+    names = {str(i): f'Reel number {i}' for i in range(80)}
+    monkeypatch.setattr(api, 'fuzzy_search', make_fuzzy_search(tmp_path, names))
+    for limit, count in (('500', MAX_TITLE_SUGGEST_LIMIT), ('0', 1), ('7', 7)):
+        plan = api.getTitleSuggestions(MultiDict({'searchTerm': 'reel', 'limit': limit}))
+        assert isinstance(plan, api.Answer)
+        assert len(plan.result['results']['bindings']) == count
@@ -0,0 +1,334 @@
+import json
+import time
+
+import numpy as np
+import pytest
+
+pyoxigraph = pytest.importorskip('pyoxigraph')
+
+from facet_index import FacetIndex
+from local_store import LocalSparqlClient
+from pattern_index import PatternIndex, read_version
+from pattern_suggest import PREFIX, SUBSTRING
+from query_factory import (advanced_search, get_most_common_patterns_for_a_tune, get_pattern_search_query,
+                           get_pattern_suggestions, get_patterns_in_common_between_two_tunes,
+                           get_ranked_patterns_by_tune)
+
+# The index is checked against the queries it replaces, run on a small fixed
+# knowledge graph in the embedded store. The graph has ties in the pattern
+# counts, trivial patterns and one without a complexity, an untitled tune, a
+# tune with two keys, tunes in several corpora or none, and a tune without
+# an annotation.
+
+PREFIXES = """@prefix jams: <http://w3id.org/polifonia/ontology/jams/> .
+@prefix mm: <http://w3id.org/polifonia/ontology/music-meta/> .
+@prefix core: <http://w3id.org/polifonia/ontology/core/> .
+@prefix xyz: <http://sparql.xyz/facade-x/data/> .
+@prefix tunes: <http://w3id.org/polifonia/ontology/tunes/> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+@prefix ex: <http://example.org/> .
+"""
+ELECTRONIC_COLLECTION = '<http://w3id.org/polifonia/resource/tunes/CollectionConcept/ElectronicCollection>'
+
+# Pattern content and complexity (None if it has none). Those at or below 0.4
+# are trivial.
+PATTERNS = {
+    '1 2 3 4': 0.8,
+    '2 3 4 5': 0.3,
+    '3 3 3': 0.4,
+    '5 4 3 2': None,
+    '1 1 1 1': 0.9,
+    '6 5 4': 0.55,
+    '2 2 1': 0.6,
+}
+# More patterns than the 18 most common ones returned, with ties.
+PATTERNS.update({f'7 {i}': 0.5 + (i % 3) / 10 for i in range(22)})
+
+# Tune id, title, tune type, keys, time signature, corpora, families and the
+# number of times each pattern occurs in each of its annotations (None if it
+# has no annotation).
+TUNES = [
+    ('t1', 'The Foxhunters', 'reel', ['D'], '4/4', ['Session'], ['Fox'],
+     [{'1 2 3 4': 2, '2 3 4 5': 2, '5 4 3 2': 1}, {'1 2 3 4': 1, '3 3 3': 1, '5 4 3 2': 1, '2 2 1': 2}]),
+    ('t2', 'First Of May', 'jig', ['G'], '6/8', ['Session', 'ONeill'], [],
+     [{'1 2 3 4': 1, '2 3 4 5': 2, '1 1 1 1': 1, '2 2 1': 3}]),
+    ('t3', None, 'reel', ['D'], '4/4', ['ONeill'], [],
+     [{'1 2 3 4': 2, '3 3 3': 2, '6 5 4': 2}]),
+    ('t4', 'Johnny Cope', 'hornpipe', ['D', 'A'], '4/4', ['Ceol Rince'], ['Fox'],
+     [{'2 3 4 5': 1, '5 4 3 2': 1, '6 5 4': 4, '1 2 3 4': 1}]),
+    ('t5', 'Abbey Reel', 'reel', [], None, [], [],
+     [{'1 2 3 4': 1, '6 5 4': 1, '2 2 1': 1}]),
+    ('t6', 'Zebra', 'jig', ['G'], '6/8', ['Session'], [], None),
+    ('t7', 'Abbey Reel', 'jig', ['A'], '6/8', ['ONeill'], [],
+     [{'1 1 1 1': 2, '2 2 1': 1}]),
+    ('t8', 'Long Tune', 'reel', ['G'], '4/4', ['Session'], [],
+     [{f'7 {i}': 1 + i % 4 for i in range(22)} | {'1 2 3 4': 3}]),
+]
+TUNE_IDS = [tune[0] for tune in TUNES]
+
+
+def literal(value):
+    return json.dumps(value)
+
+
+def make_turtle():
+    lines = [PREFIXES]
+    for position, (pattern, complexity) in enumerate(PATTERNS.items()):
+        lines.append(f'ex:pattern{position} xyz:pattern_content {literal(pattern)} .')
+        if complexity is not None:
+            lines.append(f'ex:pattern{position} xyz:pattern_complexity "{complexity}"^^xsd:float .')
+    positions = {pattern: position for position, pattern in enumerate(PATTERNS)}
+    corpora = sorted({corpus for tune in TUNES for corpus in tune[5]})
+    for corpus in corpora:
+        lines.append(f'ex:corpus-{corpus.replace(" ", "")} core:isDefinedBy {ELECTRONIC_COLLECTION} ; '
+                     f'core:name {literal(corpus)} .')
+    # A collection that isn't a corpus of the advanced search
+    lines.append('ex:printed core:name "Printed" .')
+    lines.append('ex:family-Fox a tunes:TuneFamily ; mm:tuneFamilyName "Fox" .')
+    for tune_id, title, tune_type, keys, signature, tune_corpora, families, annotations in TUNES:
+        tune = f'ex:{tune_id}'
+        lines.append(f'{tune} a mm:MusicEntity ; core:id {literal(tune_id)} ; core:isMemberOf ex:printed .')
+        if title is not None:
+            lines.append(f'{tune} core:title {literal(title)} .')
+        lines.append(f'{tune} mm:hasFormType ex:type-{tune_type} . ex:type-{tune_type} core:name {literal(tune_type)} .')
+        for key in keys:
+            lines.append(f'{tune} mm:hasKey ex:key-{key} . ex:key-{key} mm:tuneKeyName {literal(key)} .')
+        if signature is not None:
+            name = signature.replace('/', '-')
+            lines.append(f'{tune} jams:timeSignature ex:sig-{name} . ex:sig-{name} mm:timesig {literal(signature)} .')
+        for corpus in tune_corpora:
+            lines.append(f'{tune} core:isMemberOf ex:corpus-{corpus.replace(" ", "")} .')
+        for family in families:
+            lines.append(f'{tune} core:isMemberOf ex:family-{family} .')
+        for number, counts in enumerate(annotations or []):
+            annotation = f'ex:annotation-{tune_id}-{number}'
+            lines.append(f'{annotation} jams:isJAMSAnnotationOf {tune} .')
+            for pattern, count in counts.items():
+                for occurrence in range(count):
+                    observation = f'ex:observation-{tune_id}-{number}-{positions[pattern]}-{occurrence}'
+                    lines.append(f'{annotation} jams:includesObservation {observation} . '
+                                 f'{observation} jams:ofPattern ex:pattern{positions[pattern]} .')
+    return '\n'.join(lines)
+
+
+@pytest.fixture(scope='module')
+def sparql_client(tmp_path_factory):
+    store_path = str(tmp_path_factory.mktemp('store'))
+    store = pyoxigraph.Store(store_path)
+    store.load(make_turtle(), format=pyoxigraph.RdfFormat.TURTLE)
+    store.flush()
+    del store
+    return LocalSparqlClient(store_path)
+
+
+# The index as the job builds it, and as the workers load it from the file
+# the job saves.
+@pytest.fixture(scope='module', params=['built', 'loaded'])
+def pattern_index(request, sparql_client, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('index') / 'pattern_index.npz')
+    # Pages smaller than the exports, so that they are read in several
+    pattern_index = PatternIndex(sparql_client, page_size=7, path=path)
+    pattern_index.refresh('version-1')
+    assert pattern_index.ready
+    if request.param == 'built':
+        return pattern_index
+    pattern_index.save()
+    loaded = PatternIndex(None, path=path)
+    loaded.set_version('version-1')
+    loaded.load()
+    assert loaded.ready
+    return loaded
+
+
+def query(sparql_client, sparql_query):
+    response = sparql_client.query(sparql_query)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+# Results ordered by title and id, whose rows for the same tune (one per key
+# of a tune with several) can come in any order.
+def assert_same_tunes(result, expected):
+    assert result['head'] == expected['head']
+    rows, expected_rows = result['results']['bindings'], expected['results']['bindings']
+
+    def tune(row):
+        return row['title']['value'] if 'title' in row else None, row['id']['value']
+
+    assert [tune(row) for row in rows] == [tune(row) for row in expected_rows]
+    assert sorted(json.dumps(row, sort_keys=True) for row in rows) == \
+        sorted(json.dumps(row, sort_keys=True) for row in expected_rows)
+
+
+def test_occurrences_match_the_graph(pattern_index):
+    index = pattern_index.index
+    assert sorted(index.tune_ids) == sorted(tune_id for tune_id, *_, annotations in TUNES if annotations)
+    for tune_id, *_, annotations in TUNES:
+        if not annotations:
+            continue
+        expected = {}
+        for counts in annotations:
+            for pattern, count in counts.items():
+                expected[pattern] = expected.get(pattern, 0) + count
+        columns, counts = index.tune(tune_id)
+        # The rows are in pattern column order, and the columns of each
+        # pattern hold the same counts.
+        assert list(columns) == sorted(columns)
+        assert {index.patterns[column]: int(count) for column, count in zip(columns, counts)} == expected
+        for column, count in zip(columns, counts):
+            rows, pattern_counts = index.pattern(index.patterns[column])
+            assert list(rows) == sorted(rows)
+            assert int(pattern_counts[list(rows).index(index.tune_ids[tune_id])]) == count
+
+
+@pytest.mark.parametrize('exclude', ['true', 'false'])
+@pytest.mark.parametrize('tune_id', TUNE_IDS + ['missing'])
+def test_most_common_patterns(sparql_client, pattern_index, tune_id, exclude):
+    expected = query(sparql_client, get_most_common_patterns_for_a_tune(tune_id, exclude))
+    assert pattern_index.most_common_patterns(tune_id, exclude) == expected
+
+
+def test_most_common_patterns_are_limited(sparql_client, pattern_index):
+    result = pattern_index.most_common_patterns('t8', 'false')
+    assert len(result['results']['bindings']) == 18
+    assert result == query(sparql_client, get_most_common_patterns_for_a_tune('t8', 'false'))
+
+
+@pytest.mark.parametrize('exclude', ['true', 'false'])
+@pytest.mark.parametrize('tune_id', TUNE_IDS)
+def test_common_patterns(sparql_client, pattern_index, tune_id, exclude):
+    for prev in TUNE_IDS + ['missing']:
+        expected = query(sparql_client, get_patterns_in_common_between_two_tunes(tune_id, prev, exclude))
+        assert pattern_index.common_patterns(tune_id, prev, exclude) == expected, prev
+
+
+@pytest.mark.parametrize('exclude', ['true', 'false'])
+@pytest.mark.parametrize('tune_id', TUNE_IDS + ['missing'])
+def test_ranked_patterns(sparql_client, pattern_index, tune_id, exclude):
+    expected = query(sparql_client, get_ranked_patterns_by_tune(tune_id, exclude))
+    assert pattern_index.ranked_patterns(tune_id, exclude) == expected
+
+
+@pytest.mark.parametrize('pattern', list(PATTERNS) + ['9 9 9'])
+def test_tunes_by_pattern(sparql_client, pattern_index, pattern):
+    expected = query(sparql_client, get_pattern_search_query(pattern))
+    assert_same_tunes(pattern_index.tunes_by_pattern(pattern), expected)
+
+
+@pytest.mark.parametrize('match', [PREFIX, SUBSTRING])
+@pytest.mark.parametrize('term', ['', '1', '1 2', '7 1', '3', '4 3', '9',
+                                  # Escaped in the query
+                                  '"', '1\\', '1\n2', '1 2\r', '\t', '\x00', '1\x1b 2', '\x7f'])
+def test_suggest_patterns(sparql_client, pattern_index, term, match):
+    for limit in (1, 5, 50):
+        expected = query(sparql_client, get_pattern_suggestions(term, match, limit))
+        assert pattern_index.suggest_patterns(term, match, limit) == expected, limit
+
+
+def test_graph_covers_the_cases(sparql_client, pattern_index):
+    # Ties, rows of an untitled tune and of a tune with two keys are compared
+    ranked = pattern_index.ranked_patterns('t8', 'false')['results']['bindings']
+    assert len(ranked) == 23
+    rows = pattern_index.tunes_by_pattern('1 2 3 4')['results']['bindings']
+    assert [row['id']['value'] for row in rows][:1] == ['t3']
+    assert [row['key']['value'] for row in rows if row['id']['value'] == 't4'] in (['D', 'A'], ['A', 'D'])
+
+
+# The (title, score, id) matches of a title search, including one whose title
+# isn't the tune's.
+MATCHED_IDS = [('Abbey Reel', 90, 't5'), ('Abbey Reel', 90, 't7'), ('The Foxhunters', 72, 't1'),
+               ('Johnny Cope', 72, 't4'), ('First Of May?', 60, 't2')]
+ADVANCED_SEARCHES = {
+    'no filters': {},
+    'or within a corpus': {'corpus': ['Session', 'ONeill']},
+    'or within a tune type': {'tuneType': ['jig', 'hornpipe']},
+    'or within a key': {'key': ['A', 'G']},
+    'and across filters': {'tuneType': ['reel', 'hornpipe'], 'key': ['D'], 'timeSignature': ['4/4']},
+    'and across corpus and key': {'corpus': ['Session', 'Ceol Rince'], 'key': ['D', 'A']},
+    'unknown value': {'key': ['D', 'Bb']},
+    'pattern': {'pattern': ['1 2 3 4']},
+    'pattern and filters': {'pattern': ['1 2 3 4'], 'corpus': ['ONeill', 'Ceol Rince'], 'timeSignature': ['4/4']},
+    'title': {'title': ['abbey']},
+    'title and filters': {'title': ['abbey'], 'tuneType': ['reel', 'jig'], 'corpus': ['ONeill', 'Session']},
+    'pattern, title and filters': {'pattern': ['2 2 1'], 'title': ['abbey'], 'tuneType': ['reel', 'jig']},
+}
+
+
+@pytest.mark.parametrize('search', ADVANCED_SEARCHES)
+def test_advanced_search(sparql_client, pattern_index, search):
+    # As the handler reads them, with an empty pattern and title if they
+    # aren't searched for.
+    query_params = {'pattern': [''], 'title': [''], **ADVANCED_SEARCHES[search]}
+    expected = query(sparql_client, advanced_search(query_params, MATCHED_IDS))
+    assert expected['results']['bindings'] or search == 'unknown value'
+    assert_same_tunes(pattern_index.advanced_search(query_params, MATCHED_IDS), expected)
+
+
+def test_advanced_search_filters(pattern_index):
+    def tunes(**query_params):
+        result = pattern_index.advanced_search({'pattern': [''], 'title': [''], **query_params}, MATCHED_IDS)
+        return sorted({row['id']['value'] for row in result['results']['bindings']})
+
+    # Only the tunes with an annotation are found.
+    assert tunes() == ['t1', 't2', 't3', 't4', 't5', 't7', 't8']
+    # Values of a filter are ORed, and filters ANDed.
+    assert tunes(corpus=['Session']) == ['t1', 't2', 't8']
+    assert tunes(corpus=['Session', 'Ceol Rince']) == ['t1', 't2', 't4', 't8']
+    assert tunes(corpus=['Session', 'Ceol Rince'], key=['D', 'A']) == ['t1', 't4']
+    assert tunes(corpus=['Printed']) == []
+    # Then narrowed down to the tunes containing the pattern and the matched
+    # titles.
+    assert tunes(key=['D', 'A'], pattern=['1 2 3 4']) == ['t1', 't3', 't4']
+    assert tunes(key=['D', 'A'], pattern=['1 2 3 4'], title=['cope']) == ['t1', 't4']
+    assert tunes(title=['abbey'], pattern=['2 2 1']) == ['t1', 't5', 't7']
+    assert tunes(title=['abbey'], pattern=['2 2 1'], corpus=['ONeill']) == ['t7']
+
+
+# A worker only uses the index saved for the current KG version, and picks
+# up a new file when the version changes.
+def test_loaded_index_follows_the_version(sparql_client, tmp_path):
+    path = str(tmp_path / 'pattern_index.npz')
+    built = PatternIndex(sparql_client, path=path)
+    built.refresh('version-1')
+    built.save()
+    assert read_version(path) == 'version-1'
+
+    loaded = PatternIndex(None, path=path)
+    loaded.start('version-1')
+    deadline = time.monotonic() + 5
+    while not loaded.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert loaded.most_common_patterns('t1', 'false') == built.most_common_patterns('t1', 'false')
+    # The file isn't for the new version
+    loaded.set_version('version-2')
+    assert not loaded.ready
+    assert loaded.most_common_patterns('t1', 'false') is None
+
+    built.refresh('version-2')
+    built.save()
+    loaded.load()
+    assert loaded.version == 'version-2'
+    assert loaded.most_common_patterns('t1', 'false') == built.most_common_patterns('t1', 'false')
+
+
+# The workers load the facet bitsets the job built, rather than build them
+# again from the tune rows.
+def test_facet_bitsets_are_loaded(sparql_client, tmp_path, monkeypatch):
+    path = str(tmp_path / 'pattern_index.npz')
+    built = PatternIndex(sparql_client, path=path)
+    built.refresh('version-1')
+    built.save()
+
+    def build(*args):
+        raise AssertionError('The facet index was built again')
+    monkeypatch.setattr(FacetIndex, '__init__', build)
+    loaded = PatternIndex(None, path=path)
+    loaded.load()
+    facets, expected = loaded.index.facets, built.index.facets
+    assert facets.tune_ids == expected.tune_ids
+    np.testing.assert_array_equal(facets.annotated, expected.annotated)
+    assert {facet: sorted(values) for facet, values in facets.bitsets.items()} == \
+        {facet: sorted(values) for facet, values in expected.bitsets.items()}
+    for facet, values in expected.bitsets.items():
+        for value, bitset in values.items():
+            np.testing.assert_array_equal(facets.bitsets[facet][value], bitset, err_msg=(facet, value))
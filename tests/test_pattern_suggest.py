@@ -0,0 +1,108 @@
+import random
+
+import numpy as np
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import api
+import pattern_suggest
+from pattern_index import OccurrenceIndex, PatternIndex
+from pattern_suggest import MAX_SUGGEST_LIMIT, PREFIX, SUBSTRING, PatternSuggestIndex
+
+LIMITS = [1, 3, 10, MAX_SUGGEST_LIMIT]
+
+
+# Distinct random patterns, as space separated scale degrees, and their
+# frequencies in the corpus, with many ties and some that occur nowhere.
+def make_patterns(rng, count=400):
+    patterns = set()
+    while len(patterns) < count:
+        patterns.add(' '.join(str(rng.randint(1, 9)) for _ in range(rng.randint(2, 7))))
+    patterns = sorted(patterns, key=lambda _: rng.random())
+    frequencies = np.array([rng.choice([0, 1, 1, 2, 3, 5, 8]) for _ in patterns], dtype=np.int64)
+    return patterns, frequencies
+
+
+def make_terms(rng, patterns):
+    terms = ['', '1', '9 9 9 9 9 9 9 9', '0', ' ']
+    for _ in range(60):
+        pattern = rng.choice(patterns)
+        start = rng.randrange(len(pattern))
+        terms.append(pattern[:rng.randint(1, len(pattern))])
+        terms.append(pattern[start:start + rng.randint(1, 5)])
+    return terms
+
+
+# The most frequent patterns starting with or containing term, ties in string
+# order, found by going through every pattern.
+def brute_force(patterns, frequencies, term, match, limit):
+    found = [(pattern, int(frequency)) for pattern, frequency in zip(patterns, frequencies)
+             if frequency > 0 and (term in pattern if match == SUBSTRING else pattern.startswith(term))]
+    return sorted(found, key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def suggest(index, patterns, term, match, limit):
+    columns, frequencies = index.suggest(term, match, limit)
+    return [(patterns[column], int(frequency)) for column, frequency in zip(columns, frequencies)]
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_suggestions_match_brute_force(seed):
+    rng = random.Random(seed)
+    patterns, frequencies = make_patterns(rng)
+    index = PatternSuggestIndex(patterns, frequencies)
+    for term in make_terms(rng, patterns):
+        for match in (PREFIX, SUBSTRING):
+            for limit in LIMITS:
+                expected = brute_force(patterns, frequencies, term, match, limit)
+                assert suggest(index, patterns, term, match, limit) == expected, (term, match, limit)
+
+
+def test_remembered_suggestions_match_brute_force(monkeypatch):
+    # Every search is ranked up to the largest limit and remembered.
+    monkeypatch.setattr(pattern_suggest, 'REMEMBER_RANGE', 0)
+    rng = random.Random(3)
+    patterns, frequencies = make_patterns(rng)
+    index = PatternSuggestIndex(patterns, frequencies)
+    for term in make_terms(rng, patterns)[:40]:
+        for match in (PREFIX, SUBSTRING):
+            for limit in (MAX_SUGGEST_LIMIT, 3, 10):
+                expected = brute_force(patterns, frequencies, term, match, limit)
+                assert suggest(index, patterns, term, match, limit) == expected, (term, match, limit)
+    assert index._remembered
+
+
+def test_substring_matches_inside_patterns():
+    patterns = ['1 2 3', '2 3 4', '3 4 5', '4 5 1 2']
+    index = PatternSuggestIndex(patterns, np.array([1, 4, 2, 3]))
+    assert suggest(index, patterns, '2 3', PREFIX, 10) == [('2 3 4', 4)]
+    assert suggest(index, patterns, '2 3', SUBSTRING, 10) == [('2 3 4', 4), ('1 2 3', 1)]
+    assert suggest(index, patterns, '1 2', SUBSTRING, 10) == [('4 5 1 2', 3), ('1 2 3', 1)]
+    # A match doesn't run on from the end of a pattern into the next one
+    assert suggest(index, patterns, '3 2', SUBSTRING, 10) == []
+    assert suggest(index, patterns, '2 3 4 5', SUBSTRING, 10) == []
+
+
+def test_limit_is_capped():
+    rng = random.Random(4)
+    patterns, frequencies = make_patterns(rng)
+    occurrences = [(f'tune-{i}', pattern, int(frequency))
+                   for i, (pattern, frequency) in enumerate(zip(patterns, frequencies)) if frequency > 0]
+    pattern_index = PatternIndex(None)
+    pattern_index._index = OccurrenceIndex(occurrences, {}, {}, {}, [])
+    for match in (PREFIX, SUBSTRING):
+        bindings = pattern_index.suggest_patterns('', match, 500)['results']['bindings']
+        assert [(binding['pattern']['value'], int(binding['patternFreq']['value'])) for binding in bindings] == \
+            brute_force(patterns, frequencies, '', match, MAX_SUGGEST_LIMIT)
+        assert len(pattern_index.suggest_patterns('', match, 0)['results']['bindings']) == 1
+
+
+
+# Until the index is loaded there are no suggestions, rather than a query to
+# the endpoint for every key pressed.
+def test_no_suggestions_without_index():
+    api.start()
+    assert api.pattern_index.index is None
+    plan = api.getPatternSuggestions(MultiDict({'searchTerm': '1', 'match': SUBSTRING, 'limit': '500'}))
+    assert isinstance(plan, api.Answer)
+    assert plan.result == {'head': {'vars': ['pattern', 'patternFreq']}, 'results': {'bindings': []}}
@@ -0,0 +1,61 @@
+from response_cache import ResponseCache
+
+
+def make_cache(max_age=None):
+    cache = ResponseCache(max_bytes=1000, max_entry_bytes=100, max_age=max_age, stale_grace=60)
+    cache.set_version('v1')
+    return cache
+
+
+def test_expired_results_are_stale_for_the_grace_period(clock):
+    cache = make_cache(max_age=10)
+    cache.put('q', 'result', 10, 'v1')
+    clock.advance(10)
+    assert cache.get('q') == 'result'
+    # A fresh result is left to get()
+    assert cache.get_stale('q') is None
+    clock.advance(1)
+    assert cache.get('q') is None
+    assert cache.get_stale('q') == 'result'
+    clock.advance(60)
+    assert cache.get_stale('q') is None
+    assert cache.stats()['stale_hits'] == 1
+
+
+def test_results_of_any_age_are_served_when_asked_for(clock):
+    cache = make_cache(max_age=10)
+    cache.put('q', 'result', 10, 'v1')
+    clock.advance(10 + 60 + 3600)
+    assert cache.get('q') is None
+    assert cache.get_stale('q') is None
+    assert cache.get_stale('q', any_age=True) == 'result'
+    # It is still there for the next time the endpoint is unavailable
+    assert cache.get_stale('q', any_age=True) == 'result'
+    assert cache.stats()['entries'] == 1
+
+
+def test_previous_version_is_stale_for_the_grace_period(clock):
+    cache = make_cache()
+    cache.put('q', 'old result', 10, 'v1')
+    cache.put('r', 'other result', 10, 'v1')
+    cache.set_version('v2')
+    assert cache.get('q') is None
+    assert cache.get_stale('q') == 'old result'
+    # A result stored for the new version replaces the old one
+    cache.put('q', 'new result', 10, 'v2')
+    assert cache.get('q') == 'new result'
+    assert cache.stats()['entries'] == 2
+    clock.advance(61)
+    assert cache.get_stale('r', any_age=True) == 'other result'
+    # Past the grace period, the previous version is dropped
+    assert cache.get_stale('r') is None
+    assert cache.get_stale('r', any_age=True) is None
+    assert cache.stats()['entries'] == 1
+
+
+def test_results_racing_a_version_change_are_dropped(clock):
+    cache = make_cache()
+    cache.set_version('v2')
+    cache.put('q', 'old result', 10, 'v1')
+    assert cache.get('q') is None
+    assert cache.get_stale('q', any_age=True) is None
@@ -0,0 +1,71 @@
+import asyncio
+
+import httpx
+import pytest
+import requests
+
+from async_sparql_client import AsyncSparqlClient
+from query_factory import get_tune_data
+from sparql_client import SparqlClient
+
+
+def test_read_timeouts_are_not_retried(sparql_server):
+    sparql_server.delay = 0.5
+    client = SparqlClient(sparql_server.url, read_timeout=0.1, max_retries=2, backoff_factor=0)
+    with pytest.raises(requests.RequestException):
+        client.query(get_tune_data('read-timeout-test'))
+    assert sparql_server.count('read-timeout-test') == 1
+
+
+def test_gateway_errors_are_retried(sparql_server):
+    sparql_server.status = 503
+    client = SparqlClient(sparql_server.url, max_retries=2, backoff_factor=0)
+    assert client.query(get_tune_data('gateway-error-test')).status_code == 503
+    assert sparql_server.count('gateway-error-test') == 3
+
+
+def test_connection_errors_are_retried():
+    retry = SparqlClient('http://127.0.0.1:9/sparql', max_retries=2).session.get_adapter('http://').max_retries
+    assert (retry.total, retry.connect, retry.read, retry.status) == (2, 2, 0, 2)
+
+
+async def query_async(client, sparql_query):
+    try:
+        return await client.query(sparql_query)
+    finally:
+        await client.aclose()
+
+
+def test_async_read_timeouts_are_not_retried(sparql_server):
+    sparql_server.delay = 0.5
+    client = AsyncSparqlClient(sparql_server.url, read_timeout=0.1, max_retries=2, backoff_factor=0)
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(query_async(client, get_tune_data('async-read-timeout-test')))
+    assert sparql_server.count('async-read-timeout-test') == 1
+
+
+def test_async_gateway_errors_are_retried(sparql_server):
+    sparql_server.status = 504
+    client = AsyncSparqlClient(sparql_server.url, max_retries=2, backoff_factor=0)
+    response = asyncio.run(query_async(client, get_tune_data('async-gateway-error-test')))
+    assert response.status_code == 504
+    assert sparql_server.count('async-gateway-error-test') == 3
+
+
+def test_async_connection_errors_are_retried(sparql_server):
+    client = AsyncSparqlClient(sparql_server.url, max_retries=2, backoff_factor=0)
+    attempts = []
+    post = client.client.post
+
+    # Fails to connect twice, then gets through
+    async def connect(*args, **kwargs):
+        attempts.append(args)
+        if len(attempts) <= 2:
+            raise httpx.ConnectError('Connection refused')
+        return await post(*args, **kwargs)
+
+    client.client.post = connect
+    response = asyncio.run(query_async(client, get_tune_data('async-connect-test')))
+    assert response.status_code == 200
+    assert len(attempts) == 3
+    assert sparql_server.count('async-connect-test') == 1
@@ -0,0 +1,127 @@
+import asyncio
+import gzip
+import json
+import time
+
+import app as flask_app
+
+
+# A HEAD request, whose body is never read, mustn't leave its flight
+# unfinished, or the next callers of the same query wait
+# SINGLE_FLIGHT_TIMEOUT seconds for it. Flask-Compress replaces the body of a
+# compressed response with its own.
+def test_head_request_finishes_flight(sparql_server):
+    client = flask_app.app.test_client()
+    response = client.head('/api/tune_by_id?id=head', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.status_code == 200
+    assert not flask_app.query_flights._flights
+    response.close()
+    start = time.perf_counter()
+    response = client.get('/api/tune_by_id?id=head', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.status_code == 200
+    assert time.perf_counter() - start < 1
+    assert sparql_server.count('core:id "head"') == 1
+
+
+# A result small enough to be cached is read and cached before it is sent,
+# so a client that goes away neither holds up the callers of the same query
+# nor keeps them from the result.
+def test_abandoned_body_finishes_flight(sparql_server):
+    client = flask_app.app.test_client()
+    response = client.get('/api/tune_by_id?id=abandoned', buffered=False)
+    assert response.status_code == 200
+    assert not flask_app.query_flights._flights
+    response.close()
+    response = client.get('/api/tune_by_id?id=abandoned')
+    assert response.get_json()['results']['bindings'][0]['title']['value'] == 'title-value'
+    assert sparql_server.count('core:id "abandoned"') == 1
+
+
+def test_read_body_is_cached(sparql_server):
+    client = flask_app.app.test_client()
+    for _ in range(2):
+        response = client.get('/api/tune_by_id?id=cached')
+        assert response.get_json()['results']['bindings'][0]['title']['value'] == 'title-value'
+        response.close()
+    assert not flask_app.query_flights._flights
+    assert sparql_server.count('core:id "cached"') == 1
+
+
+# The responses from the endpoint, as they are returned to the app, each
+# noting whether it has been closed.
+def record_responses(monkeypatch):
+    responses = []
+    query = flask_app.api.sparql_client.query
+
+    def recorded_query(*args, **kwargs):
+        response = query(*args, **kwargs)
+        close = response.close
+
+        def recorded_close():
+            response.was_closed = True
+            close()
+        response.was_closed = False
+        response.close = recorded_close
+        responses.append(response)
+        return response
+    monkeypatch.setattr(flask_app.api.sparql_client, 'query', recorded_query)
+    return responses
+
+
+# A result too large to be cached is streamed through. Its flight is finished
+# before it is sent, and the response from the endpoint is closed with the
+# response to the client, even when its body is never read.
+def test_large_body_is_closed_with_head_response(sparql_server, monkeypatch):
+    monkeypatch.setattr(flask_app.response_cache, 'max_entry_bytes', 10)
+    responses = record_responses(monkeypatch)
+    client = flask_app.app.test_client()
+    response = client.head('/api/tune_by_id?id=large', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert not flask_app.query_flights._flights
+    assert not responses[0].was_closed
+    response.close()
+    assert responses[0].was_closed
+
+
+# A result streamed from the endpoint is compressed as it is sent, with gzip
+# for the clients that don't accept brotli.
+def test_streamed_body_is_gzipped(sparql_server, monkeypatch):
+    monkeypatch.setattr(flask_app.response_cache, 'max_entry_bytes', 10)
+    client = flask_app.app.test_client()
+    response = client.get('/api/tune_by_id?id=gzip', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.headers['Content-Encoding'] == 'gzip'
+    result = json.loads(gzip.decompress(response.get_data()))
+    assert result['results']['bindings'][0]['title']['value'] == 'title-value'
+
+
+# The ASGI app reads the whole body of a query, and a call to the endpoint
+# is shared by a task of its own, so neither a HEAD request nor a request
+# that is cancelled can leave it in flight.
+def test_asgi_head_and_cancelled_requests(sparql_server):
+    import asgi_app
+
+    async def requests():
+        async with asgi_app.app.test_app() as test_app:
+            client = test_app.test_client()
+            response = await client.head('/api/tune_by_id?id=asgi-head')
+            assert response.status_code == 200
+            assert not asgi_app.queries_in_flight
+            sparql_server.delay = 0.2
+            request = asyncio.ensure_future(client.get('/api/tune_by_id?id=asgi-cancelled'))
+            await asyncio.sleep(0.1)
+            request.cancel()
+            await asyncio.sleep(0.3)
+            # The call went on for the others, and its result was cached.
+            assert sparql_server.count('core:id "asgi-cancelled"') == 1
+            assert not asgi_app.queries_in_flight
+            sparql_server.delay = 0.0
+            start = time.perf_counter()
+            response = await client.get('/api/tune_by_id?id=asgi-cancelled')
+            assert response.status_code == 200
+            assert time.perf_counter() - start < 1
+
+    asyncio.run(requests())
+    assert sparql_server.count('core:id "asgi-cancelled"') == 1
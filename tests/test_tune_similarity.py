@@ -0,0 +1,154 @@
+import random
+
+import numpy as np
+import pytest
+
+import tune_similarity
+from pattern_index import OccurrenceIndex
+
+# The job is checked on small synthetic exports. The complexities are
+# multiples of a power of two, so that the scores are exact and tied scores
+# compare equal whatever order they are summed in.
+COMPLEXITIES = [None, 0.25, 0.5, 1.0, 1.5, 2.0]
+K = 5
+
+
+# The occurrences of a random export, ordered by tune id and pattern as the
+# export is, the complexity of every pattern and the tunes with a title.
+def make_export(rng, tunes=60, patterns=40):
+    complexities = {f'p{column:02d}': rng.choice(COMPLEXITIES) for column in range(patterns)}
+    counts = {f't{row:03d}': {pattern: rng.randint(1, 4)
+                              for pattern in rng.sample(sorted(complexities), rng.randint(1, 8))}
+              for row in range(tunes)}
+    titled = {tune_id for tune_id in counts if rng.random() < .8}
+    return counts, complexities, titled
+
+
+# The export after a new release touching part of the graph: some counts and
+# a complexity change, a tune is removed, one added and one loses its title.
+def change_export(rng, counts, complexities, titled):
+    counts = {tune_id: dict(tune_counts) for tune_id, tune_counts in counts.items()}
+    complexities = dict(complexities)
+    titled = set(titled)
+    for tune_id in rng.sample(sorted(counts), 3):
+        pattern = rng.choice(sorted(counts[tune_id]))
+        counts[tune_id][pattern] += 1
+    del counts[rng.choice(sorted(counts))]
+    counts['t500'] = {pattern: 2 for pattern in rng.sample(sorted(complexities), 4)}
+    titled.add('t500')
+    titled.discard(rng.choice(sorted(titled)))
+    pattern = rng.choice([pattern for pattern, complexity in complexities.items() if complexity is not None])
+    complexities[pattern] *= 2
+    return counts, complexities, titled
+
+
+def make_index(counts, complexities, titled):
+    occurrences = [(tune_id, pattern, count) for tune_id in sorted(counts)
+                   for pattern, count in sorted(counts[tune_id].items())]
+    tune_rows = {tune_id: [{'id': {'type': 'literal', 'value': tune_id}}] for tune_id in sorted(counts)}
+    # A row per family of each tune with a title, of which there are none to
+    # two.
+    neighbour_rows = {}
+    for tune_id in sorted(titled):
+        row = {'title': {'type': 'literal', 'value': f'Title {tune_id}'},
+               'id': {'type': 'literal', 'value': tune_id}}
+        neighbour_rows[tune_id] = [{**row, 'family': {'type': 'literal', 'value': f'Family {family}'}}
+                                   for family in range(int(tune_id[1:]) % 3)] or [row]
+    corpus_rows = [(tune_id, None) for tune_id in sorted(counts)]
+    return OccurrenceIndex(occurrences, complexities, tune_rows, neighbour_rows, corpus_rows)
+
+
+# The top k neighbours of every tune, scored pair by pair as
+# get_ranked_tunes_by_common_patterns scores them: the highest score first,
+# ties in tune id order. Returns their ids and scores, and the number of
+# neighbours of each tune.
+def brute_force(counts, complexities, titled, k):
+    neighbours = {}
+    for tune_id, tune_counts in counts.items():
+        scores = {}
+        for other, other_counts in counts.items():
+            if other == tune_id or other not in titled:
+                continue
+            shared = [pattern for pattern in tune_counts
+                      if pattern in other_counts and complexities[pattern] is not None]
+            if shared:
+                scores[other] = sum(tune_counts[pattern] * other_counts[pattern] * complexities[pattern]
+                                    for pattern in shared)
+        ranked = sorted(scores, key=lambda other: (-scores[other], other))[:k]
+        neighbours[tune_id] = (ranked, [scores[other] for other in ranked], len(scores))
+    return neighbours
+
+
+# The neighbours saved by the job, in the same form.
+def saved_neighbours(path):
+    data = tune_similarity.read_neighbours(path)
+    tune_ids = data['tune_ids'].tolist()
+    neighbours = {}
+    for row, tune_id in enumerate(tune_ids):
+        rows = data['neighbours'][row]
+        rows = rows[rows >= 0]
+        neighbours[tune_id] = ([tune_ids[other] for other in rows],
+                               data['scores'][row][:len(rows)].tolist(), int(data['counts'][row]))
+    return neighbours
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_neighbours_match_brute_force(tmp_path, monkeypatch, seed):
+    counts, complexities, titled = make_export(random.Random(seed))
+    # Several blocks, computed in two processes
+    monkeypatch.setattr(tune_similarity, 'BLOCK_ENTRIES', 600)
+    path = str(tmp_path / 'tune_similarity.npz')
+    tune_similarity.run(make_index(counts, complexities, titled), 'version-1', path, k=K, processes=2)
+    expected = brute_force(counts, complexities, titled, K)
+    assert saved_neighbours(path) == expected
+    # Tunes with more neighbours than are kept, and with none
+    assert any(count > K for *_, count in expected.values())
+    assert any(count == 0 for *_, count in expected.values())
+
+
+@pytest.mark.parametrize('seed', [3, 4, 5])
+def test_incremental_run_matches_full_run(tmp_path, capsys, seed):
+    rng = random.Random(seed)
+    export = make_export(rng)
+    changed = change_export(rng, *export)
+    path = str(tmp_path / 'tune_similarity.npz')
+    full_path = str(tmp_path / 'full.npz')
+    tune_similarity.run(make_index(*export), 'version-1', path, k=K, processes=1)
+    capsys.readouterr()
+    index = make_index(*changed)
+    tune_similarity.run(index, 'version-2', path, k=K, processes=1)
+    tune_similarity.run(index, 'version-2', full_path, k=K, processes=1)
+    incremental_run, full_run = capsys.readouterr().out.splitlines()
+    # Only part of the tunes were recomputed
+    assert f'computed {len(index.tune_ids)} of' not in incremental_run
+    assert f'computed {len(index.tune_ids)} of' in full_run
+
+    incremental, full = tune_similarity.read_neighbours(path), tune_similarity.read_neighbours(full_path)
+    assert sorted(incremental) == sorted(full)
+    for name in full:
+        np.testing.assert_array_equal(incremental[name], full[name], err_msg=name)
+    assert saved_neighbours(path) == brute_force(*changed, K)
+
+
+# The app serves the network from the file alone, a page of rows at a time,
+# for the version it was computed for.
+def test_network_is_served_from_the_file(tmp_path):
+    counts, complexities, titled = make_export(random.Random(6))
+    index = make_index(counts, complexities, titled)
+    path = str(tmp_path / 'tune_similarity.npz')
+    tune_similarity.run(index, 'version-1', path, k=K, processes=1)
+    similarity = tune_similarity.TuneSimilarity('version-1', path)
+    for tune_id, (neighbours, _, count) in brute_force(counts, complexities, titled, K).items():
+        rows = [row for neighbour in neighbours for row in index.neighbour_rows[neighbour]]
+        for offset in range(0, len(rows) + 3, 3):
+            result = similarity.neighbour_tunes(tune_id, offset, 3)
+            if offset + 3 > len(rows) and count > K:
+                # Past the neighbours kept
+                assert result is None
+            else:
+                assert result == {'head': {'vars': ['title', 'id', 'family']},
+                                  'results': {'bindings': rows[offset:offset + 3]}}
+    assert similarity.neighbour_tunes('unknown', 0, 3)['results']['bindings'] == []
+
+    similarity.set_version('version-2')
+    assert similarity.neighbour_tunes('t000', 0, 3) is None
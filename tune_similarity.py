@@ -0,0 +1,305 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from kg_version import KGVersionMonitor
+from pattern_index import PatternIndex
+from local_store import make_sparql_client
+from sparql_client import BLAZEGRAPH_URL
+
+# Where the job stores the neighbours and the app reads them from.
+SIMILARITY_PATH = os.environ.get('TUNE_SIMILARITY_PATH', 'tune_similarity.npz')
+# Number of neighbours stored per tune. Pages past these are queried for.
+TOP_K = int(os.environ.get('TUNE_SIMILARITY_TOP_K', 100))
+PROCESSES = int(os.environ.get('TUNE_SIMILARITY_PROCESSES', os.cpu_count() or 1))
+# Size of the block of the score matrix computed at once by each process.
+BLOCK_ENTRIES = 1 << 22
+# Seconds between checks for a new file in the app.
+RELOAD_INTERVAL = 60
+TUNE_NEIGHBOUR_VARS = ['title', 'id', 'family']
+
+
+# Tune-tune similarity, precomputed by running this module as a job after
+# each release of the knowledge graph:
+#     python tune_similarity.py
+# The score of a tune against another is the one ranked by
+# get_ranked_tunes_by_common_patterns: the sum over their shared patterns
+# of the occurrences in one tune x the occurrences in the other x the pattern
+# complexity, i.e. the rows of C.diag(complexity).C^T for the tune x pattern
+# count matrix C. Only the top TOP_K neighbours of each tune are kept, with
+# the result rows of every tune, so that the app serves the network from the
+# file alone.
+
+# The occurrence index shared with the worker processes.
+_index = None
+_eligible = None
+
+
+def _init_worker(index, eligible):
+    global _index, _eligible
+    _index = index
+    _eligible = eligible
+
+
+# The positions start..end of each range, concatenated.
+def _ranges(starts, ends):
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return np.arange(lengths.sum(), dtype=np.int64) + offsets
+
+
+# Top k neighbours of a block of tune rows. Returns the neighbour rows (-1
+# where a tune has fewer than k), their scores and the number of neighbours of
+# each tune.
+def _top_k_block(rows, k):
+    index, eligible = _index, _eligible
+    num_tunes = len(index.tune_ids)
+    # The patterns of every tune in the block, with a complexity.
+    starts, ends = index.tune_indptr[rows], index.tune_indptr[rows + 1]
+    positions = _ranges(starts, ends)
+    block_rows = np.repeat(np.arange(len(rows)), ends - starts)
+    columns = index.tune_patterns[positions]
+    complexity = index.complexity[columns].astype(np.float64)
+    keep = ~np.isnan(complexity)
+    block_rows, columns = block_rows[keep], columns[keep]
+    weights = index.tune_counts[positions][keep] * complexity[keep]
+    # Every occurrence of those patterns in other tunes.
+    starts, ends = index.pattern_indptr[columns], index.pattern_indptr[columns + 1]
+    positions = _ranges(starts, ends)
+    lengths = ends - starts
+    keys = np.repeat(block_rows, lengths) * num_tunes + index.pattern_tunes[positions]
+    scores = np.bincount(keys, np.repeat(weights, lengths) * index.pattern_counts[positions],
+                         minlength=len(rows) * num_tunes).reshape(len(rows), num_tunes)
+    shared = np.bincount(keys, minlength=len(rows) * num_tunes).reshape(len(rows), num_tunes) > 0
+    # Neighbours must have a title, and a tune is not its own neighbour.
+    shared &= eligible
+    shared[np.arange(len(rows)), rows] = False
+    scores[~shared] = -np.inf
+
+    neighbours = np.full((len(rows), k), -1, dtype=np.int32)
+    neighbour_scores = np.zeros((len(rows), k), dtype=np.float32)
+    counts = shared.sum(axis=1).astype(np.int32)
+    for i in range(len(rows)):
+        if counts[i] == 0:
+            continue
+        candidates = np.flatnonzero(shared[i])
+        if len(candidates) > k:
+            threshold = np.partition(scores[i, candidates], len(candidates) - k)[len(candidates) - k]
+            candidates = candidates[scores[i, candidates] >= threshold]
+        # Highest score first, ties in tune id order.
+        order = np.lexsort((candidates, -scores[i, candidates]))[:k]
+        neighbours[i, :len(order)] = candidates[order]
+        neighbour_scores[i, :len(order)] = scores[i, candidates[order]]
+    return rows, neighbours, neighbour_scores, counts
+
+
+# Tunes that can be neighbours: those with a title.
+def eligible_tunes(index):
+    return np.array([tune_id in index.neighbour_rows for tune_id in index.tune_id_list], dtype=bool)
+
+
+# Compute the top k neighbours of the given tune rows of an OccurrenceIndex,
+# in parallel across processes.
+def compute_neighbours(index, rows, eligible, k=TOP_K, processes=PROCESSES):
+    num_tunes = len(index.tune_ids)
+    neighbours = np.full((num_tunes, k), -1, dtype=np.int32)
+    scores = np.zeros((num_tunes, k), dtype=np.float32)
+    counts = np.zeros(num_tunes, dtype=np.int32)
+    block_size = max(1, BLOCK_ENTRIES // max(num_tunes, 1))
+    blocks = [rows[start:start + block_size] for start in range(0, len(rows), block_size)]
+    if processes > 1 and len(blocks) > 1:
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        with context.Pool(processes, initializer=_init_worker, initargs=(index, eligible)) as pool:
+            results = pool.starmap(_top_k_block, [(block, k) for block in blocks])
+    else:
+        _init_worker(index, eligible)
+        results = [_top_k_block(block, k) for block in blocks]
+    for block, block_neighbours, block_scores, block_counts in results:
+        neighbours[block] = block_neighbours
+        scores[block] = block_scores
+        counts[block] = block_counts
+    return neighbours, scores, counts
+
+
+def _stable_hashes(strings):
+    return np.array([int.from_bytes(hashlib.blake2b(string.encode('utf-8'), digest_size=8).digest(), 'little')
+                     for string in strings], dtype=np.uint64)
+
+
+def _mix(values):
+    # The splitmix64 finalizer; uint64 arithmetic wraps around.
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def _segment_sums(values, indptr):
+    totals = np.concatenate(([np.uint64(0)], np.cumsum(values, dtype=np.uint64)))
+    return totals[indptr[1:]] - totals[indptr[:-1]]
+
+
+# Fingerprints of each tune's patterns and counts and of each pattern's
+# tunes, counts and complexity. A tune's neighbours can only change if its
+# own fingerprint or the fingerprint of one of its patterns does.
+def fingerprints(index, eligible):
+    tune_hashes = _stable_hashes(index.tune_id_list) ^ eligible.astype(np.uint64)
+    pattern_hashes = _stable_hashes(index.patterns) ^ _mix(index.complexity.view(np.uint32).astype(np.uint64))
+    tune_fingerprints = _mix(tune_hashes + _segment_sums(
+        _mix(pattern_hashes[index.tune_patterns] ^ _mix(index.tune_counts.astype(np.uint64))),
+        index.tune_indptr))
+    pattern_fingerprints = _mix(pattern_hashes + _segment_sums(
+        _mix(tune_hashes[index.pattern_tunes] ^ _mix(index.pattern_counts.astype(np.uint64))),
+        index.pattern_indptr))
+    return tune_fingerprints, pattern_fingerprints
+
+
+def read_neighbours(path=SIMILARITY_PATH):
+    try:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError):
+        return None
+
+
+def write_neighbours(path, **arrays):
+    # Write to a temporary file and rename it, so that the app never reads a
+    # partly written file.
+    temp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, path)
+
+
+# Compute the neighbours for the index's KG version and save them. Tunes whose
+# fingerprints are unchanged since the previous run keep their neighbours, so
+# a release that only touches part of the graph is quick to process.
+def run(index, version, path=SIMILARITY_PATH, k=TOP_K, processes=PROCESSES):
+    start = time.perf_counter()
+    num_tunes = len(index.tune_ids)
+    eligible = eligible_tunes(index)
+    tune_fingerprints, pattern_fingerprints = fingerprints(index, eligible)
+    tune_ids = np.array(index.tune_id_list, dtype=str)
+
+    previous = read_neighbours(path)
+    if previous is not None and int(previous['k']) == k:
+        changed_patterns = np.flatnonzero(~np.isin(pattern_fingerprints, previous['pattern_fingerprints']))
+        affected = ~np.isin(tune_fingerprints, previous['tune_fingerprints'])
+        affected[index.pattern_tunes[_ranges(index.pattern_indptr[changed_patterns],
+                                             index.pattern_indptr[changed_patterns + 1])]] = True
+        rows = np.flatnonzero(affected).astype(np.int32)
+    else:
+        previous = None
+        rows = np.arange(num_tunes, dtype=np.int32)
+
+    neighbours, scores, counts = compute_neighbours(index, rows, eligible, k, processes)
+    if previous is not None:
+        # Copy the unaffected tunes' neighbours, mapping the previous rows to
+        # this version's rows by tune id.
+        previous_rows = {tune_id: row for row, tune_id in enumerate(previous['tune_ids'])}
+        new_rows = np.array([index.tune_ids.get(tune_id, -1) for tune_id in previous['tune_ids']] + [-1],
+                            dtype=np.int32)
+        for row in np.flatnonzero(~affected):
+            old_row = previous_rows[index.tune_id_list[row]]
+            neighbours[row] = new_rows[previous['neighbours'][old_row]]
+            scores[row] = previous['scores'][old_row]
+            counts[row] = previous['counts'][old_row]
+    # The title, id and family rows of each tune, as a JSON list per tune
+    neighbour_rows = json.dumps([index.neighbour_rows.get(tune_id, []) for tune_id in index.tune_id_list],
+                                separators=(',', ':'))
+    write_neighbours(path, version=np.array(version, dtype=str), k=np.array(k), tune_ids=tune_ids,
+                     neighbours=neighbours, scores=scores, counts=counts,
+                     neighbour_rows=np.array(neighbour_rows, dtype=str),
+                     tune_fingerprints=tune_fingerprints, pattern_fingerprints=pattern_fingerprints)
+    print(f"Tune similarity for version {version}: computed {len(rows)} of {num_tunes} tunes "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+# Serves the tune-tune network from the job's output, if it was computed for
+# the current KG version, or the version isn't known. Returns None whenever it
+# can't answer, so the caller should query the endpoint instead.
+class TuneSimilarity:
+    def __init__(self, version=None, path=SIMILARITY_PATH):
+        self.version = version
+        self.path = path
+        self._data = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    # Reload the file if it has changed, checking at most every
+    # RELOAD_INTERVAL seconds.
+    def _load(self):
+        now = time.monotonic()
+        if now - self._checked < RELOAD_INTERVAL:
+            return self._data
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return self._data
+            if mtime != self._mtime:
+                data = read_neighbours(self.path)
+                # Files written before the rows were saved are left for the
+                # job to replace.
+                if data is not None and 'neighbour_rows' in data:
+                    data['tune_ids'] = data['tune_ids'].tolist()
+                    data['neighbour_rows'] = json.loads(str(data['neighbour_rows']))
+                    data['rows'] = {tune_id: row for row, tune_id in enumerate(data['tune_ids'])}
+                    data['version'] = str(data['version'])
+                    self._data = data
+                    self._mtime = mtime
+        return self._data
+
+    # Follow the KG version, as a KGVersionMonitor listener.
+    def set_version(self, version):
+        self.version = version
+
+    # A page of get_ranked_tunes_by_common_patterns.
+    def neighbour_tunes(self, tune_id, offset, limit):
+        data = self._load()
+        if data is None or self.version is not None and data['version'] != self.version:
+            return None
+        row = data['rows'].get(tune_id)
+        bindings = []
+        complete = True
+        if row is not None:
+            neighbours = data['neighbours'][row]
+            for neighbour in neighbours[neighbours >= 0]:
+                bindings.extend(data['neighbour_rows'][neighbour])
+            complete = data['counts'][row] <= len(neighbours)
+        if offset + limit > len(bindings) and not complete:
+            return None
+        return {'head': {'vars': TUNE_NEIGHBOUR_VARS},
+                'results': {'bindings': bindings[offset:offset + limit]}}
+
+
+def main():
+    sparql_client = make_sparql_client(BLAZEGRAPH_URL)
+    version = KGVersionMonitor(sparql_client).fetch()
+    previous = read_neighbours()
+    if previous is not None and version is not None and str(previous['version']) == version \
+            and 'neighbour_rows' in previous and '--force' not in sys.argv:
+        print(f"Tune similarity is up to date for version {version}")
+        return
+    # The index saved by the pattern index job, if it is up to date, or one
+    # built from the export
+    pattern_index = PatternIndex(sparql_client)
+    pattern_index.set_version(version)
+    pattern_index.load()
+    if not pattern_index.ready:
+        pattern_index.refresh(version)
+    if not pattern_index.ready:
+        sys.exit(1)
+    run(pattern_index.index, version)
+
+
+if __name__ == "__main__":
+    main()